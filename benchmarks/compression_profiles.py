@@ -0,0 +1,80 @@
+"""Compare the chunk compression profiles on one completed chunk.
+
+Recompresses the chunk's rows Parquet and its three vector sidecars with each
+profile and reports MB/s of uncompressed input and the compression ratio.
+
+    python benchmarks/compression_profiles.py work/completed --chunk-id 1
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import time
+from pathlib import Path
+from typing import Optional
+
+import pyarrow.parquet as pq
+import zstandard as zstd
+
+from npc_labeler.output import COMPRESSION_PROFILES, VECTOR_COMPLETED_SUFFIXES
+
+
+def _time(run, repeats: int):
+    run()
+    started = time.perf_counter()
+    for _ in range(repeats):
+        output_bytes = run()
+    return (time.perf_counter() - started) / repeats, output_bytes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("completed_dir", type=Path)
+    parser.add_argument("--chunk-id", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    stem = "part-{0:06d}".format(args.chunk_id)
+    rows_table = pq.read_table(args.completed_dir / (stem + ".parquet"))
+    sidecars = []
+    for suffix in VECTOR_COMPLETED_SUFFIXES.values():
+        with (args.completed_dir / (stem + suffix)).open("rb") as handle:
+            reader = zstd.ZstdDecompressor().stream_reader(handle, read_across_frames=True)
+            sidecars.append(reader.read())
+    vector_bytes = sum(len(payload) for payload in sidecars)
+
+    def rows_run(level: Optional[int]):
+        def run() -> int:
+            buffer = io.BytesIO()
+            pq.write_table(rows_table, buffer, compression="zstd", compression_level=level)
+            return buffer.tell()
+
+        return run
+
+    def vectors_run(profile):
+        def run() -> int:
+            cctx = profile.zstd_compressor()
+            return sum(len(cctx.compress(payload)) for payload in sidecars)
+
+        return run
+
+    print("{0} rows, {1:.1f} MB raw vectors".format(rows_table.num_rows, vector_bytes / 1e6))
+    print("{0:<10} {1:<8} {2:>10} {3:>8}".format("profile", "files", "MB/s", "ratio"))
+    for name, profile in COMPRESSION_PROFILES.items():
+        seconds, output_bytes = _time(vectors_run(profile), args.repeats)
+        print(
+            "{0:<10} {1:<8} {2:>10.1f} {3:>8.2f}".format(
+                name, "vectors", vector_bytes / seconds / 1e6, vector_bytes / output_bytes
+            )
+        )
+        seconds, output_bytes = _time(rows_run(profile.parquet_level), args.repeats)
+        print(
+            "{0:<10} {1:<8} {2:>10.1f} {3:>8.2f}".format(
+                name, "rows", rows_table.nbytes / seconds / 1e6, rows_table.nbytes / output_bytes
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
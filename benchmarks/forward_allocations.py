@@ -0,0 +1,117 @@
+"""Compare the allocating and workspace forward passes.
+
+Reports wall time, tracemalloc peak bytes and minor page faults per batch for
+the fused NPClassifier heads. Uses the real weights when --weights-dir is
+given, otherwise random plans with --hidden widths.
+
+    python benchmarks/forward_allocations.py --weights-dir work/weights
+"""
+
+from __future__ import annotations
+
+import argparse
+import resource
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from npc_labeler.inference import (
+    FingerprintBatch,
+    ForwardWorkspace,
+    FusedPlan,
+    ModelPlan,
+    PlanStep,
+    load_model_plan,
+)
+
+MODEL_FILES = (
+    "NP_classifier_superclass_V1.hdf5",
+    "NP_classifier_class_V1.hdf5",
+    "NP_classifier_pathway_V1.hdf5",
+)
+HEAD_WIDTHS = (77, 687, 7)
+
+
+def _random_plan(rng: np.random.Generator, widths: list, outputs: int) -> ModelPlan:
+    steps = []
+    dims = [6144] + widths
+    for inputs, hidden in zip(dims[:-1], dims[1:]):
+        steps.append(
+            PlanStep(
+                op="dense",
+                weight=(rng.standard_normal((inputs, hidden)) * 0.02).astype(np.float32),
+                bias=np.zeros((hidden,), dtype=np.float32),
+                activation="relu",
+            )
+        )
+    steps.append(
+        PlanStep(
+            op="dense",
+            weight=(rng.standard_normal((dims[-1], outputs)) * 0.02).astype(np.float32),
+            bias=np.zeros((outputs,), dtype=np.float32),
+            activation="sigmoid",
+        )
+    )
+    return ModelPlan(steps=steps)
+
+
+def _random_batch(rng: np.random.Generator, rows: int, nnz: int, width: int) -> FingerprintBatch:
+    indices = [np.sort(rng.choice(width, size=nnz, replace=False)) for _ in range(rows)]
+    return FingerprintBatch(
+        indptr=np.arange(0, rows * nnz + 1, nnz, dtype=np.int64),
+        indices=np.concatenate(indices).astype(np.intp),
+        counts=rng.integers(1, 4, size=rows * nnz).astype(np.float32),
+    )
+
+
+def _measure(run, batches: int):
+    run()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    faults_before = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    started = time.perf_counter()
+    for _ in range(batches):
+        run()
+    elapsed = time.perf_counter() - started
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults_before
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / batches, peak - baseline, faults / batches
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--weights-dir", type=Path)
+    parser.add_argument("--hidden", default="3072,1536", help="Synthetic hidden widths.")
+    parser.add_argument("--rows", type=int, default=1024)
+    parser.add_argument("--nnz", type=int, default=64, help="Non-zero columns per row.")
+    parser.add_argument("--batches", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.weights_dir is not None:
+        plans = [load_model_plan(args.weights_dir / filename) for filename in MODEL_FILES]
+    else:
+        hidden = [int(width) for width in args.hidden.split(",")]
+        plans = [_random_plan(rng, hidden, outputs) for outputs in HEAD_WIDTHS]
+    engine = FusedPlan.from_plans(plans)
+    workspace = ForwardWorkspace(engine, args.rows)
+    batch = _random_batch(rng, args.rows, args.nnz, engine.input_width)
+
+    runs = {
+        "dense/allocating": lambda: engine.forward(batch.dense(engine.input_width)),
+        "dense/workspace": lambda: workspace.run(batch, sparse=False),
+        "sparse/allocating": lambda: engine.forward_sparse(batch),
+        "sparse/workspace": lambda: workspace.run(batch, sparse=True),
+    }
+    print("{0:<20} {1:>10} {2:>16} {3:>14}".format("mode", "ms/batch", "peak bytes/run", "minflt/batch"))
+    for name, run in runs.items():
+        seconds, peak_bytes, faults = _measure(run, args.batches)
+        print("{0:<20} {1:>10.2f} {2:>16d} {3:>14.1f}".format(name, seconds * 1000, peak_bytes, faults))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ PUBCHEM_CID_SMILES_URL = (
     "https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/CID-SMILES.gz"
 )
 PARQUET_CHUNK_ROWS = 10_000_000
+DEFAULT_VOTE_CACHE_SIZE = 65536
 
 
 def _env_int(name: str, default: Optional[int]) -> Optional[int]:
@@ -18,6 +19,18 @@ def _env_int(name: str, default: Optional[int]) -> Optional[int]:
     return int(raw_value)
 
 
+def _env_bool(name: str, default: bool) -> bool:
+    raw_value = os.environ.get(name)
+    if raw_value is None or raw_value.strip() == "":
+        return default
+    value = raw_value.strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off"):
+        return False
+    raise ValueError("{0} must be a boolean; got {1!r}".format(name, raw_value))
+
+
 def _default_work_dir() -> Path:
     return Path(os.environ.get("NPC_WORK_DIR", "/work"))
 
@@ -49,6 +62,26 @@ def build_parser() -> argparse.ArgumentParser:
         default=work_dir / "CID-SMILES.tsv",
         help="Plain-text PubChem input used for resumable chunk-boundary processing.",
     )
+    run_parser.add_argument(
+        "--input-mode",
+        choices=("materialized", "indexed-gzip"),
+        default=os.environ.get("NPC_INPUT_MODE", "materialized"),
+        help=(
+            "materialized decompresses a .gz input to --materialized-input once; "
+            "indexed-gzip reads the .gz directly and resumes through a seek index "
+            "built next to it (needs the indexed_gzip package)."
+        ),
+    )
+    run_parser.add_argument(
+        "--defer-count",
+        action="store_true",
+        default=_env_bool("NPC_DEFER_COUNT", False),
+        help=(
+            "Start labelling before the input's rows are counted when it can be "
+            "read in place (plain text, or .gz with --input-mode indexed-gzip); "
+            "the count runs in the background and the manifest waits for it."
+        ),
+    )
     run_parser.add_argument(
         "--weights-dir",
         type=Path,
@@ -94,11 +127,114 @@ def build_parser() -> argparse.ArgumentParser:
         default=_env_int("NPC_INFERENCE_BATCH_ROWS", 1024),
         help="Number of prepared rows to stack into each model forward pass.",
     )
+    run_parser.add_argument(
+        "--inference-mode",
+        choices=("dense", "sparse"),
+        default=os.environ.get("NPC_INFERENCE_MODE", "dense"),
+        help=(
+            "How the first Dense layer consumes the fingerprints: a dense GEMM, "
+            "or a sparse gather over the non-zero fingerprint columns."
+        ),
+    )
+    run_parser.add_argument(
+        "--inference-precision",
+        choices=("float32", "float16", "int8"),
+        default=os.environ.get("NPC_INFERENCE_PRECISION", "float32"),
+        help=(
+            "Storage precision of the first-layer weights. float16 and int8 need "
+            "--inference-mode sparse, and the run aborts if they change the voted "
+            "labels of the first inference slice."
+        ),
+    )
+    run_parser.add_argument(
+        "--vote-cache-size",
+        type=int,
+        default=_env_int("NPC_VOTE_CACHE_SIZE", DEFAULT_VOTE_CACHE_SIZE),
+        help=(
+            "Entries in the LRU cache of voting outcomes keyed by thresholded "
+            "label sets. 0 disables the cache."
+        ),
+    )
+    run_parser.add_argument(
+        "--rows-writer",
+        choices=("staged", "streaming"),
+        default=os.environ.get("NPC_ROWS_WRITER", "staged"),
+        help=(
+            "staged writes a Parquet part per checkpoint and merges them at the "
+            "chunk boundary; streaming appends a row group per checkpoint to the "
+            "chunk's final file and finalizes it by rename."
+        ),
+    )
+    run_parser.add_argument(
+        "--vector-writer",
+        choices=("staged", "streaming"),
+        default=os.environ.get("NPC_VECTOR_WRITER", "staged"),
+        help=(
+            "staged keeps raw float16 parts on scratch disk and compresses them at "
+            "the chunk boundary; streaming appends one zstd frame per checkpoint to "
+            "each chunk sidecar."
+        ),
+    )
+    run_parser.add_argument(
+        "--compression-profile",
+        choices=("fast", "balanced", "archive"),
+        default=os.environ.get("NPC_COMPRESSION_PROFILE", "archive"),
+        help=(
+            "zstd level, worker threads and long-distance matching used for the "
+            "completed chunk sidecars and rows Parquet."
+        ),
+    )
+    run_parser.add_argument(
+        "--inference-threads",
+        type=int,
+        default=_env_int("NPC_INFERENCE_THREADS", 1),
+        help=(
+            "Threads classifying prepared checkpoint batches, each with its own "
+            "inference workspace. Results are still written in input order."
+        ),
+    )
+    run_parser.add_argument(
+        "--pipeline-queue-depth",
+        type=int,
+        default=_env_int("NPC_PIPELINE_QUEUE_DEPTH", 2),
+        help=(
+            "Checkpoint batches each pipeline stage may hand ahead to the next "
+            "before it blocks."
+        ),
+    )
+    run_parser.add_argument(
+        "--max-pending-chunks",
+        type=int,
+        default=_env_int("NPC_MAX_PENDING_CHUNKS", 1),
+        help=(
+            "Finished chunks that may be merging, compressing and hashing in a "
+            "background process while the next chunk is classified. 0 finalizes "
+            "each chunk inline."
+        ),
+    )
+    run_parser.add_argument(
+        "--prep-workers",
+        type=int,
+        default=_env_int("NPC_PREP_WORKERS", 1),
+        help=(
+            "Number of worker processes running RDKit preparation. "
+            "1 keeps preparation in the main process."
+        ),
+    )
     run_parser.add_argument(
         "--download-pubchem",
         action="store_true",
         help="Download the latest PubChem CID-SMILES.gz if --pubchem-input is missing.",
     )
+    run_parser.add_argument(
+        "--download-connections",
+        type=int,
+        default=_env_int("NPC_DOWNLOAD_CONNECTIONS", 1),
+        help=(
+            "Parallel HTTP range requests used to download PubChem and the model "
+            "weights. Interrupted downloads resume from their .tmp file either way."
+        ),
+    )
     run_parser.add_argument(
         "--pubchem-url",
         default=os.environ.get("NPC_PUBCHEM_URL", PUBCHEM_CID_SMILES_URL),
@@ -138,6 +274,19 @@ def main() -> int:
         download_pubchem=args.download_pubchem,
         pubchem_url=args.pubchem_url,
         chunk_rows=args.chunk_rows,
+        prep_workers=args.prep_workers,
+        inference_mode=args.inference_mode,
+        inference_precision=args.inference_precision,
+        vote_cache_size=args.vote_cache_size,
+        rows_writer=args.rows_writer,
+        vector_writer=args.vector_writer,
+        compression_profile=args.compression_profile,
+        max_pending_chunks=args.max_pending_chunks,
+        inference_threads=args.inference_threads,
+        pipeline_queue_depth=args.pipeline_queue_depth,
+        input_mode=args.input_mode,
+        defer_count=args.defer_count,
+        download_connections=args.download_connections,
     )
     run_pipeline(config)
     return 0
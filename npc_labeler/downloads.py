@@ -3,17 +3,36 @@ from __future__ import annotations
 import gzip
 import hashlib
 import json
+import os
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Tuple, TypedDict, cast
+from typing import BinaryIO, List, Mapping, Optional, TypedDict, cast
 
 import requests
+import requests.adapters
+
+from npc_labeler.tsv import PubchemRowCounter, RowOffsetIndex
 
 PUBCHEM_CID_SMILES_URL = (
     "https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/CID-SMILES.gz"
 )
 MODEL_ZIP_URL = "https://zenodo.org/records/5068687/files/model.zip?download=1"
 MODEL_RECORD_DOI = "10.5281/zenodo.5068687"
+COPY_BLOCK_BYTES = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 120
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF_SECONDS = 2.0
+DOWNLOAD_MAX_BACKOFF_SECONDS = 60.0
+# Each connection fsyncs and records its progress at least this often.
+DOWNLOAD_SYNC_BYTES = 64 * 1024 * 1024
+INPUT_MODES = ("materialized", "indexed-gzip")
+# Uncompressed bytes between inflate checkpoints in the gzip seek index. Each
+# checkpoint stores a 32 KiB window, and a seek inflates at most this much.
+GZIP_INDEX_SPACING = 4 * 1024 * 1024
 
 EXPECTED_MD5 = {
     "model.zip": "7f5cf472aa970afd525267c595baf733",
@@ -55,24 +74,13 @@ class WeightsInfo(TypedDict):
 class SourceInfo(TypedDict):
     source_path: str
     materialized_path: str
-    pubchem_total: int
+    # None until a deferred count finishes.
+    pubchem_total: Optional[int]
     source_url: str
     source_bytes: int
     source_mtime_ns: int
 
 
-def _parse_pubchem_line(raw_line: str) -> Optional[Tuple[int, str]]:
-    parts = raw_line.rstrip("\n").split("\t", 1)
-    if len(parts) != 2:
-        return None
-    cid_text, smiles = parts
-    try:
-        cid = int(cid_text)
-    except ValueError:
-        return None
-    return cid, smiles.strip()
-
-
 def _checksum(path: Path, algorithm: str) -> str:
     digest = hashlib.new(algorithm)
     with path.open("rb") as handle:
@@ -98,27 +106,264 @@ def _ensure_checksum(path: Path, *, md5: str, sha256: str) -> None:
         )
 
 
-def download_file(url: str, destination: Path) -> None:
+def _parts_path(tmp_path: Path) -> Path:
+    return tmp_path.with_suffix(tmp_path.suffix + ".parts.json")
+
+
+def _range_validator(headers: Mapping[str, str]) -> Optional[str]:
+    """The If-Range value for a response, or None when ranges cannot be validated.
+
+    If-Range only accepts a strong ETag; a weak one makes the server answer
+    every range with the whole file, so Last-Modified is used instead.
+    """
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def _download_session(connections: int) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Byte ranges and Content-Length must refer to the file itself, not a re-encoding.
+    session.headers["Accept-Encoding"] = "identity"
+    return session
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+
+def _backoff(url: str, error: Exception, failures: int, backoff_seconds: float) -> None:
+    delay = min(backoff_seconds * 2 ** (failures - 1), DOWNLOAD_MAX_BACKOFF_SECONDS)
+    print("retrying {0} in {1:.0f}s after {2}".format(url, delay, error))
+    time.sleep(delay)
+
+
+class _RangedDownload:
+    """Byte ranges of one download and how much of each is safely on disk.
+
+    Progress for a range only advances after its bytes are fsync'd, and is
+    saved to a sidecar next to the ``.tmp`` file so a later run resumes every
+    range where it stopped.
+    """
+
+    def __init__(self, url: str, tmp_path: Path, size: int, validator: str) -> None:
+        self.url = url
+        self.tmp_path = tmp_path
+        self.size = size
+        self.validator = validator
+        self.parts: List[List[int]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def done_bytes(self) -> int:
+        return sum(done for _start, _end, done in self.parts)
+
+    def plan(self, connections: int) -> None:
+        parts_path = _parts_path(self.tmp_path)
+        if self.tmp_path.exists() and parts_path.exists():
+            payload = json.loads(parts_path.read_text())
+            if (payload["url"], payload["size"], payload["validator"]) == (
+                self.url,
+                self.size,
+                self.validator,
+            ):
+                self.parts = payload["parts"]
+                return
+        # Nothing says which version of the file a .tmp without a matching sidecar
+        # holds, so it is fetched again from the start.
+        _restart(self.tmp_path)
+        bounds = [self.size * index // connections for index in range(connections + 1)]
+        self.parts = [
+            [first, last, 0] for first, last in zip(bounds[:-1], bounds[1:]) if last > first
+        ]
+        self.save()
+
+    def advance(self, index: int, written: int) -> None:
+        with self._lock:
+            self.parts[index][2] += written
+            self.save()
+
+    def save(self) -> None:
+        payload = {
+            "url": self.url,
+            "size": self.size,
+            "validator": self.validator,
+            "parts": self.parts,
+        }
+        parts_path = _parts_path(self.tmp_path)
+        tmp_parts_path = parts_path.with_suffix(parts_path.suffix + ".tmp")
+        tmp_parts_path.write_text(json.dumps(payload) + "\n")
+        tmp_parts_path.replace(parts_path)
+
+    def fetch(
+        self, session: requests.Session, index: int, *, retries: int, backoff_seconds: float
+    ) -> None:
+        start, end, _done = self.parts[index]
+        failures = 0
+        with self.tmp_path.open("r+b") as handle:
+            while start + self.parts[index][2] < end:
+                before = self.parts[index][2]
+                try:
+                    self._fetch_once(session, handle, index)
+                except Exception as error:
+                    if self.parts[index][2] > before:
+                        failures = 0
+                    if not _retryable(error) or failures >= retries:
+                        raise
+                    failures += 1
+                    _backoff(self.url, error, failures, backoff_seconds)
+
+    def _fetch_once(self, session: requests.Session, handle: BinaryIO, index: int) -> None:
+        start, end, done = self.parts[index]
+        position = start + done
+        headers = {
+            "Range": "bytes={0}-{1}".format(position, end - 1),
+            "If-Range": self.validator,
+        }
+        written = 0
+        try:
+            with session.get(
+                self.url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206 and (position, end) != (0, self.size):
+                    raise RuntimeError(
+                        "{0} ignored the range request; the file may have changed on the "
+                        "server, remove {1} to start over".format(self.url, self.tmp_path)
+                    )
+                handle.seek(position)
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    chunk = chunk[: end - position - written]
+                    handle.write(chunk)
+                    written += len(chunk)
+                    if written >= DOWNLOAD_SYNC_BYTES:
+                        self._sync(handle, index, written)
+                        position += written
+                        written = 0
+        finally:
+            if written:
+                self._sync(handle, index, written)
+        if start + self.parts[index][2] < end:
+            raise requests.ConnectionError("connection closed before the range was complete")
+
+    def _sync(self, handle: BinaryIO, index: int, written: int) -> None:
+        handle.flush()
+        os.fsync(handle.fileno())
+        self.advance(index, written)
+
+
+def _restart(tmp_path: Path) -> None:
+    """Empty ``tmp_path`` and drop the range progress recorded for it."""
+    _parts_path(tmp_path).unlink(missing_ok=True)
+    tmp_path.write_bytes(b"")
+
+
+def _download_whole(
+    session: requests.Session, url: str, tmp_path: Path, *, retries: int, backoff_seconds: float
+) -> None:
+    _restart(tmp_path)
+    failures = 0
+    while True:
+        try:
+            with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+                response.raise_for_status()
+                with tmp_path.open("wb") as handle:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        handle.write(chunk)
+            return
+        except Exception as error:
+            if not _retryable(error) or failures >= retries:
+                raise
+            failures += 1
+            _backoff(url, error, failures, backoff_seconds)
+
+
+def download_file(
+    url: str,
+    destination: Path,
+    *,
+    connections: int = 1,
+    retries: int = DOWNLOAD_RETRIES,
+    backoff_seconds: float = DOWNLOAD_BACKOFF_SECONDS,
+) -> None:
+    """Download ``url`` to ``destination`` through ``destination``.tmp.
+
+    When the server serves byte ranges, the file is fetched as ``connections``
+    ranges in parallel and an interrupted download resumes from what is
+    already in the ``.tmp`` file. Transient errors are retried with
+    exponential backoff; a range restarts where its last attempt stopped.
+    """
+    if connections <= 0:
+        raise ValueError("connections must be positive; got {0}".format(connections))
     destination.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = destination.with_suffix(destination.suffix + ".tmp")
-    print("downloading {0} -> {1}".format(url, destination))
-    with requests.get(url, stream=True, timeout=120) as response:
-        response.raise_for_status()
-        with tmp_path.open("wb") as handle:
-            for chunk in response.iter_content(chunk_size=1024 * 1024):
-                if not chunk:
-                    continue
-                handle.write(chunk)
+    with _download_session(connections) as session:
+        response = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT_SECONDS)
+        length = response.headers.get("Content-Length")
+        validator = _range_validator(response.headers)
+        if (
+            not response.ok
+            or response.headers.get("Accept-Ranges", "").lower() != "bytes"
+            or length is None
+            or validator is None
+        ):
+            # Servers that refuse HEAD, byte ranges or a usable If-Range
+            # validator get one plain GET per attempt.
+            print("downloading {0} -> {1}".format(url, destination))
+            _download_whole(
+                session, url, tmp_path, retries=retries, backoff_seconds=backoff_seconds
+            )
+            tmp_path.replace(destination)
+            return
+
+        download = _RangedDownload(url, tmp_path, int(length), validator)
+        download.plan(connections)
+        if download.done_bytes:
+            print(
+                "resuming {0} -> {1} at {2}/{3} bytes".format(
+                    url, destination, download.done_bytes, download.size
+                )
+            )
+        else:
+            print("downloading {0} -> {1}".format(url, destination))
+        pending = [
+            index
+            for index, (start, end, done) in enumerate(download.parts)
+            if start + done < end
+        ]
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [
+                executor.submit(
+                    download.fetch, session, index, retries=retries, backoff_seconds=backoff_seconds
+                )
+                for index in pending
+            ]
+            for future in futures:
+                future.result()
+
+    if tmp_path.stat().st_size != download.size:
+        raise ValueError(
+            "{0} is {1} bytes; expected {2}".format(
+                tmp_path, tmp_path.stat().st_size, download.size
+            )
+        )
     tmp_path.replace(destination)
+    _parts_path(tmp_path).unlink()
 
 
-def ensure_model_weights(weights_dir: Path) -> WeightsInfo:
+def ensure_model_weights(weights_dir: Path, *, download_connections: int = 1) -> WeightsInfo:
     weights_dir.mkdir(parents=True, exist_ok=True)
     zip_path = weights_dir / "model.zip"
 
     need_zip = any(not (weights_dir / filename).exists() for filename in MODEL_FILES)
     if need_zip and not zip_path.exists():
-        download_file(MODEL_ZIP_URL, zip_path)
+        download_file(MODEL_ZIP_URL, zip_path, connections=download_connections)
 
     if zip_path.exists():
         _ensure_checksum(
@@ -171,7 +416,18 @@ def ensure_pubchem_input(
     materialized_input_path: Path,
     allow_download: bool,
     pubchem_url: str,
+    input_mode: str = "materialized",
+    defer_count: bool = False,
+    download_connections: int = 1,
 ) -> SourceInfo:
+    """Make the PubChem input readable and count its rows.
+
+    With ``defer_count``, an input that can be read in place (plain text, or
+    a ``.gz`` in indexed-gzip mode) and has no cached count is returned at
+    once with ``pubchem_total`` set to None; calling again without
+    ``defer_count`` does the count. A ``.gz`` in materialized mode is still
+    copied first, and that copy counts its rows as it goes.
+    """
     if not pubchem_input_path.exists():
         if not allow_download:
             raise FileNotFoundError(
@@ -179,8 +435,20 @@ def ensure_pubchem_input(
                     pubchem_input_path
                 )
             )
-        download_file(pubchem_url, pubchem_input_path)
-
+        download_file(pubchem_url, pubchem_input_path, connections=download_connections)
+
+    if input_mode not in INPUT_MODES:
+        raise ValueError("unsupported input mode {0!r}".format(input_mode))
+    in_place = pubchem_input_path.suffix != ".gz" or input_mode == "indexed-gzip"
+    if defer_count and in_place and _cached_in_place_meta(pubchem_input_path, pubchem_url) is None:
+        return _meta_payload(
+            source_path=pubchem_input_path,
+            materialized_path=pubchem_input_path,
+            pubchem_total=None,
+            source_url=pubchem_url,
+        )
+    if pubchem_input_path.suffix == ".gz" and input_mode == "indexed-gzip":
+        return _index_gzip(pubchem_input_path, pubchem_url)
     if pubchem_input_path.suffix == ".gz":
         return _materialize_gzip(pubchem_input_path, materialized_input_path, pubchem_url)
     return _count_plain_input(pubchem_input_path, pubchem_url)
@@ -190,7 +458,7 @@ def _meta_payload(
     *,
     source_path: Path,
     materialized_path: Path,
-    pubchem_total: int,
+    pubchem_total: Optional[int],
     source_url: str,
 ) -> SourceInfo:
     return {
@@ -207,6 +475,116 @@ def _meta_path(materialized_path: Path) -> Path:
     return materialized_path.with_suffix(materialized_path.suffix + ".meta.json")
 
 
+def row_index_path(input_path: Path) -> Path:
+    return input_path.with_suffix(input_path.suffix + ".rows.idx")
+
+
+def load_row_index(input_path: Path) -> RowOffsetIndex:
+    """Load the row offset index written when ``input_path`` was counted."""
+    return RowOffsetIndex.load(row_index_path(input_path))
+
+
+def _ensure_row_index(input_path: Path) -> None:
+    # Inputs counted before the row index existed get one from a plain read.
+    if row_index_path(input_path).exists():
+        return
+    counter = PubchemRowCounter()
+    print("indexing rows of {0}".format(input_path))
+    with open_pubchem_input(input_path) as handle:
+        for block in iter(lambda: handle.read(COPY_BLOCK_BYTES), b""):
+            counter.update(block)
+    counter.row_index().save(row_index_path(input_path))
+
+
+def gzip_index_path(source_path: Path) -> Path:
+    return source_path.with_suffix(source_path.suffix + ".gzidx")
+
+
+def _import_indexed_gzip():
+    try:
+        import indexed_gzip
+    except ImportError as error:
+        raise ImportError(
+            "input mode 'indexed-gzip' needs the indexed_gzip package; "
+            "pip install indexed_gzip or use --input-mode materialized"
+        ) from error
+    return indexed_gzip
+
+
+def open_pubchem_input(path: Path) -> BinaryIO:
+    """Open the input the pipeline reads; ``.gz`` sources seek through their index.
+
+    Offsets are positions in the uncompressed stream either way, so a resume
+    offset means the same row whether it was recorded against the
+    materialized copy or the indexed gzip.
+    """
+    if path.suffix != ".gz":
+        return path.open("rb")
+    indexed_gzip = _import_indexed_gzip()
+    handle = indexed_gzip.IndexedGzipFile(str(path), spacing=GZIP_INDEX_SPACING)
+    index_path = gzip_index_path(path)
+    if not index_path.exists():
+        # A deferred count is still building the index; seeks inflate from the start.
+        return cast(BinaryIO, handle)
+    try:
+        handle.import_index(str(index_path))
+    except BaseException:
+        handle.close()
+        raise
+    return cast(BinaryIO, handle)
+
+
+def _cached_in_place_meta(source_path: Path, source_url: str) -> Optional[SourceInfo]:
+    # Metadata for an input read where it is: plain text, or a gzip with its seek index.
+    meta_path = _meta_path(source_path)
+    if not meta_path.exists():
+        return None
+    if source_path.suffix == ".gz" and not gzip_index_path(source_path).exists():
+        return None
+    existing = cast(SourceInfo, json.loads(meta_path.read_text()))
+    if (
+        existing.get("source_path") == str(source_path)
+        and existing.get("materialized_path") == str(source_path)
+        and existing.get("source_url") == source_url
+        and existing.get("source_bytes") == source_path.stat().st_size
+        and existing.get("source_mtime_ns") == source_path.stat().st_mtime_ns
+    ):
+        return existing
+    return None
+
+
+def _index_gzip(source_path: Path, source_url: str) -> SourceInfo:
+    meta_path = _meta_path(source_path)
+    index_path = gzip_index_path(source_path)
+    existing = _cached_in_place_meta(source_path, source_url)
+    if existing is not None:
+        _ensure_row_index(source_path)
+        return existing
+
+    indexed_gzip = _import_indexed_gzip()
+    tmp_path = index_path.with_suffix(index_path.suffix + ".tmp")
+    counter = PubchemRowCounter()
+    print("indexing {0} -> {1}".format(source_path, index_path))
+    # Reading front to back adds an inflate checkpoint every GZIP_INDEX_SPACING
+    # bytes, so the counting pass also builds the complete index.
+    with indexed_gzip.IndexedGzipFile(str(source_path), spacing=GZIP_INDEX_SPACING) as compressed:
+        for block in iter(lambda: compressed.read(COPY_BLOCK_BYTES), b""):
+            counter.update(block)
+        compressed.export_index(str(tmp_path))
+    pubchem_total = counter.finish()
+
+    tmp_path.replace(index_path)
+    counter.row_index().save(row_index_path(source_path))
+    payload = _meta_payload(
+        source_path=source_path,
+        materialized_path=source_path,
+        pubchem_total=pubchem_total,
+        source_url=source_url,
+    )
+    meta_path.write_text(json.dumps(payload, indent=2, sort_keys=True) + "\n")
+    return payload
+
+
 def _materialize_gzip(
     source_path: Path, materialized_path: Path, source_url: str
 ) -> SourceInfo:
@@ -227,20 +605,21 @@ def _materialize_gzip(
             and existing.get("source_bytes") == expected_meta["source_bytes"]
             and existing.get("source_mtime_ns") == expected_meta["source_mtime_ns"]
         ):
+            _ensure_row_index(materialized_path)
             return existing
 
     materialized_path.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = materialized_path.with_suffix(materialized_path.suffix + ".tmp")
-    pubchem_total = 0
+    counter = PubchemRowCounter()
     print("materializing {0} -> {1}".format(source_path, materialized_path))
     with gzip.open(source_path, "rb") as compressed, tmp_path.open("wb") as plain:
-        for raw_line in compressed:
-            line = raw_line.decode("utf-8")
-            if _parse_pubchem_line(line) is not None:
-                pubchem_total += 1
-            plain.write(raw_line)
+        for block in iter(lambda: compressed.read(COPY_BLOCK_BYTES), b""):
+            counter.update(block)
+            plain.write(block)
+    pubchem_total = counter.finish()
 
     tmp_path.replace(materialized_path)
+    counter.row_index().save(row_index_path(materialized_path))
     payload = _meta_payload(
         source_path=source_path,
         materialized_path=materialized_path,
@@ -253,23 +632,18 @@ def _materialize_gzip(
 
 def _count_plain_input(source_path: Path, source_url: str) -> SourceInfo:
     meta_path = _meta_path(source_path)
-    if meta_path.exists():
-        existing = cast(SourceInfo, json.loads(meta_path.read_text()))
-        if (
-            existing.get("source_path") == str(source_path)
-            and existing.get("materialized_path") == str(source_path)
-            and existing.get("source_url") == source_url
-            and existing.get("source_bytes") == source_path.stat().st_size
-            and existing.get("source_mtime_ns") == source_path.stat().st_mtime_ns
-        ):
-            return existing
+    existing = _cached_in_place_meta(source_path, source_url)
+    if existing is not None:
+        _ensure_row_index(source_path)
+        return existing
 
-    pubchem_total = 0
+    counter = PubchemRowCounter()
     print("counting rows in {0}".format(source_path))
-    with source_path.open("r", encoding="utf-8") as handle:
-        for line in handle:
-            if _parse_pubchem_line(line) is not None:
-                pubchem_total += 1
+    with source_path.open("rb") as handle:
+        for block in iter(lambda: handle.read(COPY_BLOCK_BYTES), b""):
+            counter.update(block)
+    pubchem_total = counter.finish()
+    counter.row_index().save(row_index_path(source_path))
 
     payload = _meta_payload(
         source_path=source_path,
@@ -0,0 +1,63 @@
+"""Single-parse equivalents of the recovered RDKit helpers."""
+
+from __future__ import annotations
+
+from typing import Any, Tuple
+
+import numpy as np
+
+from npc_labeler.original.fingerprint_handler import Chem, rdMolDescriptors
+
+FINGERPRINT_BITS = 2048
+FINGERPRINT_RADIUS = 2
+FINGERPRINT_WIDTH = FINGERPRINT_BITS * (FINGERPRINT_RADIUS + 1)
+
+# Same SMARTS as fingerprint_handler._isglycoside, compiled once per process
+# instead of once per row.
+_SUGAR_PATTERNS = [
+    Chem.MolFromSmarts(
+        "[OX2;$([r5]1@C(!@[OX2,NX3,SX2,FX1,ClX1,BrX1,IX1])@C@C@C1),"
+        "$([r6]1@C(!@[OX2,NX3,SX2,FX1,ClX1,BrX1,IX1])@C@C@C@C1)]"
+    ),
+    Chem.MolFromSmarts(
+        "[OX2;$([r5]1@C(!@[OX2,NX3,SX2,FX1,ClX1,BrX1,IX1])@C@C(O)@C1),"
+        "$([r6]1@C(!@[OX2,NX3,SX2,FX1,ClX1,BrX1,IX1])@C@C(O)@C(O)@C1)]"
+    ),
+    Chem.MolFromSmarts(
+        "[OX2;$([r5]1@C(!@[OX2H1])@C@C@C1),$([r6]1@C(!@[OX2H1])@C@C@C@C1)]"
+    ),
+]
+
+
+def parse_smiles(smiles: str):
+    return Chem.MolFromSmiles(smiles)
+
+
+def is_glycoside(molecule) -> bool:
+    return any(molecule.HasSubstructMatch(pattern) for pattern in _SUGAR_PATTERNS)
+
+
+def morgan_count_pairs(molecule) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the non-zero ``(column, count)`` pairs of a molecule's input row.
+
+    Column ``radius * 2048 + bit`` holds the number of radius-``radius``
+    environments hashed to ``bit``, which is ``fp1`` followed by ``fp2`` in the
+    layout of ``fingerprint_handler.calculate_fingerprint``. One radius-2
+    ``bitInfo`` already lists the radius-0 and radius-1 environments, so the
+    legacy per-radius calls are not needed.
+    """
+    bit_info: Any = {}
+    rdMolDescriptors.GetMorganFingerprintAsBitVect(
+        Chem.AddHs(molecule),
+        radius=FINGERPRINT_RADIUS,
+        bitInfo=bit_info,
+        nBits=FINGERPRINT_BITS,
+    )
+    columns = [
+        env_radius * FINGERPRINT_BITS + bit
+        for bit, environments in bit_info.items()
+        for _atom, env_radius in environments
+    ]
+    indices, counts = np.unique(np.asarray(columns, dtype=np.uint16), return_counts=True)
+    return indices, counts.astype(np.uint16)
+
@@ -0,0 +1,552 @@
+from __future__ import annotations
+
+import json
+import warnings
+import zipfile
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, cast
+
+import h5py
+import numpy as np
+
+from npc_labeler.output import sha256_file
+
+LayerList = List[Tuple[str, str, Dict[str, object]]]
+
+INFERENCE_MODES = ("dense", "sparse")
+INFERENCE_PRECISIONS = ("float32", "float16", "int8")
+PLAN_VERSION = 1
+PLAN_CACHE_SUFFIX = ".plan.npz"
+
+
+def _load_model(path: Path) -> LayerList:
+    with h5py.File(path, "r") as handle:
+        config = json.loads(handle.attrs["model_config"])
+        weights_root = handle["model_weights"]
+        layers: LayerList = []
+
+        for layer_config in config["config"]["layers"]:
+            layer_type = layer_config["class_name"]
+            name = layer_config["name"]
+            if layer_type == "InputLayer":
+                continue
+            if layer_type == "Concatenate":
+                layers.append(("concat", name, {}))
+                continue
+            if layer_type == "Dropout":
+                layers.append(("dropout", name, {}))
+                continue
+            if layer_type == "Dense":
+                group = weights_root[name][name]
+                layers.append(
+                    (
+                        "dense",
+                        name,
+                        {
+                            "kernel": group["kernel:0"][()].astype(np.float32),
+                            "bias": group["bias:0"][()].astype(np.float32),
+                            "activation": layer_config["config"]["activation"],
+                        },
+                    )
+                )
+                continue
+            if layer_type == "BatchNormalization":
+                group = weights_root[name][name]
+                layers.append(
+                    (
+                        "batch_norm",
+                        name,
+                        {
+                            "gamma": group["gamma:0"][()].astype(np.float32),
+                            "beta": group["beta:0"][()].astype(np.float32),
+                            "mean": group["moving_mean:0"][()].astype(np.float32),
+                            "variance": group["moving_variance:0"][()].astype(np.float32),
+                            "epsilon": float(layer_config["config"].get("epsilon", 1e-3)),
+                        },
+                    )
+                )
+                continue
+            raise RuntimeError("unexpected layer type {0!r} in {1}".format(layer_type, path.name))
+
+    return layers
+
+
+def _sigmoid(values: np.ndarray) -> np.ndarray:
+    output = np.empty_like(values)
+    positives = values >= 0
+    output[positives] = 1.0 / (1.0 + np.exp(-values[positives]))
+    negatives = np.exp(values[~positives])
+    output[~positives] = negatives / (1.0 + negatives)
+    return output
+
+
+def _activate(values: np.ndarray, activation: str) -> np.ndarray:
+    if activation == "relu":
+        return np.maximum(values, 0.0)
+    if activation == "sigmoid":
+        return _sigmoid(values)
+    if activation != "linear":
+        raise RuntimeError("unsupported activation {0!r}".format(activation))
+    return values
+
+
+def _forward(layers: LayerList, inputs: np.ndarray) -> np.ndarray:
+    values = inputs
+    for op, _name, params in layers:
+        if op == "concat":
+            continue
+        if op == "dense":
+            kernel = cast(np.ndarray, params["kernel"])
+            bias = cast(np.ndarray, params["bias"])
+            activation = cast(str, params["activation"])
+            values = _activate(values @ kernel + bias, activation)
+            continue
+        if op == "batch_norm":
+            gamma = cast(np.ndarray, params["gamma"])
+            mean = cast(np.ndarray, params["mean"])
+            variance = cast(np.ndarray, params["variance"])
+            beta = cast(np.ndarray, params["beta"])
+            epsilon = cast(float, params["epsilon"])
+            values = (
+                gamma
+                * (values - mean)
+                / np.sqrt(variance + epsilon)
+                + beta
+            )
+            continue
+        if op == "dropout":
+            continue
+        raise RuntimeError("unexpected op {0!r}".format(op))
+    return values
+
+
+@dataclass
+class FingerprintBatch:
+    """CSR view of the prepared fingerprints of one inference slice."""
+
+    indptr: np.ndarray
+    indices: np.ndarray
+    counts: np.ndarray
+
+    @property
+    def rows(self) -> int:
+        return len(self.indptr) - 1
+
+    def dense(self, width: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if out is None:
+            inputs = np.zeros((self.rows, width), dtype=np.float32)
+        else:
+            inputs = out
+            inputs.fill(0.0)
+        rows = np.repeat(np.arange(self.rows), np.diff(self.indptr))
+        inputs[rows, self.indices] = self.counts
+        return inputs
+
+
+def _sparse_matmul(batch: FingerprintBatch, kernel: np.ndarray) -> np.ndarray:
+    output = np.empty((batch.rows, kernel.shape[1]), dtype=np.float32)
+    indptr = batch.indptr.tolist()
+    for row in range(batch.rows):
+        start, stop = indptr[row], indptr[row + 1]
+        np.dot(
+            batch.counts[start:stop],
+            kernel[batch.indices[start:stop]].astype(np.float32, copy=False),
+            out=output[row],
+        )
+    return output
+
+
+@dataclass
+class PlanStep:
+    # "dense" steps hold a (inputs, outputs) kernel; "affine" steps hold a
+    # per-feature scale for a BatchNorm that could not be folded away.
+    op: str
+    weight: np.ndarray
+    bias: np.ndarray
+    activation: str
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        if self.op == "dense":
+            return _activate(values @ self.weight + self.bias, self.activation)
+        return values * self.weight + self.bias
+
+
+@dataclass
+class ModelPlan:
+    """Flat inference plan with BatchNorm folded into the Dense weights."""
+
+    steps: List[PlanStep]
+
+    @property
+    def input_width(self) -> int:
+        return int(self.steps[0].weight.shape[0])
+
+    def forward(self, inputs: np.ndarray) -> np.ndarray:
+        values = inputs
+        for step in self.steps:
+            values = step.apply(values)
+        return values
+
+    def forward_sparse(self, batch: FingerprintBatch) -> np.ndarray:
+        # Only the first Dense layer sees the sparse fingerprints; it becomes
+        # a gather-and-accumulate over the kernel rows of the non-zero columns.
+        first = self.steps[0]
+        values = _activate(_sparse_matmul(batch, first.weight) + first.bias, first.activation)
+        for step in self.steps[1:]:
+            values = step.apply(values)
+        return values
+
+    def save(self, path: Path, *, source_sha256: str) -> None:
+        meta = {
+            "plan_version": PLAN_VERSION,
+            "source_sha256": source_sha256,
+            "steps": [{"op": step.op, "activation": step.activation} for step in self.steps],
+        }
+        arrays: Dict[str, np.ndarray] = {"meta": np.array(json.dumps(meta, sort_keys=True))}
+        for index, step in enumerate(self.steps):
+            arrays["weight_{0}".format(index)] = step.weight
+            arrays["bias_{0}".format(index)] = step.bias
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as handle:
+            np.savez(handle, **arrays)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path, *, source_sha256: str) -> Optional["ModelPlan"]:
+        with np.load(path, allow_pickle=False) as payload:
+            meta = json.loads(str(payload["meta"]))
+            if (
+                meta.get("plan_version") != PLAN_VERSION
+                or meta.get("source_sha256") != source_sha256
+            ):
+                return None
+            steps = [
+                PlanStep(
+                    op=step["op"],
+                    weight=np.ascontiguousarray(payload["weight_{0}".format(index)]),
+                    bias=np.ascontiguousarray(payload["bias_{0}".format(index)]),
+                    activation=step["activation"],
+                )
+                for index, step in enumerate(meta["steps"])
+            ]
+        return cls(steps=steps)
+
+
+@dataclass
+class FusedPlan:
+    """Several model plans sharing one input and one stacked first-layer GEMM."""
+
+    kernel: np.ndarray
+    bias: np.ndarray
+    boundaries: List[int]
+    activations: List[str]
+    tails: List[List[PlanStep]]
+    # Per-column dequantization scale when ``kernel`` holds int8 weights.
+    kernel_scale: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_plans(cls, plans: Sequence[ModelPlan]) -> "FusedPlan":
+        input_widths = {plan.input_width for plan in plans}
+        if len(input_widths) != 1:
+            raise RuntimeError("fused models disagree on input width: {0}".format(sorted(input_widths)))
+        firsts = [plan.steps[0] for plan in plans]
+        boundaries = [0]
+        for first in firsts:
+            boundaries.append(boundaries[-1] + first.weight.shape[1])
+        return cls(
+            kernel=np.ascontiguousarray(np.hstack([first.weight for first in firsts])),
+            bias=np.concatenate([first.bias for first in firsts]),
+            boundaries=boundaries,
+            activations=[first.activation for first in firsts],
+            tails=[plan.steps[1:] for plan in plans],
+        )
+
+    @property
+    def input_width(self) -> int:
+        return int(self.kernel.shape[0])
+
+    @property
+    def precision(self) -> str:
+        if self.kernel.dtype == np.int8:
+            return "int8"
+        return str(self.kernel.dtype)
+
+    def with_precision(self, precision: str) -> "FusedPlan":
+        """Return a copy whose first-layer kernel is stored in ``precision``.
+
+        Only the stacked kernel is narrowed; it is widened back to float32 row
+        by row as the sparse path gathers it, so activations stay float32.
+        """
+        if precision not in INFERENCE_PRECISIONS:
+            raise ValueError("unsupported inference precision {0!r}".format(precision))
+        if precision == self.precision:
+            return self
+        if self.precision != "float32":
+            raise ValueError("can only narrow a float32 plan, not {0}".format(self.precision))
+        if precision == "float16":
+            return replace(self, kernel=self.kernel.astype(np.float16))
+        peak = np.abs(self.kernel).max(axis=0)
+        scale = np.where(peak > 0.0, peak / 127.0, 1.0).astype(np.float32)
+        quantized = np.clip(np.rint(self.kernel / scale), -127, 127).astype(np.int8)
+        return replace(self, kernel=quantized, kernel_scale=scale)
+
+    def forward(self, inputs: np.ndarray) -> List[np.ndarray]:
+        if self.precision != "float32":
+            raise RuntimeError("dense inference needs float32 weights, not {0}".format(self.precision))
+        return self._heads(inputs @ self.kernel + self.bias)
+
+    def forward_sparse(self, batch: FingerprintBatch) -> List[np.ndarray]:
+        hidden = _sparse_matmul(batch, self.kernel)
+        if self.kernel_scale is not None:
+            hidden *= self.kernel_scale
+        return self._heads(hidden + self.bias)
+
+    def _heads(self, hidden: np.ndarray) -> List[np.ndarray]:
+        outputs = []
+        for index, tail in enumerate(self.tails):
+            start, stop = self.boundaries[index], self.boundaries[index + 1]
+            values = _activate(hidden[:, start:stop], self.activations[index])
+            for step in tail:
+                values = step.apply(values)
+            outputs.append(values)
+        return outputs
+
+
+def _sigmoid_inplace(
+    values: np.ndarray, exp_buffer: np.ndarray, denominator: np.ndarray, mask: np.ndarray
+) -> None:
+    # Same arithmetic as _sigmoid, written into preallocated buffers.
+    np.greater_equal(values, 0.0, out=mask)
+    np.abs(values, out=exp_buffer)
+    np.negative(exp_buffer, out=exp_buffer)
+    np.exp(exp_buffer, out=exp_buffer)
+    np.add(exp_buffer, 1.0, out=denominator)
+    np.divide(exp_buffer, denominator, out=values)
+    np.divide(1.0, denominator, out=denominator)
+    np.copyto(values, denominator, where=mask)
+
+
+class ForwardWorkspace:
+    """Preallocated buffers for running a FusedPlan on up to ``rows`` rows.
+
+    The returned head outputs are views into the workspace and stay valid only
+    until the next call to ``run``.
+    """
+
+    def __init__(self, plan: FusedPlan, rows: int) -> None:
+        self.plan = plan
+        self.rows = rows
+        # Only the dense path needs the densified inputs; allocated on first use.
+        self.inputs: Optional[np.ndarray] = None
+        self.hidden = np.empty((rows, plan.kernel.shape[1]), dtype=np.float32)
+        self.head_buffers: List[List[np.ndarray]] = []
+        widest = plan.kernel.shape[1]
+        for index, tail in enumerate(plan.tails):
+            width = plan.boundaries[index + 1] - plan.boundaries[index]
+            buffers = []
+            for step in tail:
+                if step.op == "dense":
+                    width = step.weight.shape[1]
+                buffers.append(np.empty((rows, width), dtype=np.float32))
+                widest = max(widest, width)
+            self.head_buffers.append(buffers)
+        self.exp_buffer = np.empty((rows, widest), dtype=np.float32)
+        self.denominator = np.empty((rows, widest), dtype=np.float32)
+        self.mask = np.empty((rows, widest), dtype=np.bool_)
+        self.gather = np.empty((256, plan.kernel.shape[1]), dtype=np.float32)
+        # Narrow kernels are gathered as stored, then widened into ``gather``.
+        self.narrow_gather = (
+            None
+            if plan.precision == "float32"
+            else np.empty((256, plan.kernel.shape[1]), dtype=plan.kernel.dtype)
+        )
+
+    def run(self, batch: FingerprintBatch, *, sparse: bool) -> List[np.ndarray]:
+        rows = batch.rows
+        if rows > self.rows:
+            raise ValueError("batch of {0} rows exceeds workspace of {1}".format(rows, self.rows))
+        hidden = self.hidden[:rows]
+        if sparse:
+            self._sparse_matmul(batch, hidden)
+            if self.plan.kernel_scale is not None:
+                np.multiply(hidden, self.plan.kernel_scale, out=hidden)
+        else:
+            if self.plan.precision != "float32":
+                raise RuntimeError(
+                    "dense inference needs float32 weights, not {0}".format(self.plan.precision)
+                )
+            if self.inputs is None:
+                self.inputs = np.empty((self.rows, self.plan.input_width), dtype=np.float32)
+            inputs = batch.dense(self.plan.input_width, out=self.inputs[:rows])
+            np.matmul(inputs, self.plan.kernel, out=hidden)
+        np.add(hidden, self.plan.bias, out=hidden)
+
+        outputs = []
+        for index, tail in enumerate(self.plan.tails):
+            values = hidden[:, self.plan.boundaries[index] : self.plan.boundaries[index + 1]]
+            self._activate(values, self.plan.activations[index])
+            for step, buffer in zip(tail, self.head_buffers[index]):
+                output = buffer[:rows]
+                if step.op == "dense":
+                    np.matmul(values, step.weight, out=output)
+                    np.add(output, step.bias, out=output)
+                    self._activate(output, step.activation)
+                else:
+                    np.multiply(values, step.weight, out=output)
+                    np.add(output, step.bias, out=output)
+                values = output
+            outputs.append(values)
+        return outputs
+
+    def _sparse_matmul(self, batch: FingerprintBatch, output: np.ndarray) -> None:
+        indptr = batch.indptr.tolist()
+        for row in range(batch.rows):
+            start, stop = indptr[row], indptr[row + 1]
+            if stop - start > self.gather.shape[0]:
+                self.gather = np.empty((stop - start, self.gather.shape[1]), dtype=np.float32)
+                if self.narrow_gather is not None:
+                    self.narrow_gather = np.empty(
+                        (stop - start, self.gather.shape[1]), dtype=self.plan.kernel.dtype
+                    )
+            gathered = self.gather[: stop - start]
+            # mode="clip" lets np.take write into ``out`` without buffering.
+            if self.narrow_gather is None:
+                np.take(
+                    self.plan.kernel, batch.indices[start:stop], axis=0, out=gathered, mode="clip"
+                )
+            else:
+                narrow = self.narrow_gather[: stop - start]
+                np.take(
+                    self.plan.kernel, batch.indices[start:stop], axis=0, out=narrow, mode="clip"
+                )
+                np.copyto(gathered, narrow)
+            np.dot(batch.counts[start:stop], gathered, out=output[row])
+
+    def _activate(self, values: np.ndarray, activation: str) -> None:
+        if activation == "relu":
+            np.maximum(values, 0.0, out=values)
+        elif activation == "sigmoid":
+            rows, columns = values.shape
+            _sigmoid_inplace(
+                values,
+                self.exp_buffer[:rows, :columns],
+                self.denominator[:rows, :columns],
+                self.mask[:rows, :columns],
+            )
+        elif activation != "linear":
+            raise RuntimeError("unsupported activation {0!r}".format(activation))
+
+
+def _batch_norm_affine(params: Dict[str, object]) -> Tuple[np.ndarray, np.ndarray]:
+    gamma = cast(np.ndarray, params["gamma"]).astype(np.float64)
+    beta = cast(np.ndarray, params["beta"]).astype(np.float64)
+    mean = cast(np.ndarray, params["mean"]).astype(np.float64)
+    variance = cast(np.ndarray, params["variance"]).astype(np.float64)
+    scale = gamma / np.sqrt(variance + cast(float, params["epsilon"]))
+    return scale, beta - mean * scale
+
+
+def compile_layers(layers: LayerList) -> ModelPlan:
+    """Fold inference-mode BatchNorm into neighbouring Dense layers.
+
+    A BatchNorm directly after a linear Dense is folded into that layer's
+    output columns; otherwise (e.g. after a ReLU) it is folded into the input
+    rows of the next Dense. Concatenate and Dropout are no-ops at inference.
+    """
+    steps: List[PlanStep] = []
+    pending: Optional[Tuple[np.ndarray, np.ndarray]] = None
+    previous_op: Optional[str] = None
+    for op, _name, params in layers:
+        if op in ("concat", "dropout"):
+            continue
+        if op == "batch_norm":
+            scale, shift = _batch_norm_affine(params)
+            last = steps[-1] if steps else None
+            if (
+                pending is None
+                and previous_op == "dense"
+                and last is not None
+                and last.activation == "linear"
+            ):
+                last.weight = (last.weight.astype(np.float64) * scale).astype(np.float32)
+                last.bias = (last.bias.astype(np.float64) * scale + shift).astype(np.float32)
+            elif pending is None:
+                pending = (scale, shift)
+            else:
+                pending = (pending[0] * scale, pending[1] * scale + shift)
+            previous_op = op
+            continue
+        if op == "dense":
+            kernel = cast(np.ndarray, params["kernel"])
+            bias = cast(np.ndarray, params["bias"])
+            if pending is not None:
+                kernel64 = kernel.astype(np.float64)
+                bias = (bias.astype(np.float64) + pending[1] @ kernel64).astype(np.float32)
+                kernel = (pending[0][:, None] * kernel64).astype(np.float32)
+                pending = None
+            steps.append(
+                PlanStep(
+                    op="dense",
+                    weight=np.ascontiguousarray(kernel, dtype=np.float32),
+                    bias=np.ascontiguousarray(bias, dtype=np.float32),
+                    activation=cast(str, params["activation"]),
+                )
+            )
+            previous_op = op
+            continue
+        raise RuntimeError("unexpected op {0!r}".format(op))
+
+    if pending is not None:
+        steps.append(
+            PlanStep(
+                op="affine",
+                weight=pending[0].astype(np.float32),
+                bias=pending[1].astype(np.float32),
+                activation="linear",
+            )
+        )
+    if not steps or steps[0].op != "dense":
+        raise RuntimeError("model plan must start with a Dense layer")
+    return ModelPlan(steps=steps)
+
+
+def plan_cache_path(weights_path: Path) -> Path:
+    return weights_path.with_name(weights_path.stem + PLAN_CACHE_SUFFIX)
+
+
+def load_model_plan(
+    weights_path: Path,
+    *,
+    source_sha256: Optional[str] = None,
+    log: Optional[Callable[[str], None]] = None,
+) -> ModelPlan:
+    """Load the folded plan for ``weights_path``, compiling and caching it if needed.
+
+    ``source_sha256`` is the digest of the weights file when the caller has
+    already verified it; otherwise the file is hashed here. The cache is only
+    an optimisation: a damaged cache file is recompiled, and a cache that
+    cannot be written is reported through ``log`` (a RuntimeWarning when not
+    given) while the compiled plan is still returned.
+    """
+    if source_sha256 is None:
+        source_sha256 = sha256_file(weights_path)
+    cache_path = plan_cache_path(weights_path)
+    if cache_path.exists():
+        try:
+            plan = ModelPlan.load(cache_path, source_sha256=source_sha256)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            plan = None
+        if plan is not None:
+            return plan
+
+    plan = compile_layers(_load_model(weights_path))
+    try:
+        plan.save(cache_path, source_sha256=source_sha256)
+    except OSError as error:
+        message = "could not cache model plan {0}: {1}".format(cache_path, error)
+        if log is None:
+            warnings.warn(message, RuntimeWarning, stacklevel=2)
+        else:
+            log(message)
+    return plan
@@ -1,16 +1,45 @@
 from __future__ import annotations
 
 import json
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
 
-import h5py
 import numpy as np
 
-from npc_labeler.original import fingerprint_handler, prediction_voting
+from npc_labeler import fingerprints
+from npc_labeler.inference import (
+    INFERENCE_MODES,
+    INFERENCE_PRECISIONS,
+    FingerprintBatch,
+    ForwardWorkspace,
+    FusedPlan,
+    LayerList,
+    ModelPlan,
+    compile_layers,
+    load_model_plan,
+)
+from npc_labeler.original import fingerprint_handler
+from npc_labeler.results import ClassificationBatchBuilder
+from npc_labeler.voting import (
+    DEFAULT_VOTE_CACHE_SIZE,
+    BatchVoter,
+    VotedIds,
+    VoteOutcome,
+)
 
-THRESHOLDS = {"SUPERCLASS": 0.3, "CLASS": 0.1, "PATHWAY": 0.5}
 MODEL_FILES = {
     "PATHWAY": "NP_classifier_pathway_V1.hdf5",
     "SUPERCLASS": "NP_classifier_superclass_V1.hdf5",
@@ -30,127 +59,103 @@ class ClassificationRuntimeError(RuntimeError):
     """Raised when the local classifier stack fails for non-RDKit reasons."""
 
 
+class PrecisionParityError(RuntimeError):
+    """Raised when reduced-precision weights change the voted labels of a sample."""
+
+
 @dataclass
 class PreparedRecord:
+    # Fingerprints are kept as sparse (column, count) pairs over the
+    # concatenated fp1/fp2 input and only expanded per inference slice.
+    __slots__ = ("cid", "smiles", "is_glycoside", "fingerprint_indices", "fingerprint_counts")
+
     cid: int
     smiles: str
     is_glycoside: bool
-    fp1: np.ndarray
-    fp2: np.ndarray
+    fingerprint_indices: np.ndarray
+    fingerprint_counts: np.ndarray
 
 
 def _ontology_path() -> Path:
     return Path(__file__).resolve().parent / "original" / "dict" / "index_v1.json"
 
 
-def _load_model(path: Path) -> List[Tuple[str, str, Dict[str, object]]]:
-    with h5py.File(path, "r") as handle:
-        config = json.loads(handle.attrs["model_config"])
-        weights_root = handle["model_weights"]
-        layers: List[Tuple[str, str, Dict[str, object]]] = []
-
-        for layer_config in config["config"]["layers"]:
-            layer_type = layer_config["class_name"]
-            name = layer_config["name"]
-            if layer_type == "InputLayer":
-                continue
-            if layer_type == "Concatenate":
-                layers.append(("concat", name, {}))
-                continue
-            if layer_type == "Dropout":
-                layers.append(("dropout", name, {}))
-                continue
-            if layer_type == "Dense":
-                group = weights_root[name][name]
-                layers.append(
-                    (
-                        "dense",
-                        name,
-                        {
-                            "kernel": group["kernel:0"][()].astype(np.float32),
-                            "bias": group["bias:0"][()].astype(np.float32),
-                            "activation": layer_config["config"]["activation"],
-                        },
-                    )
-                )
-                continue
-            if layer_type == "BatchNormalization":
-                group = weights_root[name][name]
-                layers.append(
-                    (
-                        "batch_norm",
-                        name,
-                        {
-                            "gamma": group["gamma:0"][()].astype(np.float32),
-                            "beta": group["beta:0"][()].astype(np.float32),
-                            "mean": group["moving_mean:0"][()].astype(np.float32),
-                            "variance": group["moving_variance:0"][()].astype(np.float32),
-                            "epsilon": float(layer_config["config"].get("epsilon", 1e-3)),
-                        },
-                    )
-                )
-                continue
-            raise RuntimeError("unexpected layer type {0!r} in {1}".format(layer_type, path.name))
-
-    return layers
-
-
-def _sigmoid(values: np.ndarray) -> np.ndarray:
-    output = np.empty_like(values)
-    positives = values >= 0
-    output[positives] = 1.0 / (1.0 + np.exp(-values[positives]))
-    negatives = np.exp(values[~positives])
-    output[~positives] = negatives / (1.0 + negatives)
-    return output
-
-
-def _forward(
-    layers: List[Tuple[str, str, Dict[str, object]]],
-    fp1: np.ndarray,
-    fp2: np.ndarray,
-) -> np.ndarray:
-    values = np.concatenate([fp1, fp2], axis=-1).astype(np.float32, copy=False)
-    for op, _name, params in layers:
-        if op == "concat":
-            continue
-        if op == "dense":
-            kernel = cast(np.ndarray, params["kernel"])
-            bias = cast(np.ndarray, params["bias"])
-            activation = cast(str, params["activation"])
-            values = values @ kernel + bias
-            if activation == "relu":
-                values = np.maximum(values, 0.0)
-            elif activation == "sigmoid":
-                values = _sigmoid(values)
-            elif activation != "linear":
-                raise RuntimeError("unsupported activation {0!r}".format(activation))
-            continue
-        if op == "batch_norm":
-            gamma = cast(np.ndarray, params["gamma"])
-            mean = cast(np.ndarray, params["mean"])
-            variance = cast(np.ndarray, params["variance"])
-            beta = cast(np.ndarray, params["beta"])
-            epsilon = cast(float, params["epsilon"])
-            values = (
-                gamma
-                * (values - mean)
-                / np.sqrt(variance + epsilon)
-                + beta
-            )
-            continue
-        if op == "dropout":
-            continue
-        raise RuntimeError("unexpected op {0!r}".format(op))
-    return values
+def prepare_record(cid: int, smiles: str) -> PreparedRecord:
+    molecule = fingerprints.parse_smiles(smiles)
+    if molecule is None:
+        raise InvalidSmilesError("RDKit could not parse the SMILES string")
+
+    try:
+        try:
+            is_glycoside = fingerprints.is_glycoside(molecule)
+        except Exception as error:  # noqa: BLE001
+            # The legacy helper swallowed this and returned "Input_error".
+            raise RdkitPipelineError(
+                "legacy glycoside helper returned a non-boolean value"
+            ) from error
+        fingerprint_indices, fingerprint_counts = fingerprints.morgan_count_pairs(molecule)
+    except RdkitPipelineError:
+        raise
+    except Exception as error:  # noqa: BLE001
+        raise RdkitPipelineError(str(error)) from error
+
+    return PreparedRecord(
+        cid=cid,
+        smiles=smiles,
+        is_glycoside=is_glycoside,
+        fingerprint_indices=fingerprint_indices,
+        fingerprint_counts=fingerprint_counts,
+    )
+
+
+def _fingerprint_batch(prepared_records: List[PreparedRecord]) -> FingerprintBatch:
+    lengths = [len(record.fingerprint_indices) for record in prepared_records]
+    indptr = np.zeros((len(prepared_records) + 1,), dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return FingerprintBatch(
+        indptr=indptr,
+        indices=np.concatenate(
+            [record.fingerprint_indices for record in prepared_records]
+        ).astype(np.intp),
+        counts=np.concatenate(
+            [record.fingerprint_counts for record in prepared_records]
+        ).astype(np.float32),
+    )
 
 
 class NPClassifier:
     def __init__(
         self,
-        models: Dict[str, List[Tuple[str, str, Dict[str, object]]]],
+        models: Mapping[str, Union[ModelPlan, LayerList]],
         ontology: Optional[Dict[str, object]] = None,
+        inference_mode: str = "dense",
+        workspace_rows: Optional[int] = None,
+        inference_precision: str = "float32",
+        vote_cache_size: int = DEFAULT_VOTE_CACHE_SIZE,
     ) -> None:
-        self.models = models
+        if inference_mode not in INFERENCE_MODES:
+            raise ValueError("unsupported inference mode {0!r}".format(inference_mode))
+        if inference_precision not in INFERENCE_PRECISIONS:
+            raise ValueError("unsupported inference precision {0!r}".format(inference_precision))
+        if inference_precision != "float32" and inference_mode != "sparse":
+            raise ValueError(
+                "{0} weights need the sparse inference mode".format(inference_precision)
+            )
+        plans = {
+            model_name: model if isinstance(model, ModelPlan) else compile_layers(model)
+            for model_name, model in models.items()
+        }
+        # predict_batch returns the heads in this order.
+        reference = FusedPlan.from_plans(
+            [plans["SUPERCLASS"], plans["CLASS"], plans["PATHWAY"]]
+        )
+        self.engine = reference.with_precision(inference_precision)
+        # The float32 plan is only kept until check_precision_parity passes.
+        self._reference_engine: Optional[FusedPlan] = (
+            None if self.engine is reference else reference
+        )
+        self.inference_mode = inference_mode
+        self.inference_precision = inference_precision
         self.ontology = cast(
             Dict[str, Any],
             ontology if ontology is not None else json.loads(_ontology_path().read_text()),
@@ -158,8 +163,7 @@ class NPClassifier:
         self.pathway_to_id = cast(Dict[str, int], self.ontology["Pathway"])
         self.superclass_to_id = cast(Dict[str, int], self.ontology["Superclass"])
         self.class_to_id = cast(Dict[str, int], self.ontology["Class"])
-        self.super_hierarchy = cast(Dict[str, Dict[str, List[int]]], self.ontology["Super_hierarchy"])
-        self.class_hierarchy = cast(Dict[str, Dict[str, List[int]]], self.ontology["Class_hierarchy"])
+        self.voter = BatchVoter(self.ontology, cache_size=vote_cache_size)
         self.pathway_labels = self._ordered_labels(self.pathway_to_id)
         self.superclass_labels = self._ordered_labels(self.superclass_to_id)
         self.class_labels = self._ordered_labels(self.class_to_id)
@@ -168,16 +172,49 @@ class NPClassifier:
             "superclass_prediction_vector": len(self.superclass_to_id),
             "class_prediction_vector": len(self.class_to_id),
         }
+        self.input_width = self.engine.input_width
+        self.workspace_rows = workspace_rows
+        self._thread_state = threading.local()
         self.rdkit_version = getattr(
             getattr(fingerprint_handler, "rdkit", None), "__version__", "unknown"
         )
 
+    @property
+    def workspace(self) -> Optional[ForwardWorkspace]:
+        """The calling thread's buffers, so inference threads never share one."""
+        if not self.workspace_rows:
+            return None
+        workspace = getattr(self._thread_state, "workspace", None)
+        if workspace is None:
+            workspace = ForwardWorkspace(self.engine, self.workspace_rows)
+            self._thread_state.workspace = workspace
+        return workspace
+
     @classmethod
-    def from_weights_dir(cls, weights_dir: Path) -> "NPClassifier":
-        models = {}
+    def from_weights_dir(
+        cls,
+        weights_dir: Path,
+        inference_mode: str = "dense",
+        workspace_rows: Optional[int] = None,
+        inference_precision: str = "float32",
+        vote_cache_size: int = DEFAULT_VOTE_CACHE_SIZE,
+        weights_sha256: Optional[Mapping[str, str]] = None,
+        log: Optional[Callable[[str], None]] = None,
+    ) -> "NPClassifier":
+        # Digests already verified by ensure_model_weights, keyed by filename.
+        weights_sha256 = weights_sha256 or {}
+        plans = {}
         for model_name, filename in MODEL_FILES.items():
-            models[model_name] = _load_model(weights_dir / filename)
-        return cls(models=models)
+            plans[model_name] = load_model_plan(
+                weights_dir / filename, source_sha256=weights_sha256.get(filename), log=log
+            )
+        return cls(
+            models=plans,
+            inference_mode=inference_mode,
+            workspace_rows=workspace_rows,
+            inference_precision=inference_precision,
+            vote_cache_size=vote_cache_size,
+        )
 
     def vocabulary_payload(self) -> Dict[str, List[str]]:
         return {
@@ -197,29 +234,7 @@ class NPClassifier:
         return output
 
     def prepare_record(self, cid: int, smiles: str) -> PreparedRecord:
-        molecule = fingerprint_handler.Chem.MolFromSmiles(smiles)
-        if molecule is None:
-            raise InvalidSmilesError("RDKit could not parse the SMILES string")
-
-        try:
-            is_glycoside = fingerprint_handler._isglycoside(smiles)
-            if not isinstance(is_glycoside, bool):
-                raise RdkitPipelineError(
-                    "legacy glycoside helper returned a non-boolean value"
-                )
-            fp2048, fp4096 = fingerprint_handler.calculate_fingerprint(smiles, 2)
-        except RdkitPipelineError:
-            raise
-        except Exception as error:  # noqa: BLE001
-            raise RdkitPipelineError(str(error)) from error
-
-        return PreparedRecord(
-            cid=cid,
-            smiles=smiles,
-            is_glycoside=is_glycoside,
-            fp1=np.asarray(fp2048[0], dtype=np.float32),
-            fp2=np.asarray(fp4096[0], dtype=np.float32),
-        )
+        return prepare_record(cid=cid, smiles=smiles)
 
     def predict_batch(
         self, prepared_records: List[PreparedRecord]
@@ -232,25 +247,68 @@ class NPClassifier:
                 np.empty((0, vector_widths["pathway_prediction_vector"]), dtype=np.float32),
             )
 
-        fp1_batch = np.stack([record.fp1 for record in prepared_records], axis=0)
-        fp2_batch = np.stack([record.fp2 for record in prepared_records], axis=0)
-        return (
-            _forward(self.models["SUPERCLASS"], fp1_batch, fp2_batch),
-            _forward(self.models["CLASS"], fp1_batch, fp2_batch),
-            _forward(self.models["PATHWAY"], fp1_batch, fp2_batch),
-        )
-
-    def _pathways_from_superclasses(self, superclass_ids: List[int]) -> List[int]:
-        pathway_ids = set()
-        for label in superclass_ids:
-            pathway_ids.update(self.super_hierarchy[str(label)]["Pathway"])
-        return list(pathway_ids)
+        batch = _fingerprint_batch(prepared_records)
+        workspace = self.workspace
+        if workspace is not None and batch.rows <= workspace.rows:
+            # Views into the workspace: valid until this thread's next
+            # predict_batch call.
+            pred_super, pred_class, pred_path = workspace.run(
+                batch, sparse=self.inference_mode == "sparse"
+            )
+        elif self.inference_mode == "sparse":
+            pred_super, pred_class, pred_path = self.engine.forward_sparse(batch)
+        else:
+            pred_super, pred_class, pred_path = self.engine.forward(
+                batch.dense(self.input_width)
+            )
+        return pred_super, pred_class, pred_path
+
+    def check_precision_parity(self, prepared_records: List[PreparedRecord]) -> None:
+        """Refuse reduced-precision weights unless they vote exactly like float32.
+
+        Runs ``prepared_records`` through both plans and raises
+        PrecisionParityError if any voted pathway, superclass or class ids
+        differ. Once a non-empty sample has passed, the float32 plan is dropped.
+        """
+        reference = self._reference_engine
+        if reference is None or not prepared_records:
+            return
+
+        narrow_predictions = self.predict_batch(prepared_records)
+        narrow_ids = [
+            self._voted_ids(record, *(head[index] for head in narrow_predictions))
+            for index, record in enumerate(prepared_records)
+        ]
+        wide_predictions = reference.forward_sparse(_fingerprint_batch(prepared_records))
+        mismatched = [
+            record.cid
+            for index, record in enumerate(prepared_records)
+            if self._voted_ids(record, *(head[index] for head in wide_predictions))
+            != narrow_ids[index]
+        ]
+        if mismatched:
+            raise PrecisionParityError(
+                "{0} weights changed the voted labels of {1} of {2} sample rows "
+                "(first cid {3}); rerun with float32".format(
+                    self.inference_precision, len(mismatched), len(prepared_records), mismatched[0]
+                )
+            )
+        self._reference_engine = None
 
-    def _pathways_from_classes(self, class_ids: List[int]) -> List[int]:
-        pathway_ids = set()
-        for label in class_ids:
-            pathway_ids.update(self.class_hierarchy[str(label)]["Pathway"])
-        return list(pathway_ids)
+    def _voted_ids(
+        self,
+        prepared_record: PreparedRecord,
+        pred_super: np.ndarray,
+        pred_class: np.ndarray,
+        pred_path: np.ndarray,
+    ) -> Tuple[object, ...]:
+        try:
+            record = self.record_from_predictions(
+                prepared_record, pred_super, pred_class, pred_path
+            )
+        except ClassificationRuntimeError as error:
+            return ("error", str(error))
+        return (record["pathway_ids"], record["superclass_ids"], record["class_ids"])
 
     def record_from_predictions(
         self,
@@ -259,46 +317,40 @@ class NPClassifier:
         pred_class: np.ndarray,
         pred_path: np.ndarray,
     ) -> Dict[str, object]:
-        try:
-            n_super = list(np.flatnonzero(pred_super >= THRESHOLDS["SUPERCLASS"]))
-            n_class = list(np.flatnonzero(pred_class >= THRESHOLDS["CLASS"]))
-            n_path = list(np.flatnonzero(pred_path >= THRESHOLDS["PATHWAY"]))
-
-            path_from_super = self._pathways_from_superclasses(n_super)
-            path_from_class = self._pathways_from_classes(n_class)
-
-            pathway_results, superclass_results, class_results, is_glycoside_out = (
-                prediction_voting.vote_classification(
-                    n_path,
-                    n_class,
-                    n_super,
-                    pred_class,
-                    pred_super,
-                    path_from_class,
-                    path_from_super,
-                    prepared_record.is_glycoside,
-                    self.ontology,
-                )
-            )
-            if not isinstance(is_glycoside_out, bool):
-                raise ClassificationRuntimeError(
-                    "legacy voting returned a non-boolean glycoside flag"
-                )
-        except ClassificationRuntimeError:
-            raise
-        except Exception as error:  # noqa: BLE001
-            raise ClassificationRuntimeError(str(error)) from error
+        outcome = self.voter.vote(pred_super[None], pred_class[None], pred_path[None])[0]
+        return self._record(
+            prepared_record,
+            outcome,
+            pred_super.astype(np.float16),
+            pred_class.astype(np.float16),
+            pred_path.astype(np.float16),
+        )
 
+    def _record(
+        self,
+        prepared_record: PreparedRecord,
+        outcome: VoteOutcome,
+        super_vector: np.ndarray,
+        class_vector: np.ndarray,
+        path_vector: np.ndarray,
+    ) -> Dict[str, object]:
+        if isinstance(outcome, str):
+            raise ClassificationRuntimeError(outcome)
+        if not isinstance(prepared_record.is_glycoside, bool):
+            raise ClassificationRuntimeError(
+                "legacy voting returned a non-boolean glycoside flag"
+            )
+        pathway_ids, superclass_ids, class_ids = outcome
         return {
             "cid": prepared_record.cid,
             "smiles": prepared_record.smiles,
-            "pathway_ids": [self.pathway_to_id[label] for label in pathway_results],
-            "superclass_ids": [self.superclass_to_id[label] for label in superclass_results],
-            "class_ids": [self.class_to_id[label] for label in class_results],
-            "isglycoside": is_glycoside_out,
-            "pathway_prediction_vector": list(pred_path.astype(np.float16)),
-            "superclass_prediction_vector": list(pred_super.astype(np.float16)),
-            "class_prediction_vector": list(pred_class.astype(np.float16)),
+            "pathway_ids": pathway_ids,
+            "superclass_ids": superclass_ids,
+            "class_ids": class_ids,
+            "isglycoside": prepared_record.is_glycoside,
+            "pathway_prediction_vector": list(path_vector),
+            "superclass_prediction_vector": list(super_vector),
+            "class_prediction_vector": list(class_vector),
             "parse_failed": False,
             "rdkit_failed": False,
             "other_failure": False,
@@ -323,17 +375,63 @@ class NPClassifier:
         pred_super_batch, pred_class_batch, pred_path_batch = self.predict_batch(
             prepared_records
         )
-        records: List[Dict[str, object]] = []
-        for index, prepared_record in enumerate(prepared_records):
-            records.append(
-                self.record_from_predictions(
-                    prepared_record=prepared_record,
-                    pred_super=pred_super_batch[index],
-                    pred_class=pred_class_batch[index],
-                    pred_path=pred_path_batch[index],
-                )
+        outcomes = self.voter.vote(pred_super_batch, pred_class_batch, pred_path_batch)
+        super_vectors = pred_super_batch.astype(np.float16)
+        class_vectors = pred_class_batch.astype(np.float16)
+        path_vectors = pred_path_batch.astype(np.float16)
+        return [
+            self._record(
+                prepared_record,
+                outcomes[index],
+                super_vectors[index],
+                class_vectors[index],
+                path_vectors[index],
             )
-        return records
+            for index, prepared_record in enumerate(prepared_records)
+        ]
+
+    def classify_into(
+        self,
+        builder: ClassificationBatchBuilder,
+        rows: Sequence[int],
+        prepared_records: List[PreparedRecord],
+    ) -> None:
+        """Classify ``prepared_records`` straight into ``builder`` at ``rows``.
+
+        Rows the voting fails on become other_failure rows, with the same
+        message classify_prepared_record would raise.
+        """
+        if not prepared_records:
+            return
+        pred_super, pred_class, pred_path = self.predict_batch(prepared_records)
+        outcomes = self.voter.vote(pred_super, pred_class, pred_path)
+        voted = [index for index, outcome in enumerate(outcomes) if not isinstance(outcome, str)]
+        picked: Union[slice, List[int]] = slice(None)
+        if len(voted) != len(outcomes):
+            picked = voted
+            for index, outcome in enumerate(outcomes):
+                if isinstance(outcome, str):
+                    builder.set_failure(
+                        rows[index],
+                        prepared_records[index].cid,
+                        prepared_records[index].smiles,
+                        parse_failed=False,
+                        rdkit_failed=False,
+                        other_failure=True,
+                        error_message=outcome,
+                    )
+        builder.set_classified(
+            [rows[index] for index in voted],
+            [prepared_records[index].cid for index in voted],
+            [prepared_records[index].smiles for index in voted],
+            [prepared_records[index].is_glycoside for index in voted],
+            [cast(VotedIds, outcomes[index]) for index in voted],
+            {
+                "superclass_prediction_vector": pred_super[picked],
+                "class_prediction_vector": pred_class[picked],
+                "pathway_prediction_vector": pred_path[picked],
+            },
+        )
 
     def classify_record(self, cid: int, smiles: str) -> Dict[str, object]:
         prepared_record = self.prepare_record(cid=cid, smiles=smiles)
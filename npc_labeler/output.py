@@ -1,22 +1,36 @@
 from __future__ import annotations
 
+import functools
 import hashlib
 import json
+import os
 import shutil
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Mapping, Optional, cast
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Collection,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    cast,
+)
 
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 import zstandard as zstd
 
+if TYPE_CHECKING:
+    from npc_labeler.results import ClassificationBatch
+
 MANIFEST_FILENAME = "manifest.json"
 VOCABULARY_FILENAME = "vocabulary.json"
 DATASET_SCHEMA_VERSION = 5
-MANIFEST_VERSION = 6
+MANIFEST_VERSION = 7
 PARQUET_CHUNK_ROWS = 10_000_000
 
 ROWS_PARQUET_SCHEMA = pa.schema(
@@ -34,6 +48,8 @@ ROWS_PARQUET_SCHEMA = pa.schema(
     ]
 )
 
+LABEL_COLUMN_NAMES = ["pathway_ids", "superclass_ids", "class_ids"]
+
 PATHWAY_VECTOR_COLUMN = "pathway_prediction_vector"
 SUPERCLASS_VECTOR_COLUMN = "superclass_prediction_vector"
 CLASS_VECTOR_COLUMN = "class_prediction_vector"
@@ -44,6 +60,51 @@ VECTOR_COLUMN_NAMES = [
 ]
 
 ROWS_STAGING_SUFFIX = ".rows.parquet"
+# "staged" writes one Parquet file per checkpoint and merges them when the
+# chunk is finalized; "streaming" appends a row group per checkpoint to the
+# chunk's final file and finalizes it by rename.
+ROWS_WRITERS = ("staged", "streaming")
+# Likewise for the vector sidecars: "streaming" compresses each checkpoint's
+# matrix into its own zstd frame appended to the chunk's sidecar, so nothing
+# is staged uncompressed. Readers must decode across frames.
+VECTOR_WRITERS = ("staged", "streaming")
+PART_JOURNAL = "parts.jsonl"
+
+
+@dataclass(frozen=True)
+class CompressionProfile:
+    """zstd settings for a chunk's completed sidecars and rows Parquet.
+
+    ``threads`` and ``long_distance_matching`` only apply to the sidecars;
+    pyarrow exposes neither for Parquet, which just takes ``parquet_level``
+    (None keeps pyarrow's default zstd level).
+    """
+
+    name: str
+    level: int
+    threads: int
+    long_distance_matching: bool
+    parquet_level: Optional[int]
+
+    def zstd_compressor(self) -> zstd.ZstdCompressor:
+        return zstd.ZstdCompressor(
+            compression_params=zstd.ZstdCompressionParameters.from_level(
+                self.level,
+                threads=self.threads,
+                enable_ldm=self.long_distance_matching,
+            )
+        )
+
+
+# threads=-1 lets zstd use one worker per CPU. "archive" is the default and
+# writes the same bytes as before profiles existed: single-threaded level 19
+# sidecars and Parquet at pyarrow's default level.
+COMPRESSION_PROFILES = {
+    "fast": CompressionProfile("fast", level=3, threads=-1, long_distance_matching=False, parquet_level=1),
+    "balanced": CompressionProfile("balanced", level=9, threads=-1, long_distance_matching=True, parquet_level=3),
+    "archive": CompressionProfile("archive", level=19, threads=0, long_distance_matching=False, parquet_level=None),
+}
+DEFAULT_COMPRESSION_PROFILE = "archive"
 VECTOR_STAGING_SUFFIXES = {
     PATHWAY_VECTOR_COLUMN: ".pathway-vectors.f16.bin",
     SUPERCLASS_VECTOR_COLUMN: ".superclass-vectors.f16.bin",
@@ -87,6 +148,84 @@ def sha256_file(path: Path) -> str:
     return digest.hexdigest()
 
 
+@dataclass(frozen=True)
+class WrittenFile:
+    path: Path
+    bytes: int
+    sha256: str
+
+
+class HashingWriter:
+    """Binary file sink that hashes and counts bytes on their way to disk.
+
+    Completed chunk files are written through it so their digests never
+    need a second read of the file.
+    """
+
+    def __init__(self, path: Path, *, keep_bytes: int = 0) -> None:
+        """Start ``path`` afresh, or keep its first ``keep_bytes`` and append."""
+        self.path = path
+        self.bytes_written = 0
+        self._digest = hashlib.sha256()
+        if not keep_bytes:
+            self._handle: BinaryIO = path.open("wb")
+            return
+        self._handle = path.open("r+b")
+        self._handle.truncate(keep_bytes)
+        # The kept prefix is rehashed so the digest still covers the file.
+        for block in iter(lambda: self._handle.read(1024 * 1024), b""):
+            self._digest.update(block)
+            self.bytes_written += len(block)
+        if self.bytes_written != keep_bytes:
+            raise ValueError(
+                "{0} holds {1} bytes, fewer than the {2} to keep".format(
+                    path, self.bytes_written, keep_bytes
+                )
+            )
+
+    @property
+    def closed(self) -> bool:
+        return self._handle.closed
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data).cast("B")
+        self._handle.write(view)
+        self._digest.update(view)
+        self.bytes_written += view.nbytes
+        return view.nbytes
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self) -> None:
+        self._handle.flush()
+
+    def sync(self) -> None:
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self) -> None:
+        self._handle.close()
+
+    def commit(self, final_path: Path) -> WrittenFile:
+        """Close the file, move it to ``final_path`` and return its digest."""
+        self.close()
+        size = self.path.stat().st_size
+        if size != self.bytes_written:
+            raise RuntimeError(
+                "{0} holds {1} bytes but {2} were hashed".format(
+                    self.path, size, self.bytes_written
+                )
+            )
+        self.path.replace(final_path)
+        return WrittenFile(
+            path=final_path, bytes=self.bytes_written, sha256=self._digest.hexdigest()
+        )
+
+
 @dataclass
 class ChunkRecord:
     created_at: str
@@ -108,6 +247,7 @@ class ChunkRecord:
     class_vector_bytes: int
     class_vector_sha256: str
     class_vector_shape: List[int]
+    compression_profile: str = ""
 
     @classmethod
     def from_payload(cls, payload: Dict[str, object]) -> "ChunkRecord":
@@ -131,6 +271,7 @@ class ChunkRecord:
             class_vector_bytes=_get_int(payload, "class_vector_bytes", 0),
             class_vector_sha256=_get_str(payload, "class_vector_sha256", ""),
             class_vector_shape=_get_int_list(payload, "class_vector_shape"),
+            compression_profile=_get_str(payload, "compression_profile", ""),
         )
 
     def completed_filenames(self) -> List[str]:
@@ -172,7 +313,66 @@ class ChunkIndex:
         return len(self.records) + 1
 
 
-def cleanup_completed_dir(completed_dir: Path, chunk_index: ChunkIndex) -> None:
+@dataclass
+class StagedPart:
+    """One checkpoint batch committed to its chunk's part journal."""
+
+    part_id: int
+    first_row: int
+    rows: int
+    next_offset: int
+    successful_rows: int
+    parse_failed_rows: int
+    rdkit_failed_rows: int
+    other_failed_rows: int
+    rows_writer: str
+    vector_writer: str
+    vector_ends: Dict[str, int]
+
+    @property
+    def next_row(self) -> int:
+        return self.first_row + self.rows
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, object]) -> "StagedPart":
+        vector_ends = payload.get("vector_ends", {})
+        if not isinstance(vector_ends, dict):
+            raise ValueError("expected object payload for vector_ends")
+        return cls(
+            part_id=_require_int(payload, "part_id"),
+            first_row=_require_int(payload, "first_row"),
+            rows=_require_int(payload, "rows"),
+            next_offset=_require_int(payload, "next_offset"),
+            successful_rows=_require_int(payload, "successful_rows"),
+            parse_failed_rows=_require_int(payload, "parse_failed_rows"),
+            rdkit_failed_rows=_require_int(payload, "rdkit_failed_rows"),
+            other_failed_rows=_require_int(payload, "other_failed_rows"),
+            rows_writer=_require_str(payload, "rows_writer"),
+            vector_writer=_require_str(payload, "vector_writer"),
+            vector_ends={str(key): int(value) for key, value in vector_ends.items()},
+        )
+
+
+def read_part_journal(chunk_dir: Path) -> List[StagedPart]:
+    """Parts committed to ``chunk_dir``'s journal, ignoring a torn last line."""
+    path = chunk_dir / PART_JOURNAL
+    if not path.exists():
+        return []
+    parts = []
+    lines = path.read_text().splitlines()
+    for index, line in enumerate(lines):
+        try:
+            parts.append(StagedPart.from_payload(json.loads(line)))
+        except ValueError:
+            if index == len(lines) - 1:
+                break
+            raise
+    return parts
+
+
+def cleanup_completed_dir(
+    completed_dir: Path, chunk_index: ChunkIndex, keep: Collection[str] = ()
+) -> None:
     completed_dir.mkdir(parents=True, exist_ok=True)
     indexed = {
         filename
@@ -180,7 +380,7 @@ def cleanup_completed_dir(completed_dir: Path, chunk_index: ChunkIndex) -> None:
         for filename in record.completed_filenames()
     }
     for path in completed_dir.iterdir():
-        if not path.is_file():
+        if not path.is_file() or path.name in keep:
             continue
         if path.name.endswith(".tmp"):
             path.unlink()
@@ -192,9 +392,19 @@ def cleanup_completed_dir(completed_dir: Path, chunk_index: ChunkIndex) -> None:
             path.unlink()
 
 
-def cleanup_staging_dir(staging_dir: Path) -> None:
-    if staging_dir.exists():
+def cleanup_staging_dir(staging_dir: Path, keep: Collection[Path] = ()) -> None:
+    if not staging_dir.exists():
+        return
+    if not keep:
         shutil.rmtree(staging_dir)
+        return
+    for path in staging_dir.iterdir():
+        if path in keep:
+            continue
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
 
 
 def cleanup_release_staging(release_dir: Path) -> None:
@@ -246,47 +456,45 @@ def _staging_part_path(
     return chunk_dir / filename
 
 
-def _project_rows_record(record: Dict[str, object]) -> Dict[str, object]:
-    return {column: record.get(column) for column in ROWS_COLUMNS}
-
-
-def _vector_row(
-    record: Dict[str, object], column_name: str, width: int
-) -> np.ndarray:
-    values = record.get(column_name)
-    if values is None:
-        return np.full((width,), np.nan, dtype=VECTOR_DTYPE)
-    vector = np.asarray(values, dtype=VECTOR_DTYPE)
-    if vector.shape != (width,):
-        raise ValueError(
-            "expected {0} values for {1}, got {2}".format(
-                width, column_name, vector.shape
-            )
+def _rows_table(batch: ClassificationBatch) -> pa.Table:
+    unclassified = pa.array(~batch.classified)
+    columns = {
+        "cid": pa.array(batch.cids, type=pa.int64()),
+        "smiles": pa.array(batch.smiles, type=pa.string()),
+        "isglycoside": pa.array(
+            batch.isglycoside, type=pa.bool_(), mask=~batch.classified
+        ),
+        "parse_failed": pa.array(batch.parse_failed, type=pa.bool_()),
+        "rdkit_failed": pa.array(batch.rdkit_failed, type=pa.bool_()),
+        "other_failure": pa.array(batch.other_failure, type=pa.bool_()),
+        "error_message": pa.array(batch.error_messages, type=pa.string()),
+    }
+    for column_name in LABEL_COLUMN_NAMES:
+        columns[column_name] = pa.ListArray.from_arrays(
+            pa.array(batch.label_offsets[column_name], type=pa.int32()),
+            pa.array(batch.label_values[column_name], type=pa.uint16()),
+            type=ROWS_PARQUET_SCHEMA.field(column_name).type,
+            mask=unclassified,
         )
-    return vector
+    return pa.Table.from_arrays(
+        [columns[name] for name in ROWS_PARQUET_SCHEMA.names], schema=ROWS_PARQUET_SCHEMA
+    )
 
 
-def _write_rows_table(
-    path: Path, schema: pa.Schema, records: List[Dict[str, object]]
-) -> None:
+def _write_rows_table(path: Path, table: pa.Table) -> None:
     tmp_path = path.with_suffix(path.suffix + ".tmp")
-    table = pa.Table.from_pylist(records, schema=schema)
     pq.write_table(table, tmp_path, compression="zstd")
+    with tmp_path.open("rb") as handle:
+        os.fsync(handle.fileno())
     tmp_path.replace(path)
 
 
-def _write_vector_matrix(
-    path: Path,
-    *,
-    column_name: str,
-    width: int,
-    records: List[Dict[str, object]],
-) -> None:
-    matrix = np.empty((len(records), width), dtype=VECTOR_DTYPE)
-    for index, record in enumerate(records):
-        matrix[index] = _vector_row(record, column_name, width)
+def _write_vector_matrix(path: Path, matrix: np.ndarray) -> None:
     tmp_path = path.with_suffix(path.suffix + ".tmp")
-    tmp_path.write_bytes(matrix.tobytes(order="C"))
+    with tmp_path.open("wb") as handle:
+        handle.write(memoryview(np.ascontiguousarray(matrix, dtype=VECTOR_DTYPE)))
+        handle.flush()
+        os.fsync(handle.fileno())
     tmp_path.replace(path)
 
 
@@ -294,49 +502,65 @@ def write_staging_part(
     staging_dir: Path,
     chunk_id: int,
     part_id: int,
-    records: List[Dict[str, object]],
+    batch: ClassificationBatch,
     *,
     vector_widths: Dict[str, int],
+    include_rows: bool = True,
+    include_vectors: bool = True,
 ) -> Dict[str, Path]:
+    for column_name in VECTOR_COLUMN_NAMES:
+        expected_shape = (batch.rows, vector_widths[column_name])
+        if batch.vectors[column_name].shape != expected_shape:
+            raise ValueError(
+                "expected {0} values for {1}, got {2}".format(
+                    expected_shape, column_name, batch.vectors[column_name].shape
+                )
+            )
     chunk_dir = staging_dir / "chunk-{0:06d}".format(chunk_id)
     chunk_dir.mkdir(parents=True, exist_ok=True)
-    paths = {"rows": _staging_part_path(chunk_dir, chunk_id, part_id, ROWS_STAGING_SUFFIX)}
-    _write_rows_table(
-        paths["rows"],
-        ROWS_PARQUET_SCHEMA,
-        [_project_rows_record(record) for record in records],
-    )
-    for column_name in VECTOR_COLUMN_NAMES:
-        paths[column_name] = _staging_part_path(
-            chunk_dir, chunk_id, part_id, VECTOR_STAGING_SUFFIXES[column_name]
-        )
-        _write_vector_matrix(
-            paths[column_name],
-            column_name=column_name,
-            width=vector_widths[column_name],
-            records=records,
-        )
+    paths = {}
+    if include_rows:
+        paths["rows"] = _staging_part_path(chunk_dir, chunk_id, part_id, ROWS_STAGING_SUFFIX)
+        _write_rows_table(paths["rows"], _rows_table(batch))
+    if include_vectors:
+        for column_name in VECTOR_COLUMN_NAMES:
+            paths[column_name] = _staging_part_path(
+                chunk_dir, chunk_id, part_id, VECTOR_STAGING_SUFFIXES[column_name]
+            )
+            _write_vector_matrix(paths[column_name], batch.vectors[column_name])
     return paths
 
 
+def _completed_rows_filename(chunk_id: int) -> str:
+    return "part-{0:06d}.parquet".format(chunk_id)
+
+
 def _merge_completed_rows(
     *,
     chunk_dir: Path,
     completed_dir: Path,
     chunk_id: int,
     schema: pa.Schema,
-) -> Path:
-    filename = "part-{0:06d}.parquet".format(chunk_id)
-    tmp_path = completed_dir / (filename + ".tmp")
-    final_path = completed_dir / filename
+    compression: CompressionProfile,
+) -> WrittenFile:
+    filename = _completed_rows_filename(chunk_id)
+    sink = HashingWriter(completed_dir / (filename + ".tmp"))
 
     part_paths = sorted(chunk_dir.glob("*{0}".format(ROWS_STAGING_SUFFIX)))
-    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
-        for part_path in part_paths:
-            writer.write_table(pq.ParquetFile(part_path).read())
+    try:
+        with pq.ParquetWriter(
+            sink, schema, compression="zstd", compression_level=compression.parquet_level
+        ) as writer:
+            for part_path in part_paths:
+                writer.write_table(pq.ParquetFile(part_path).read())
+    finally:
+        sink.close()
 
-    tmp_path.replace(final_path)
-    return final_path
+    return sink.commit(completed_dir / filename)
+
+
+def _completed_vector_filename(chunk_id: int, column_name: str) -> str:
+    return "part-{0:06d}{1}".format(chunk_id, VECTOR_COMPLETED_SUFFIXES[column_name])
 
 
 def _merge_completed_vector_stream(
@@ -345,21 +569,22 @@ def _merge_completed_vector_stream(
     completed_dir: Path,
     chunk_id: int,
     column_name: str,
-) -> Path:
-    filename = "part-{0:06d}{1}".format(chunk_id, VECTOR_COMPLETED_SUFFIXES[column_name])
-    tmp_path = completed_dir / (filename + ".tmp")
-    final_path = completed_dir / filename
+    compression: CompressionProfile,
+) -> WrittenFile:
+    filename = _completed_vector_filename(chunk_id, column_name)
+    sink = HashingWriter(completed_dir / (filename + ".tmp"))
 
-    cctx = zstd.ZstdCompressor(level=19)
+    cctx = compression.zstd_compressor()
     part_paths = sorted(chunk_dir.glob("*{0}".format(VECTOR_STAGING_SUFFIXES[column_name])))
-    with tmp_path.open("wb") as handle:
-        with cctx.stream_writer(handle, closefd=False) as writer:
+    try:
+        with cctx.stream_writer(cast(BinaryIO, sink), closefd=False) as writer:
             for part_path in part_paths:
                 with part_path.open("rb") as part_handle:
                     shutil.copyfileobj(part_handle, writer, length=1024 * 1024)
+    finally:
+        sink.close()
 
-    tmp_path.replace(final_path)
-    return final_path
+    return sink.commit(completed_dir / filename)
 
 
 def finalize_chunk(
@@ -371,60 +596,333 @@ def finalize_chunk(
     last_row: int,
     row_count: int,
     vector_widths: Dict[str, int],
+    rows_file: Optional[WrittenFile] = None,
+    vector_files: Optional[Dict[str, WrittenFile]] = None,
+    compression: CompressionProfile = COMPRESSION_PROFILES[DEFAULT_COMPRESSION_PROFILE],
 ) -> ChunkRecord:
+    """Merge the staged parts of a chunk into completed_dir.
+
+    ``rows_file`` and ``vector_files`` are the chunk's already-completed
+    files when those were streamed; anything not given is merged from the
+    staged parts. Digests come from the writers, not from rereading files.
+    """
     chunk_dir = staging_dir / "chunk-{0:06d}".format(chunk_id)
     if not chunk_dir.exists():
         raise FileNotFoundError(chunk_dir)
 
     completed_dir.mkdir(parents=True, exist_ok=True)
-    rows_path = _merge_completed_rows(
-        chunk_dir=chunk_dir,
-        completed_dir=completed_dir,
-        chunk_id=chunk_id,
-        schema=ROWS_PARQUET_SCHEMA,
-    )
-    pathway_vectors_path = _merge_completed_vector_stream(
-        chunk_dir=chunk_dir,
-        completed_dir=completed_dir,
-        chunk_id=chunk_id,
-        column_name=PATHWAY_VECTOR_COLUMN,
-    )
-    superclass_vectors_path = _merge_completed_vector_stream(
-        chunk_dir=chunk_dir,
-        completed_dir=completed_dir,
-        chunk_id=chunk_id,
-        column_name=SUPERCLASS_VECTOR_COLUMN,
-    )
-    class_vectors_path = _merge_completed_vector_stream(
-        chunk_dir=chunk_dir,
-        completed_dir=completed_dir,
-        chunk_id=chunk_id,
-        column_name=CLASS_VECTOR_COLUMN,
-    )
+    if rows_file is None:
+        rows_file = _merge_completed_rows(
+            chunk_dir=chunk_dir,
+            completed_dir=completed_dir,
+            chunk_id=chunk_id,
+            schema=ROWS_PARQUET_SCHEMA,
+            compression=compression,
+        )
+    merged_vector_files = dict(vector_files or {})
+    for column_name in VECTOR_COLUMN_NAMES:
+        if column_name not in merged_vector_files:
+            merged_vector_files[column_name] = _merge_completed_vector_stream(
+                chunk_dir=chunk_dir,
+                completed_dir=completed_dir,
+                chunk_id=chunk_id,
+                column_name=column_name,
+                compression=compression,
+            )
+    pathway_vectors = merged_vector_files[PATHWAY_VECTOR_COLUMN]
+    superclass_vectors = merged_vector_files[SUPERCLASS_VECTOR_COLUMN]
+    class_vectors = merged_vector_files[CLASS_VECTOR_COLUMN]
     shutil.rmtree(chunk_dir)
     return ChunkRecord(
         created_at=utc_now(),
-        filename=rows_path.name,
+        filename=rows_file.path.name,
         first_row=first_row,
         last_row=last_row,
         row_count=row_count,
-        bytes=rows_path.stat().st_size,
-        sha256=sha256_file(rows_path),
-        pathway_vector_filename=pathway_vectors_path.name,
-        pathway_vector_bytes=pathway_vectors_path.stat().st_size,
-        pathway_vector_sha256=sha256_file(pathway_vectors_path),
+        bytes=rows_file.bytes,
+        sha256=rows_file.sha256,
+        pathway_vector_filename=pathway_vectors.path.name,
+        pathway_vector_bytes=pathway_vectors.bytes,
+        pathway_vector_sha256=pathway_vectors.sha256,
         pathway_vector_shape=[row_count, vector_widths[PATHWAY_VECTOR_COLUMN]],
-        superclass_vector_filename=superclass_vectors_path.name,
-        superclass_vector_bytes=superclass_vectors_path.stat().st_size,
-        superclass_vector_sha256=sha256_file(superclass_vectors_path),
+        superclass_vector_filename=superclass_vectors.path.name,
+        superclass_vector_bytes=superclass_vectors.bytes,
+        superclass_vector_sha256=superclass_vectors.sha256,
         superclass_vector_shape=[row_count, vector_widths[SUPERCLASS_VECTOR_COLUMN]],
-        class_vector_filename=class_vectors_path.name,
-        class_vector_bytes=class_vectors_path.stat().st_size,
-        class_vector_sha256=sha256_file(class_vectors_path),
+        class_vector_filename=class_vectors.path.name,
+        class_vector_bytes=class_vectors.bytes,
+        class_vector_sha256=class_vectors.sha256,
         class_vector_shape=[row_count, vector_widths[CLASS_VECTOR_COLUMN]],
+        compression_profile=compression.name,
     )
 
 
+class ChunkWriter:
+    """Writes the checkpoint batches of one chunk and finalizes the chunk.
+
+    Every written batch is a part, and once its files are synced it is
+    appended to PART_JOURNAL in the chunk's staging dir with its row range,
+    input offset and counts. ``resume`` reopens a chunk from that journal
+    after a crash, so only the uncommitted checkpoint is redone.
+
+    In "streaming" rows mode the rows go straight into
+    ``part-NNNNNN.parquet.tmp`` in completed_dir, one row group per
+    checkpoint. A Parquet file cannot be reopened for appending, so such
+    chunks are redone from their first row. In "streaming" vector mode each
+    checkpoint's matrices are appended as one zstd frame per sidecar to
+    ``.zst.tmp`` files, and the journal records where each part's frames
+    end.
+    """
+
+    def __init__(
+        self,
+        *,
+        staging_dir: Path,
+        completed_dir: Path,
+        chunk_id: int,
+        vector_widths: Dict[str, int],
+        rows_writer: str = "staged",
+        vector_writer: str = "staged",
+        compression: CompressionProfile = COMPRESSION_PROFILES[DEFAULT_COMPRESSION_PROFILE],
+    ) -> None:
+        if rows_writer not in ROWS_WRITERS:
+            raise ValueError("unsupported rows writer {0!r}".format(rows_writer))
+        if vector_writer not in VECTOR_WRITERS:
+            raise ValueError("unsupported vector writer {0!r}".format(vector_writer))
+        self.staging_dir = staging_dir
+        self.completed_dir = completed_dir
+        self.chunk_id = chunk_id
+        self.chunk_dir = staging_dir / "chunk-{0:06d}".format(chunk_id)
+        self.vector_widths = vector_widths
+        self.rows_writer = rows_writer
+        self.vector_writer = vector_writer
+        self.compression = compression
+        self.parts: List[StagedPart] = []
+        self._rows_sink: Optional[HashingWriter] = None
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+        self._vector_handles: Dict[str, HashingWriter] = {}
+        self._vector_compressor = compression.zstd_compressor()
+
+    @classmethod
+    def resume(
+        cls,
+        *,
+        staging_dir: Path,
+        completed_dir: Path,
+        chunk_id: int,
+        first_row: int,
+        vector_widths: Dict[str, int],
+        rows_writer: str = "staged",
+        vector_writer: str = "staged",
+        compression: CompressionProfile = COMPRESSION_PROFILES[DEFAULT_COMPRESSION_PROFILE],
+    ) -> Optional["ChunkWriter"]:
+        """Reopen chunk ``chunk_id`` after its last journaled part.
+
+        Returns None when there is nothing to resume: no committed parts, a
+        journal that does not start at ``first_row`` or was written with
+        other writer modes, missing part files, or streaming rows.
+        Uncommitted part files and sidecar bytes are dropped.
+        """
+        writer = cls(
+            staging_dir=staging_dir,
+            completed_dir=completed_dir,
+            chunk_id=chunk_id,
+            vector_widths=vector_widths,
+            rows_writer=rows_writer,
+            vector_writer=vector_writer,
+            compression=compression,
+        )
+        parts = read_part_journal(writer.chunk_dir)
+        if not parts or rows_writer == "streaming":
+            return None
+        expected_row = first_row
+        for part_id, part in enumerate(parts, start=1):
+            if (
+                part.part_id != part_id
+                or part.first_row != expected_row
+                or (part.rows_writer, part.vector_writer) != (rows_writer, vector_writer)
+            ):
+                return None
+            expected_row = part.next_row
+
+        kept = {PART_JOURNAL}
+        for part in parts:
+            kept.update(path.name for path in writer._staged_paths(part.part_id))
+        if any(not (writer.chunk_dir / name).exists() for name in kept - {PART_JOURNAL}):
+            return None
+        vector_ends = parts[-1].vector_ends
+        if vector_writer == "streaming":
+            for column_name in VECTOR_COLUMN_NAMES:
+                path = writer._vector_tmp_path(column_name)
+                sealed_path = path.with_name(path.name[: -len(".tmp")])
+                if not path.exists() and sealed_path.exists():
+                    # Sealed but not committed before the crash; reopened so it is hashed again.
+                    sealed_path.rename(path)
+                if not path.exists() or path.stat().st_size < vector_ends.get(column_name, -1):
+                    return None
+
+        for path in writer.chunk_dir.iterdir():
+            if path.name not in kept:
+                path.unlink()
+        # Rewritten so a torn trailing line is gone before parts are appended.
+        with (writer.chunk_dir / PART_JOURNAL).open("w", encoding="utf-8") as journal:
+            for part in parts:
+                journal.write(json.dumps(asdict(part), sort_keys=True))
+                journal.write("\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        if vector_writer == "streaming":
+            for column_name in VECTOR_COLUMN_NAMES:
+                writer._vector_handles[column_name] = HashingWriter(
+                    writer._vector_tmp_path(column_name), keep_bytes=vector_ends[column_name]
+                )
+        writer.parts = parts
+        return writer
+
+    @property
+    def next_part_id(self) -> int:
+        return len(self.parts) + 1
+
+    @property
+    def rows(self) -> int:
+        return sum(part.rows for part in self.parts)
+
+    def open_filenames(self) -> List[str]:
+        """Names of this chunk's in-progress files in completed_dir."""
+        return [handle.path.name for handle in self._vector_handles.values()]
+
+    def _vector_tmp_path(self, column_name: str) -> Path:
+        return self.completed_dir / (
+            _completed_vector_filename(self.chunk_id, column_name) + ".tmp"
+        )
+
+    def _staged_paths(self, part_id: int) -> List[Path]:
+        suffixes = []
+        if self.rows_writer == "staged":
+            suffixes.append(ROWS_STAGING_SUFFIX)
+        if self.vector_writer == "staged":
+            suffixes.extend(VECTOR_STAGING_SUFFIXES[column] for column in VECTOR_COLUMN_NAMES)
+        return [
+            _staging_part_path(self.chunk_dir, self.chunk_id, part_id, suffix)
+            for suffix in suffixes
+        ]
+
+    def write(self, batch: ClassificationBatch, *, first_row: int, next_offset: int) -> None:
+        """Write ``batch`` as the next part; ``next_offset`` is where its input ends."""
+        self.chunk_dir.mkdir(parents=True, exist_ok=True)
+        write_staging_part(
+            staging_dir=self.staging_dir,
+            chunk_id=self.chunk_id,
+            part_id=self.next_part_id,
+            batch=batch,
+            vector_widths=self.vector_widths,
+            include_rows=self.rows_writer == "staged",
+            include_vectors=self.vector_writer == "staged",
+        )
+        if self.rows_writer == "streaming":
+            if self._parquet_writer is None:
+                self.completed_dir.mkdir(parents=True, exist_ok=True)
+                self._rows_sink = HashingWriter(
+                    self.completed_dir / (_completed_rows_filename(self.chunk_id) + ".tmp")
+                )
+                self._parquet_writer = pq.ParquetWriter(
+                    self._rows_sink,
+                    ROWS_PARQUET_SCHEMA,
+                    compression="zstd",
+                    compression_level=self.compression.parquet_level,
+                )
+            self._parquet_writer.write_table(_rows_table(batch))
+        vector_ends = {}
+        if self.vector_writer == "streaming":
+            vector_ends = self._append_vector_frames(batch)
+
+        part = StagedPart(
+            part_id=self.next_part_id,
+            first_row=first_row,
+            rows=batch.rows,
+            next_offset=next_offset,
+            successful_rows=batch.successful_rows,
+            parse_failed_rows=batch.parse_failed_rows,
+            rdkit_failed_rows=batch.rdkit_failed_rows,
+            other_failed_rows=batch.other_failed_rows,
+            rows_writer=self.rows_writer,
+            vector_writer=self.vector_writer,
+            vector_ends=vector_ends,
+        )
+        # The part only counts as committed once this line is on disk.
+        with (self.chunk_dir / PART_JOURNAL).open("a", encoding="utf-8") as journal:
+            journal.write(json.dumps(asdict(part), sort_keys=True) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.parts.append(part)
+
+    def _append_vector_frames(self, batch: ClassificationBatch) -> Dict[str, int]:
+        ends = {}
+        for column_name in VECTOR_COLUMN_NAMES:
+            handle = self._vector_handles.get(column_name)
+            if handle is None:
+                self.completed_dir.mkdir(parents=True, exist_ok=True)
+                handle = HashingWriter(self._vector_tmp_path(column_name))
+                self._vector_handles[column_name] = handle
+            matrix = np.ascontiguousarray(batch.vectors[column_name], dtype=VECTOR_DTYPE)
+            handle.write(self._vector_compressor.compress(memoryview(matrix)))
+            handle.sync()
+            ends[column_name] = handle.tell()
+        return ends
+
+    def close(self) -> None:
+        """Release open files without finalizing; the .tmp files stay behind."""
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._rows_sink is not None:
+            self._rows_sink.close()
+            self._rows_sink = None
+        for handle in self._vector_handles.values():
+            handle.close()
+        self._vector_handles = {}
+
+    def finalize(self, *, first_row: int, last_row: int, row_count: int) -> ChunkRecord:
+        return self.seal(first_row=first_row, last_row=last_row, row_count=row_count)()
+
+    def seal(
+        self, *, first_row: int, last_row: int, row_count: int
+    ) -> "functools.partial[ChunkRecord]":
+        """Close the streamed files and return the rest of finalization.
+
+        The returned call only touches files on disk, so it can run in
+        another process while the next chunk is being written.
+        """
+        rows_file = None
+        if self._parquet_writer is not None and self._rows_sink is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+            rows_file = self._rows_sink.commit(
+                self.completed_dir / _completed_rows_filename(self.chunk_id)
+            )
+            self._rows_sink = None
+        vector_files = {
+            column_name: handle.commit(
+                self.completed_dir / _completed_vector_filename(self.chunk_id, column_name)
+            )
+            for column_name, handle in self._vector_handles.items()
+        }
+        self._vector_handles = {}
+        return functools.partial(
+            finalize_chunk,
+            completed_dir=self.completed_dir,
+            staging_dir=self.staging_dir,
+            chunk_id=self.chunk_id,
+            first_row=first_row,
+            last_row=last_row,
+            row_count=row_count,
+            vector_widths=self.vector_widths,
+            rows_file=rows_file,
+            vector_files=vector_files,
+            compression=self.compression,
+        )
+
+
 def write_vocabulary(release_dir: Path, vocabulary: Dict[str, List[str]]) -> Path:
     release_dir.mkdir(parents=True, exist_ok=True)
     path = release_dir / VOCABULARY_FILENAME
@@ -448,6 +946,7 @@ def build_release_manifest(
     chunk_rows: int,
     max_rows: Optional[int],
     vector_widths: Dict[str, int],
+    compression: CompressionProfile = COMPRESSION_PROFILES[DEFAULT_COMPRESSION_PROFILE],
 ) -> Path:
     cleanup_release_staging(release_dir)
     manifest = {
@@ -474,6 +973,7 @@ def build_release_manifest(
         "weights": weights_info,
         "format": {
             "rows_type": "parquet",
+            "compression_profile": asdict(compression),
             "alignment": (
                 "Each chunk writes one main rows file and three vector sidecar files. "
                 "All four files have identical row order and row count within the chunk."
@@ -493,6 +993,11 @@ def build_release_manifest(
             "vector_sidecars": {
                 "encoding": "raw row-major little-endian float16 matrix",
                 "compression": "zstd",
+                "framing": (
+                    "A sidecar is one zstd frame or several concatenated frames (one per "
+                    "checkpoint when streamed); decode across frame boundaries, e.g. "
+                    "zstandard stream_reader(read_across_frames=True)."
+                ),
                 "failed_row_encoding": (
                     "Rows flagged as failures in the main parquet are encoded as all-NaN "
                     "vectors in each sidecar."
@@ -524,6 +1029,7 @@ def build_release_manifest(
                 "row_count": record.row_count,
                 "bytes": record.bytes,
                 "sha256": record.sha256,
+                "compression_profile": record.compression_profile,
                 "pathway_vector_file": {
                     "filename": record.pathway_vector_filename,
                     "bytes": record.pathway_vector_bytes,
@@ -1,46 +1,62 @@
 from __future__ import annotations
 
+import multiprocessing
+import threading
 import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import nullcontext, suppress
 from dataclasses import dataclass
+from functools import partial
+from multiprocessing.pool import AsyncResult, Pool
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from queue import Empty, Full, Queue
+from typing import (
+    Callable,
+    ContextManager,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
 
 from npc_labeler.downloads import (
+    INPUT_MODES,
     PUBCHEM_CID_SMILES_URL,
     SourceInfo,
     WeightsInfo,
     ensure_model_weights,
     ensure_pubchem_input,
+    open_pubchem_input,
 )
 from npc_labeler.model import (
-    ClassificationRuntimeError,
     InvalidSmilesError,
     NPClassifier,
+    PreparedRecord,
     RdkitPipelineError,
+    prepare_record,
 )
 from npc_labeler.output import (
+    COMPRESSION_PROFILES,
+    DEFAULT_COMPRESSION_PROFILE,
     PARQUET_CHUNK_ROWS,
+    ROWS_WRITERS,
+    VECTOR_WRITERS,
     ChunkIndex,
+    ChunkRecord,
+    ChunkWriter,
     build_release_manifest,
     cleanup_completed_dir,
     cleanup_staging_dir,
-    finalize_chunk,
-    write_staging_part,
     write_vocabulary,
 )
+from npc_labeler.results import ClassificationBatch, ClassificationBatchBuilder
 from npc_labeler.state import RunState
-
-
-def _parse_pubchem_line(raw_line: str) -> Optional[Tuple[int, str]]:
-    parts = raw_line.rstrip("\n").split("\t", 1)
-    if len(parts) != 2:
-        return None
-    cid_text, smiles = parts
-    try:
-        cid = int(cid_text)
-    except ValueError:
-        return None
-    return cid, smiles.strip()
+from npc_labeler.tsv import PubchemTsvReader
+from npc_labeler.voting import DEFAULT_VOTE_CACHE_SIZE
 
 
 @dataclass
@@ -58,6 +74,19 @@ class RunConfig:
     download_pubchem: bool
     pubchem_url: str = PUBCHEM_CID_SMILES_URL
     chunk_rows: int = PARQUET_CHUNK_ROWS
+    prep_workers: int = 1
+    inference_mode: str = "dense"
+    inference_precision: str = "float32"
+    vote_cache_size: int = DEFAULT_VOTE_CACHE_SIZE
+    rows_writer: str = "staged"
+    vector_writer: str = "staged"
+    compression_profile: str = DEFAULT_COMPRESSION_PROFILE
+    max_pending_chunks: int = 1
+    inference_threads: int = 1
+    pipeline_queue_depth: int = 2
+    input_mode: str = "materialized"
+    defer_count: bool = False
+    download_connections: int = 1
 
 
 @dataclass
@@ -82,52 +111,51 @@ class RunCounts:
 
 
 def _read_batch(
-    handle,
+    reader: PubchemTsvReader,
     *,
     current_row: int,
     checkpoint_rows: int,
     max_rows: Optional[int],
 ) -> Tuple[List[Tuple[int, int, str]], int]:
-    tasks: List[Tuple[int, int, str]] = []
-    batch_end_offset = handle.tell()
-    while len(tasks) < checkpoint_rows:
-        if max_rows is not None and current_row + len(tasks) >= max_rows:
-            break
-        raw_line = handle.readline()
-        if not raw_line:
-            break
-        batch_end_offset = handle.tell()
-        parsed = _parse_pubchem_line(raw_line.decode("utf-8", errors="replace"))
-        if parsed is None:
-            continue
-        cid, smiles = parsed
-        tasks.append((current_row + len(tasks), cid, smiles))
-    return tasks, batch_end_offset
+    limit = checkpoint_rows
+    if max_rows is not None:
+        limit = min(limit, max_rows - current_row)
+    batch = reader.read(max(limit, 0))
+    tasks = list(
+        zip(range(current_row, current_row + batch.rows), batch.cids.tolist(), batch.smiles)
+    )
+    return tasks, batch.end_offset
 
 
 def _progress_line(
     *,
     counts: RunCounts,
-    target_rows: int,
+    target_rows: Optional[int],
     started_at: float,
     checkpoint_rows: int,
     next_chunk_id: int,
     rows_in_chunk: int,
     chunk_rows: int,
+    vote_cache_hits: int = 0,
+    vote_cache_misses: int = 0,
 ) -> str:
     elapsed = max(time.time() - started_at, 1e-6)
     rate = counts.processed_rows / elapsed
-    remaining = max(target_rows - counts.processed_rows, 0)
-    eta_seconds = remaining / rate if rate > 0 else 0.0
-    eta_minutes = eta_seconds / 60.0
+    if target_rows is None:
+        target_text, eta_text = "?", "?"
+    else:
+        remaining = max(target_rows - counts.processed_rows, 0)
+        eta_seconds = remaining / rate if rate > 0 else 0.0
+        target_text, eta_text = str(target_rows), "{0:.1f}".format(eta_seconds / 60.0)
     return (
         "handled {processed}/{target} rows | success={success} parse_failed={parse_failed} "
         "rdkit_failed={rdkit_failed} other_failed={other_failed} | chunk={chunk_id} "
         "rows_in_chunk={rows_in_chunk}/{chunk_rows} | checkpoint_rows={checkpoint_rows} "
-        "| rate={rate:.1f}/s | eta={eta:.1f} min"
+        "| vote_cache hits={vote_cache_hits} misses={vote_cache_misses} "
+        "| rate={rate:.1f}/s | eta={eta} min"
     ).format(
         processed=counts.processed_rows,
-        target=target_rows,
+        target=target_text,
         success=counts.successful_rows,
         parse_failed=counts.parse_failed_rows,
         rdkit_failed=counts.rdkit_failed_rows,
@@ -136,37 +164,444 @@ def _progress_line(
         rows_in_chunk=rows_in_chunk,
         chunk_rows=chunk_rows,
         checkpoint_rows=checkpoint_rows,
+        vote_cache_hits=vote_cache_hits,
+        vote_cache_misses=vote_cache_misses,
         rate=rate,
-        eta=eta_minutes,
+        eta=eta_text,
     )
 
 
-def _failure_record(
-    cid: int,
-    smiles: str,
-    *,
-    parse_failed: bool,
-    rdkit_failed: bool,
-    other_failure: bool,
-    error_message: str,
-) -> Dict[str, object]:
+@dataclass
+class PrepOutcome:
+    prepared: Optional[PreparedRecord]
+    failure: Optional[str] = None
+    error_message: str = ""
+
+
+def _prepare_task(task: Tuple[int, int, str]) -> PrepOutcome:
+    _row_index, cid, smiles = task
+    try:
+        return PrepOutcome(prepared=prepare_record(cid=cid, smiles=smiles))
+    except InvalidSmilesError as error:
+        return PrepOutcome(None, "parse_failed", str(error))
+    except RdkitPipelineError as error:
+        return PrepOutcome(None, "rdkit_failed", str(error))
+    except Exception as error:  # noqa: BLE001
+        return PrepOutcome(None, "other_failure", str(error))
+
+
+def _prepare_tasks(
+    tasks: List[Tuple[int, int, str]], executor: Optional[Executor], workers: int
+) -> List[PrepOutcome]:
+    if executor is None:
+        return [_prepare_task(task) for task in tasks]
+    chunksize = max(1, min(1024, len(tasks) // (workers * 4)))
+    return list(executor.map(_prepare_task, tasks, chunksize=chunksize))
+
+
+def _prep_executor(workers: int) -> ContextManager[Optional[Executor]]:
+    if workers <= 1:
+        return nullcontext(None)
+    # Spawned workers import RDKit on their own instead of inheriting a forked
+    # copy of the parent's BLAS thread pools and loaded weights.
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _state_update(
+    counts: RunCounts, *, next_row: int, next_offset: int, next_chunk_id: int
+) -> Dict[str, int]:
+    # Snapshot taken at the chunk boundary; saved once the chunk commits.
     return {
-        "cid": cid,
-        "smiles": smiles,
-        "pathway_ids": None,
-        "superclass_ids": None,
-        "class_ids": None,
-        "isglycoside": None,
-        "pathway_prediction_vector": None,
-        "superclass_prediction_vector": None,
-        "class_prediction_vector": None,
-        "parse_failed": parse_failed,
-        "rdkit_failed": rdkit_failed,
-        "other_failure": other_failure,
-        "error_message": error_message,
+        "next_row": next_row,
+        "next_offset": next_offset,
+        "successful_rows": counts.successful_rows,
+        "parse_failed_rows": counts.parse_failed_rows,
+        "rdkit_failed_rows": counts.rdkit_failed_rows,
+        "other_failed_rows": counts.other_failed_rows,
+        "next_chunk_id": next_chunk_id,
     }
 
 
+def _submit_chunk(
+    finalizer: "_ChunkFinalizer",
+    chunk_writer: ChunkWriter,
+    counts: RunCounts,
+    *,
+    next_row: int,
+    next_offset: int,
+    next_chunk_id: int,
+) -> None:
+    finalizer.submit(
+        chunk_writer,
+        first_row=chunk_writer.parts[0].first_row,
+        last_row=next_row - 1,
+        row_count=chunk_writer.rows,
+        state_update=_state_update(
+            counts,
+            next_row=next_row,
+            next_offset=next_offset,
+            next_chunk_id=next_chunk_id,
+        ),
+    )
+
+
+class _ChunkFinalizer:
+    """Finalizes chunks in order, inline or in one background process.
+
+    A chunk is only appended to the chunk index, and the run state saved
+    with the boundary it reached, once its finalization has returned. A
+    crash with chunks still pending therefore resumes from the last
+    committed boundary and cleanup_completed_dir drops the rest.
+    ``commit_finished`` commits every finished chunk at the front of the
+    queue, so only chunks that are still being finalized stay pending.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_pending: int,
+        chunk_index: ChunkIndex,
+        state: RunState,
+        state_path: Path,
+    ) -> None:
+        self.max_pending = max_pending
+        self.chunk_index = chunk_index
+        self.state = state
+        self.state_path = state_path
+        self._executor: Optional[Executor] = None
+        if max_pending > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._pending: Deque[Tuple["Future[ChunkRecord]", Dict[str, int]]] = deque()
+
+    def __enter__(self) -> "_ChunkFinalizer":
+        return self
+
+    def __exit__(self, exc_type: object, exc: object, traceback: object) -> None:
+        try:
+            if exc_type is None:
+                self.drain()
+            else:
+                # Keep the chunks that did finish; a later run redoes the rest.
+                with suppress(Exception):
+                    self.drain()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(
+        self,
+        writer: ChunkWriter,
+        *,
+        first_row: int,
+        last_row: int,
+        row_count: int,
+        state_update: Dict[str, int],
+    ) -> None:
+        job = writer.seal(first_row=first_row, last_row=last_row, row_count=row_count)
+        future: "Future[ChunkRecord]"
+        if self._executor is None:
+            future = Future()
+            future.set_result(job())
+        else:
+            future = self._executor.submit(job)
+        self._pending.append((future, state_update))
+        self.commit_finished()
+        while len(self._pending) > self.max_pending:
+            self._commit_oldest()
+
+    def commit_finished(self) -> None:
+        while self._pending and self._pending[0][0].done():
+            self._commit_oldest()
+
+    def drain(self) -> None:
+        while self._pending:
+            self._commit_oldest()
+
+    def _commit_oldest(self) -> None:
+        future, state_update = self._pending[0]
+        chunk_record = future.result()
+        self._pending.popleft()
+        self.chunk_index.append(chunk_record)
+        self.state.update(**state_update)
+        self.state.save(self.state_path)
+        print("finalized {0} at row {1}".format(chunk_record.filename, chunk_record.last_row))
+
+
+class _DeferredCount:
+    """Counts the PubChem input in a background process when the count was deferred.
+
+    ``poll`` picks the count up without blocking once it is done and ``wait``
+    blocks for it. Leaving on an error terminates the counting process.
+    """
+
+    def __init__(self, source_info: SourceInfo, count_job: Callable[[], SourceInfo]) -> None:
+        self.source_info = source_info
+        self._count_job = count_job
+        self._pool: Optional[Pool] = None
+        self._result: Optional["AsyncResult[SourceInfo]"] = None
+
+    def __enter__(self) -> "_DeferredCount":
+        if self.source_info["pubchem_total"] is None:
+            print("counting rows of {0} in the background".format(self.source_info["source_path"]))
+            self._pool = multiprocessing.get_context("spawn").Pool(1)
+            self._result = self._pool.apply_async(self._count_job)
+        return self
+
+    def __exit__(self, exc_type: object, exc: object, traceback: object) -> None:
+        if self._pool is None:
+            return
+        if exc_type is None:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+
+    def poll(self) -> Optional[int]:
+        if self._result is not None and self._result.ready():
+            self.source_info = self._result.get()
+            self._result = None
+        return self.source_info["pubchem_total"]
+
+    def wait(self) -> int:
+        if self._result is not None:
+            self.source_info = self._result.get()
+            self._result = None
+        pubchem_total = self.source_info["pubchem_total"]
+        if pubchem_total is None:
+            raise RuntimeError("the deferred row count never started")
+        return pubchem_total
+
+
+def _target_rows(pubchem_total: Optional[int], max_rows: Optional[int]) -> Optional[int]:
+    if pubchem_total is None:
+        return max_rows
+    return min(pubchem_total, max_rows) if max_rows is not None else pubchem_total
+
+
+_END_OF_STAGE = object()
+
+
+class _StageStopped(Exception):
+    pass
+
+
+class _StagePipeline:
+    """Threads for the reader, preparation and inference stages.
+
+    Stages pass work along bounded queues, so a slow stage blocks the ones
+    upstream of it. Every item carries its checkpoint sequence number and
+    ``ordered`` hands results to the writer in input order. The first stage
+    error stops every stage and is raised in the writer.
+    """
+
+    def __init__(self) -> None:
+        self.stopped = threading.Event()
+        self.errors: List[BaseException] = []
+        self.threads: List[threading.Thread] = []
+
+    def __enter__(self) -> "_StagePipeline":
+        return self
+
+    def __exit__(self, exc_type: object, exc: object, traceback: object) -> None:
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def start(
+        self, name: str, target: Callable[..., None], *args: object, **kwargs: object
+    ) -> None:
+        def run() -> None:
+            try:
+                target(*args, **kwargs)
+            except _StageStopped:
+                pass
+            except BaseException as error:  # noqa: BLE001
+                self.errors.append(error)
+                self.stopped.set()
+
+        thread = threading.Thread(target=run, name="npc-{0}".format(name), daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def put(self, queue: "Queue[object]", item: object) -> None:
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+        raise _StageStopped()
+
+    def get(self, queue: "Queue[object]") -> object:
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        if self.errors:
+            raise self.errors[0]
+        raise _StageStopped()
+
+    def ordered(
+        self, queue: "Queue[object]", *, producers: int
+    ) -> Iterator[Tuple[List[Tuple[int, int, str]], int, ClassificationBatch]]:
+        waiting: Dict[int, Tuple[List[Tuple[int, int, str]], int, ClassificationBatch]] = {}
+        next_sequence = 0
+        while producers:
+            item = self.get(queue)
+            if item is _END_OF_STAGE:
+                producers -= 1
+                continue
+            sequence, tasks, batch_end_offset, batch = cast(
+                Tuple[int, List[Tuple[int, int, str]], int, ClassificationBatch], item
+            )
+            waiting[sequence] = (tasks, batch_end_offset, batch)
+            while next_sequence in waiting:
+                yield waiting.pop(next_sequence)
+                next_sequence += 1
+
+
+def _read_stage(
+    stages: _StagePipeline,
+    handle,
+    output: "Queue[object]",
+    *,
+    current_row: int,
+    target_rows: Optional[int],
+    checkpoint_rows: int,
+    max_rows: Optional[int],
+) -> None:
+    reader = PubchemTsvReader(handle)
+    sequence = 0
+    while target_rows is None or current_row < target_rows:
+        tasks, batch_end_offset = _read_batch(
+            reader,
+            current_row=current_row,
+            checkpoint_rows=checkpoint_rows,
+            max_rows=max_rows,
+        )
+        if not tasks:
+            break
+        stages.put(output, (sequence, tasks, batch_end_offset))
+        current_row += len(tasks)
+        sequence += 1
+    stages.put(output, _END_OF_STAGE)
+
+
+def _prep_stage(
+    stages: _StagePipeline,
+    source: "Queue[object]",
+    output: "Queue[object]",
+    *,
+    executor: Optional[Executor],
+    prep_workers: int,
+    vector_widths: Dict[str, int],
+    downstream: int,
+) -> None:
+    while True:
+        item = stages.get(source)
+        if item is _END_OF_STAGE:
+            break
+        sequence, tasks, batch_end_offset = cast(
+            Tuple[int, List[Tuple[int, int, str]], int], item
+        )
+        builder = ClassificationBatchBuilder(len(tasks), vector_widths)
+        prepared_rows = []
+        outcomes = _prepare_tasks(tasks, executor, prep_workers)
+        for task_index, outcome in enumerate(outcomes):
+            if outcome.prepared is not None:
+                prepared_rows.append((task_index, outcome.prepared))
+                continue
+            _row_index, cid, smiles = tasks[task_index]
+            builder.set_failure(
+                task_index,
+                cid,
+                smiles,
+                parse_failed=outcome.failure == "parse_failed",
+                rdkit_failed=outcome.failure == "rdkit_failed",
+                other_failure=outcome.failure == "other_failure",
+                error_message=outcome.error_message,
+            )
+        stages.put(output, (sequence, tasks, batch_end_offset, builder, prepared_rows))
+    for _ in range(downstream):
+        stages.put(output, _END_OF_STAGE)
+
+
+def _inference_stage(
+    stages: _StagePipeline,
+    source: "Queue[object]",
+    output: "Queue[object]",
+    *,
+    classifier: NPClassifier,
+    inference_batch_rows: int,
+) -> None:
+    while True:
+        item = stages.get(source)
+        if item is _END_OF_STAGE:
+            break
+        sequence, tasks, batch_end_offset, builder, prepared_rows = cast(
+            Tuple[
+                int,
+                List[Tuple[int, int, str]],
+                int,
+                ClassificationBatchBuilder,
+                List[Tuple[int, PreparedRecord]],
+            ],
+            item,
+        )
+        # Raises before anything of this run is written if reduced-precision
+        # weights disagree with float32 on the first non-empty inference slice;
+        # once a slice has passed this returns straight away.
+        classifier.check_precision_parity(
+            [prepared_record for _, prepared_record in prepared_rows[:inference_batch_rows]]
+        )
+
+        for batch_start in range(0, len(prepared_rows), inference_batch_rows):
+            batch_items = prepared_rows[batch_start : batch_start + inference_batch_rows]
+            try:
+                classifier.classify_into(
+                    builder,
+                    [task_index for task_index, _ in batch_items],
+                    [prepared_record for _, prepared_record in batch_items],
+                )
+            except Exception:
+                for task_index, prepared_record in batch_items:
+                    try:
+                        classifier.classify_into(builder, [task_index], [prepared_record])
+                    except Exception as error:  # noqa: BLE001
+                        builder.set_failure(
+                            task_index,
+                            prepared_record.cid,
+                            prepared_record.smiles,
+                            parse_failed=False,
+                            rdkit_failed=False,
+                            other_failure=True,
+                            error_message=str(error),
+                        )
+
+        for task_index in builder.unassigned_rows():
+            _row_index, cid, smiles = tasks[task_index]
+            builder.set_failure(
+                task_index,
+                cid,
+                smiles,
+                parse_failed=False,
+                rdkit_failed=False,
+                other_failure=True,
+                error_message="missing classification result",
+            )
+        stages.put(output, (sequence, tasks, batch_end_offset, builder.build()))
+    stages.put(output, _END_OF_STAGE)
+
+
 def run_pipeline(config: RunConfig) -> Dict[str, object]:
     if config.chunk_rows % config.checkpoint_rows != 0:
         raise ValueError(
@@ -180,6 +615,42 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
                 config.inference_batch_rows
             )
         )
+    if config.prep_workers <= 0:
+        raise ValueError(
+            "prep_workers must be positive; got {0}".format(config.prep_workers)
+        )
+    if config.rows_writer not in ROWS_WRITERS:
+        raise ValueError("unsupported rows writer {0!r}".format(config.rows_writer))
+    if config.vector_writer not in VECTOR_WRITERS:
+        raise ValueError("unsupported vector writer {0!r}".format(config.vector_writer))
+    if config.compression_profile not in COMPRESSION_PROFILES:
+        raise ValueError(
+            "unsupported compression profile {0!r}".format(config.compression_profile)
+        )
+    if config.input_mode not in INPUT_MODES:
+        raise ValueError("unsupported input mode {0!r}".format(config.input_mode))
+    if config.download_connections <= 0:
+        raise ValueError(
+            "download_connections must be positive; got {0}".format(config.download_connections)
+        )
+    if config.inference_threads <= 0:
+        raise ValueError(
+            "inference_threads must be positive; got {0}".format(config.inference_threads)
+        )
+    if config.pipeline_queue_depth <= 0:
+        raise ValueError(
+            "pipeline_queue_depth must be positive; got {0}".format(
+                config.pipeline_queue_depth
+            )
+        )
+    if config.max_pending_chunks < 0:
+        raise ValueError(
+            "max_pending_chunks must be non-negative; got {0}".format(config.max_pending_chunks)
+        )
+    if config.vote_cache_size < 0:
+        raise ValueError(
+            "vote_cache_size must be non-negative; got {0}".format(config.vote_cache_size)
+        )
 
     for path in (
         config.work_dir,
@@ -191,22 +662,45 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
         path.mkdir(parents=True, exist_ok=True)
 
     staging_dir = config.state_dir / "staging"
-    cleanup_staging_dir(staging_dir)
 
-    weights_info: WeightsInfo = ensure_model_weights(config.weights_dir)
+    weights_info: WeightsInfo = ensure_model_weights(
+        config.weights_dir, download_connections=config.download_connections
+    )
     source_info: SourceInfo = ensure_pubchem_input(
         pubchem_input_path=config.pubchem_input_path,
         materialized_input_path=config.materialized_input_path,
         allow_download=config.download_pubchem,
         pubchem_url=config.pubchem_url,
+        input_mode=config.input_mode,
+        defer_count=config.defer_count,
+        download_connections=config.download_connections,
+    )
+    input_path = Path(source_info["materialized_path"])
+    deferred_count = _DeferredCount(
+        source_info,
+        partial(
+            ensure_pubchem_input,
+            pubchem_input_path=config.pubchem_input_path,
+            materialized_input_path=config.materialized_input_path,
+            allow_download=False,
+            pubchem_url=config.pubchem_url,
+            input_mode=config.input_mode,
+        ),
     )
 
-    classifier = NPClassifier.from_weights_dir(config.weights_dir)
+    classifier = NPClassifier.from_weights_dir(
+        config.weights_dir,
+        inference_mode=config.inference_mode,
+        workspace_rows=config.inference_batch_rows,
+        inference_precision=config.inference_precision,
+        vote_cache_size=config.vote_cache_size,
+        weights_sha256={entry["filename"]: entry["sha256"] for entry in weights_info["files"]},
+        log=print,
+    )
     weights_info["rdkit_version"] = classifier.rdkit_version
 
     state_path = config.state_dir / "run-state.json"
     chunk_index = ChunkIndex.open(config.state_dir / "chunks.jsonl")
-    cleanup_completed_dir(config.completed_dir, chunk_index)
 
     if state_path.exists():
         state = RunState.load(state_path)
@@ -217,7 +711,12 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
             checkpoint_rows=config.checkpoint_rows,
             chunk_rows=config.chunk_rows,
             max_rows=config.max_rows,
+            source_bytes=source_info["source_bytes"],
+            source_mtime_ns=source_info["source_mtime_ns"],
         )
+        # States from before the source identity was kept pick it up here.
+        state.source_bytes = source_info["source_bytes"]
+        state.source_mtime_ns = source_info["source_mtime_ns"]
     else:
         state = RunState.create(
             input_path=config.pubchem_input_path,
@@ -226,8 +725,13 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
             checkpoint_rows=config.checkpoint_rows,
             chunk_rows=config.chunk_rows,
             max_rows=config.max_rows,
+            source_bytes=source_info["source_bytes"],
+            source_mtime_ns=source_info["source_mtime_ns"],
         )
 
+    pubchem_total = source_info["pubchem_total"]
+    if pubchem_total is not None:
+        state.record_pubchem_total(pubchem_total)
     state.next_chunk_id = chunk_index.next_chunk_id()
     counts = RunCounts(
         successful_rows=state.successful_rows,
@@ -236,20 +740,49 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
         other_failed_rows=state.other_failed_rows,
     )
 
-    target_rows = (
-        min(source_info["pubchem_total"], config.max_rows)
-        if config.max_rows is not None
-        else source_info["pubchem_total"]
-    )
+    target_rows = _target_rows(pubchem_total, config.max_rows)
     vocabulary_path = write_vocabulary(config.release_dir, classifier.vocabulary_payload())
     vector_widths = classifier.vector_widths()
+    compression = COMPRESSION_PROFILES[config.compression_profile]
+
+    # Parts of the next chunk that were committed before a crash are kept;
+    # everything else in staging and every unindexed output is dropped. A
+    # chunk whose parts were all committed was still being finalized, so the
+    # chunk after it may have committed parts as well.
+    resume_chunk = partial(
+        ChunkWriter.resume,
+        staging_dir=staging_dir,
+        completed_dir=config.completed_dir,
+        vector_widths=vector_widths,
+        rows_writer=config.rows_writer,
+        vector_writer=config.vector_writer,
+        compression=compression,
+    )
+    resumed_writers: List[ChunkWriter] = []
+    resume_row = state.next_row
+    while True:
+        resumed_writer = resume_chunk(
+            chunk_id=state.next_chunk_id + len(resumed_writers), first_row=resume_row
+        )
+        if resumed_writer is None:
+            break
+        resumed_writers.append(resumed_writer)
+        if resumed_writer.rows < config.chunk_rows:
+            break
+        resume_row = resumed_writer.parts[-1].next_row
+    cleanup_staging_dir(staging_dir, keep=[writer.chunk_dir for writer in resumed_writers])
+    cleanup_completed_dir(
+        config.completed_dir,
+        chunk_index,
+        keep=[name for writer in resumed_writers for name in writer.open_filenames()],
+    )
 
-    if state.next_row >= target_rows:
+    if pubchem_total is not None and target_rows is not None and state.next_row >= target_rows:
         print("state already covers {0} rows, refreshing manifest only".format(target_rows))
         manifest_path = build_release_manifest(
             release_dir=config.release_dir,
             chunk_index=chunk_index,
-            pubchem_total=source_info["pubchem_total"],
+            pubchem_total=pubchem_total,
             successful_rows=counts.successful_rows,
             parse_failed_rows=counts.parse_failed_rows,
             rdkit_failed_rows=counts.rdkit_failed_rows,
@@ -261,6 +794,7 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
             chunk_rows=config.chunk_rows,
             max_rows=config.max_rows,
             vector_widths=vector_widths,
+            compression=compression,
         )
         return {"manifest_path": manifest_path, "vocabulary_path": vocabulary_path}
 
@@ -269,182 +803,128 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
     current_offset = state.next_offset
     current_chunk_id = state.next_chunk_id
     rows_in_chunk = 0
-    chunk_first_row: Optional[int] = None
-    next_part_id = 1
 
     print(
         "starting at finalized chunk boundary row {0} using {1}".format(
-            current_row, config.materialized_input_path
+            current_row, input_path
         )
     )
-    with config.materialized_input_path.open("rb") as handle:
-        handle.seek(state.next_offset)
-        while current_row < target_rows:
-            tasks, batch_end_offset = _read_batch(
-                handle,
-                current_row=current_row,
-                checkpoint_rows=config.checkpoint_rows,
-                max_rows=config.max_rows,
+    chunk_writer: Optional[ChunkWriter] = None
+    with deferred_count, open_pubchem_input(input_path) as handle, _prep_executor(
+        config.prep_workers
+    ) as prep_executor, _ChunkFinalizer(
+        max_pending=config.max_pending_chunks,
+        chunk_index=chunk_index,
+        state=state,
+        state_path=state_path,
+    ) as finalizer, _StagePipeline() as stages:
+        for chunk_writer in resumed_writers:
+            last_part = chunk_writer.parts[-1]
+            current_row = last_part.next_row
+            current_offset = last_part.next_offset
+            rows_in_chunk = chunk_writer.rows
+            for part in chunk_writer.parts:
+                counts.successful_rows += part.successful_rows
+                counts.parse_failed_rows += part.parse_failed_rows
+                counts.rdkit_failed_rows += part.rdkit_failed_rows
+                counts.other_failed_rows += part.other_failed_rows
+            print(
+                "resuming chunk {0} after {1} committed parts at row {2}".format(
+                    current_chunk_id, len(chunk_writer.parts), current_row
+                )
             )
-            if not tasks:
-                break
-
-            records: List[Optional[Dict[str, object]]] = [None] * len(tasks)
-            prepared_rows = []
-            for task_index, (_row_index, cid, smiles) in enumerate(tasks):
-                try:
-                    prepared_rows.append(
-                        (task_index, classifier.prepare_record(cid=cid, smiles=smiles))
-                    )
-                except InvalidSmilesError as error:
-                    records[task_index] = _failure_record(
-                        cid,
-                        smiles,
-                        parse_failed=True,
-                        rdkit_failed=False,
-                        other_failure=False,
-                        error_message=str(error),
-                    )
-                    counts.parse_failed_rows += 1
-                except RdkitPipelineError as error:
-                    records[task_index] = _failure_record(
-                        cid,
-                        smiles,
-                        parse_failed=False,
-                        rdkit_failed=True,
-                        other_failure=False,
-                        error_message=str(error),
-                    )
-                    counts.rdkit_failed_rows += 1
-                except ClassificationRuntimeError as error:
-                    records[task_index] = _failure_record(
-                        cid,
-                        smiles,
-                        parse_failed=False,
-                        rdkit_failed=False,
-                        other_failure=True,
-                        error_message=str(error),
-                    )
-                    counts.other_failed_rows += 1
-                except Exception as error:  # noqa: BLE001
-                    records[task_index] = _failure_record(
-                        cid,
-                        smiles,
-                        parse_failed=False,
-                        rdkit_failed=False,
-                        other_failure=True,
-                        error_message=str(error),
-                    )
-                    counts.other_failed_rows += 1
-
-            for batch_start in range(0, len(prepared_rows), config.inference_batch_rows):
-                batch_items = prepared_rows[
-                    batch_start : batch_start + config.inference_batch_rows
-                ]
-                batch_prepared = [prepared_record for _, prepared_record in batch_items]
-                try:
-                    batch_records = classifier.classify_prepared_batch(batch_prepared)
-                    if len(batch_records) != len(batch_items):
-                        raise RuntimeError(
-                            "classifier returned {0} records for {1} prepared rows".format(
-                                len(batch_records), len(batch_items)
-                            )
-                        )
-                    for (task_index, _prepared_record), record in zip(
-                        batch_items, batch_records
-                    ):
-                        records[task_index] = record
-                        counts.successful_rows += 1
-                except Exception:
-                    for task_index, prepared_record in batch_items:
-                        try:
-                            records[task_index] = classifier.classify_prepared_record(
-                                prepared_record
-                            )
-                            counts.successful_rows += 1
-                        except ClassificationRuntimeError as error:
-                            records[task_index] = _failure_record(
-                                prepared_record.cid,
-                                prepared_record.smiles,
-                                parse_failed=False,
-                                rdkit_failed=False,
-                                other_failure=True,
-                                error_message=str(error),
-                            )
-                            counts.other_failed_rows += 1
-                        except Exception as error:  # noqa: BLE001
-                            records[task_index] = _failure_record(
-                                prepared_record.cid,
-                                prepared_record.smiles,
-                                parse_failed=False,
-                                rdkit_failed=False,
-                                other_failure=True,
-                                error_message=str(error),
-                            )
-                            counts.other_failed_rows += 1
-
-            finalized_records: List[Dict[str, object]] = []
-            for task_index, maybe_record in enumerate(records):
-                if maybe_record is None:
-                    _row_index, cid, smiles = tasks[task_index]
-                    resolved_record = _failure_record(
-                        cid,
-                        smiles,
-                        parse_failed=False,
-                        rdkit_failed=False,
-                        other_failure=True,
-                        error_message="missing classification result",
-                    )
-                    counts.other_failed_rows += 1
-                else:
-                    resolved_record = maybe_record
-                finalized_records.append(resolved_record)
-
-            if chunk_first_row is None:
-                chunk_first_row = tasks[0][0]
-            write_staging_part(
-                staging_dir=staging_dir,
-                chunk_id=current_chunk_id,
-                part_id=next_part_id,
-                records=finalized_records,
-                vector_widths=vector_widths,
+            if rows_in_chunk == config.chunk_rows:
+                # Every part was committed before the crash; only finalization is left.
+                current_chunk_id += 1
+                _submit_chunk(
+                    finalizer,
+                    chunk_writer,
+                    counts,
+                    next_row=current_row,
+                    next_offset=current_offset,
+                    next_chunk_id=current_chunk_id,
+                )
+                rows_in_chunk = 0
+                chunk_writer = None
+        handle.seek(current_offset)
+        read_queue: "Queue[object]" = Queue(maxsize=config.pipeline_queue_depth)
+        prep_queue: "Queue[object]" = Queue(maxsize=config.pipeline_queue_depth)
+        done_queue: "Queue[object]" = Queue(maxsize=config.pipeline_queue_depth)
+        stages.start(
+            "reader",
+            _read_stage,
+            stages,
+            handle,
+            read_queue,
+            current_row=current_row,
+            target_rows=target_rows,
+            checkpoint_rows=config.checkpoint_rows,
+            max_rows=config.max_rows,
+        )
+        stages.start(
+            "prep",
+            _prep_stage,
+            stages,
+            read_queue,
+            prep_queue,
+            executor=prep_executor,
+            prep_workers=config.prep_workers,
+            vector_widths=vector_widths,
+            downstream=config.inference_threads,
+        )
+        for thread_id in range(config.inference_threads):
+            stages.start(
+                "inference-{0}".format(thread_id),
+                _inference_stage,
+                stages,
+                prep_queue,
+                done_queue,
+                classifier=classifier,
+                inference_batch_rows=config.inference_batch_rows,
             )
-            next_part_id += 1
-            rows_in_chunk += len(finalized_records)
-            current_row += len(finalized_records)
-            current_offset = batch_end_offset
 
-            if rows_in_chunk == config.chunk_rows:
-                chunk_record = finalize_chunk(
-                    completed_dir=config.completed_dir,
+        for tasks, batch_end_offset, batch in stages.ordered(
+            done_queue, producers=config.inference_threads
+        ):
+            finalizer.commit_finished()
+            counts.successful_rows += batch.successful_rows
+            counts.parse_failed_rows += batch.parse_failed_rows
+            counts.rdkit_failed_rows += batch.rdkit_failed_rows
+            counts.other_failed_rows += batch.other_failed_rows
+
+            if chunk_writer is None:
+                chunk_writer = ChunkWriter(
                     staging_dir=staging_dir,
+                    completed_dir=config.completed_dir,
                     chunk_id=current_chunk_id,
-                    first_row=chunk_first_row if chunk_first_row is not None else 0,
-                    last_row=current_row - 1,
-                    row_count=rows_in_chunk,
                     vector_widths=vector_widths,
+                    rows_writer=config.rows_writer,
+                    vector_writer=config.vector_writer,
+                    compression=compression,
                 )
-                chunk_index.append(chunk_record)
+            chunk_writer.write(batch, first_row=tasks[0][0], next_offset=batch_end_offset)
+            rows_in_chunk += batch.rows
+            current_row += batch.rows
+            current_offset = batch_end_offset
+
+            if rows_in_chunk == config.chunk_rows:
                 current_chunk_id += 1
-                rows_in_chunk = 0
-                chunk_first_row = None
-                next_part_id = 1
-                state.update(
+                _submit_chunk(
+                    finalizer,
+                    chunk_writer,
+                    counts,
                     next_row=current_row,
                     next_offset=current_offset,
-                    successful_rows=counts.successful_rows,
-                    parse_failed_rows=counts.parse_failed_rows,
-                    rdkit_failed_rows=counts.rdkit_failed_rows,
-                    other_failed_rows=counts.other_failed_rows,
                     next_chunk_id=current_chunk_id,
                 )
-                state.save(state_path)
-                print(
-                    "finalized {0} at row {1}".format(
-                        chunk_record.filename, chunk_record.last_row
-                    )
-                )
+                rows_in_chunk = 0
+                chunk_writer = None
 
+            if pubchem_total is None:
+                pubchem_total = deferred_count.poll()
+                if pubchem_total is not None:
+                    state.record_pubchem_total(pubchem_total)
+                    target_rows = _target_rows(pubchem_total, config.max_rows)
             print(
                 _progress_line(
                     counts=counts,
@@ -454,48 +934,42 @@ def run_pipeline(config: RunConfig) -> Dict[str, object]:
                     next_chunk_id=current_chunk_id,
                     rows_in_chunk=rows_in_chunk,
                     chunk_rows=config.chunk_rows,
+                    vote_cache_hits=classifier.voter.cache_hits,
+                    vote_cache_misses=classifier.voter.cache_misses,
                 )
             )
 
-    if rows_in_chunk > 0:
-        chunk_record = finalize_chunk(
-            completed_dir=config.completed_dir,
-            staging_dir=staging_dir,
-            chunk_id=current_chunk_id,
-            first_row=chunk_first_row if chunk_first_row is not None else 0,
-            last_row=current_row - 1,
-            row_count=rows_in_chunk,
-            vector_widths=vector_widths,
-        )
-        chunk_index.append(chunk_record)
-        current_chunk_id += 1
-        state.update(
-            next_row=current_row,
-            next_offset=current_offset,
-            successful_rows=counts.successful_rows,
-            parse_failed_rows=counts.parse_failed_rows,
-            rdkit_failed_rows=counts.rdkit_failed_rows,
-            other_failed_rows=counts.other_failed_rows,
-            next_chunk_id=current_chunk_id,
-        )
-        state.save(state_path)
-        print("finalized trailing chunk {0}".format(chunk_record.filename))
+        if rows_in_chunk > 0 and chunk_writer is not None:
+            current_chunk_id += 1
+            _submit_chunk(
+                finalizer,
+                chunk_writer,
+                counts,
+                next_row=current_row,
+                next_offset=current_offset,
+                next_chunk_id=current_chunk_id,
+            )
+        if pubchem_total is None:
+            pubchem_total = deferred_count.wait()
+            state.record_pubchem_total(pubchem_total)
+            state.save(state_path)
 
     manifest_path = build_release_manifest(
         release_dir=config.release_dir,
         chunk_index=chunk_index,
-        pubchem_total=source_info["pubchem_total"],
+        pubchem_total=pubchem_total,
         successful_rows=counts.successful_rows,
         parse_failed_rows=counts.parse_failed_rows,
         rdkit_failed_rows=counts.rdkit_failed_rows,
         other_failed_rows=counts.other_failed_rows,
-        source_info=source_info,
+        source_info=deferred_count.source_info,
         weights_info=weights_info,
         vocabulary_path=vocabulary_path,
         checkpoint_rows=config.checkpoint_rows,
         chunk_rows=config.chunk_rows,
         max_rows=config.max_rows,
         vector_widths=vector_widths,
+        compression=compression,
     )
     print("release metadata ready at {0}".format(manifest_path))
     return {
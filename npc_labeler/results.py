@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, cast
+
+import numpy as np
+
+from npc_labeler.output import LABEL_COLUMN_NAMES, VECTOR_COLUMN_NAMES, VECTOR_DTYPE
+
+
+@dataclass
+class ClassificationBatch:
+    """Struct-of-arrays results for one checkpoint batch, in input order.
+
+    Label lists are stored Arrow-style as int32 offsets into uint16 values.
+    Rows that were not classified have null labels and NaN vector rows.
+    """
+
+    cids: np.ndarray
+    smiles: List[str]
+    classified: np.ndarray
+    isglycoside: np.ndarray
+    parse_failed: np.ndarray
+    rdkit_failed: np.ndarray
+    other_failure: np.ndarray
+    error_messages: List[Optional[str]]
+    label_offsets: Dict[str, np.ndarray]
+    label_values: Dict[str, np.ndarray]
+    vectors: Dict[str, np.ndarray]
+
+    @property
+    def rows(self) -> int:
+        return len(self.cids)
+
+    @property
+    def successful_rows(self) -> int:
+        return int(self.classified.sum())
+
+    @property
+    def parse_failed_rows(self) -> int:
+        return int(self.parse_failed.sum())
+
+    @property
+    def rdkit_failed_rows(self) -> int:
+        return int(self.rdkit_failed.sum())
+
+    @property
+    def other_failed_rows(self) -> int:
+        return int(self.other_failure.sum())
+
+    def labels(self, column: str, row: int) -> Optional[List[int]]:
+        if not self.classified[row]:
+            return None
+        offsets = self.label_offsets[column]
+        return self.label_values[column][offsets[row] : offsets[row + 1]].tolist()
+
+    @classmethod
+    def from_records(
+        cls, records: Sequence[Dict[str, object]], vector_widths: Dict[str, int]
+    ) -> "ClassificationBatch":
+        """Build a batch from per-row dicts shaped like NPClassifier records."""
+        builder = ClassificationBatchBuilder(len(records), vector_widths)
+        for row, record in enumerate(records):
+            cid = cast(int, record["cid"])
+            smiles = cast(str, record["smiles"])
+            if record.get("pathway_ids") is None:
+                builder.set_failure(
+                    row,
+                    cid,
+                    smiles,
+                    parse_failed=bool(record.get("parse_failed")),
+                    rdkit_failed=bool(record.get("rdkit_failed")),
+                    other_failure=bool(record.get("other_failure")),
+                    error_message=cast(Optional[str], record.get("error_message")),
+                )
+                continue
+            builder.set_classified(
+                [row],
+                [cid],
+                [smiles],
+                [bool(record["isglycoside"])],
+                [[cast(List[int], record[column]) for column in LABEL_COLUMN_NAMES]],
+                {
+                    column: np.asarray([record[column]], dtype=np.float32)
+                    for column in VECTOR_COLUMN_NAMES
+                },
+            )
+        return builder.build()
+
+
+class ClassificationBatchBuilder:
+    """Collects the rows of one ClassificationBatch in any order."""
+
+    def __init__(self, rows: int, vector_widths: Dict[str, int]) -> None:
+        self.cids = np.zeros((rows,), dtype=np.int64)
+        self.smiles: List[str] = [""] * rows
+        self.assigned = np.zeros((rows,), dtype=np.bool_)
+        self.classified = np.zeros((rows,), dtype=np.bool_)
+        self.isglycoside = np.zeros((rows,), dtype=np.bool_)
+        self.parse_failed = np.zeros((rows,), dtype=np.bool_)
+        self.rdkit_failed = np.zeros((rows,), dtype=np.bool_)
+        self.other_failure = np.zeros((rows,), dtype=np.bool_)
+        self.error_messages: List[Optional[str]] = [None] * rows
+        self.labels: Dict[str, List[Sequence[int]]] = {
+            column: [()] * rows for column in LABEL_COLUMN_NAMES
+        }
+        self.vectors = {
+            column: np.full((rows, vector_widths[column]), np.nan, dtype=VECTOR_DTYPE)
+            for column in VECTOR_COLUMN_NAMES
+        }
+
+    def unassigned_rows(self) -> List[int]:
+        return np.flatnonzero(~self.assigned).tolist()
+
+    def set_failure(
+        self,
+        row: int,
+        cid: int,
+        smiles: str,
+        *,
+        parse_failed: bool,
+        rdkit_failed: bool,
+        other_failure: bool,
+        error_message: Optional[str],
+    ) -> None:
+        self.cids[row] = cid
+        self.smiles[row] = smiles
+        self.assigned[row] = True
+        self.classified[row] = False
+        self.isglycoside[row] = False
+        self.parse_failed[row] = parse_failed
+        self.rdkit_failed[row] = rdkit_failed
+        self.other_failure[row] = other_failure
+        self.error_messages[row] = error_message
+        for column in LABEL_COLUMN_NAMES:
+            self.labels[column][row] = ()
+        for matrix in self.vectors.values():
+            matrix[row] = np.nan
+
+    def set_classified(
+        self,
+        rows: Sequence[int],
+        cids: Iterable[int],
+        smiles: Iterable[str],
+        isglycoside: Iterable[bool],
+        label_ids: Iterable[Sequence[Sequence[int]]],
+        vectors: Dict[str, np.ndarray],
+    ) -> None:
+        """Store classified rows; ``label_ids`` holds (pathway, superclass, class) ids."""
+        index = np.asarray(rows, dtype=np.intp)
+        self.cids[index] = np.fromiter(cids, dtype=np.int64, count=len(index))
+        for row, row_smiles, row_labels in zip(rows, smiles, label_ids):
+            self.smiles[row] = row_smiles
+            for column, ids in zip(LABEL_COLUMN_NAMES, row_labels):
+                self.labels[column][row] = ids
+            self.error_messages[row] = None
+        self.assigned[index] = True
+        self.classified[index] = True
+        self.isglycoside[index] = np.fromiter(isglycoside, dtype=np.bool_, count=len(index))
+        self.parse_failed[index] = False
+        self.rdkit_failed[index] = False
+        self.other_failure[index] = False
+        for column, matrix in self.vectors.items():
+            # Assignment rounds float32 to float16 exactly like astype().
+            matrix[index] = vectors[column]
+
+    def build(self) -> ClassificationBatch:
+        if not self.assigned.all():
+            raise ValueError(
+                "{0} rows were never assigned a result".format(int((~self.assigned).sum()))
+            )
+        label_offsets = {}
+        label_values = {}
+        for column in LABEL_COLUMN_NAMES:
+            lists = self.labels[column]
+            offsets = np.zeros((len(lists) + 1,), dtype=np.int32)
+            np.cumsum([len(ids) for ids in lists], out=offsets[1:])
+            label_offsets[column] = offsets
+            label_values[column] = np.fromiter(
+                (label for ids in lists for label in ids),
+                dtype=np.uint16,
+                count=int(offsets[-1]),
+            )
+        return ClassificationBatch(
+            cids=self.cids,
+            smiles=self.smiles,
+            classified=self.classified,
+            isglycoside=self.isglycoside,
+            parse_failed=self.parse_failed,
+            rdkit_failed=self.rdkit_failed,
+            other_failure=self.other_failure,
+            error_messages=self.error_messages,
+            label_offsets=label_offsets,
+            label_values=label_values,
+            vectors=self.vectors,
+        )
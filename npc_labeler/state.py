@@ -20,7 +20,8 @@ class RunState:
     updated_at: str
     input_path: str
     materialized_input_path: str
-    pubchem_total: int
+    # None while a deferred row count is still running.
+    pubchem_total: Optional[int]
     checkpoint_rows: int
     chunk_rows: int
     max_rows: Optional[int]
@@ -31,6 +32,10 @@ class RunState:
     rdkit_failed_rows: int
     other_failed_rows: int
     next_chunk_id: int
+    # Size and mtime of the PubChem source, so a resume can tell the input changed
+    # even while pubchem_total is unknown. None in states written before they were kept.
+    source_bytes: Optional[int] = None
+    source_mtime_ns: Optional[int] = None
 
     @property
     def processed_rows(self) -> int:
@@ -50,10 +55,12 @@ class RunState:
         cls,
         input_path: Path,
         materialized_input_path: Path,
-        pubchem_total: int,
+        pubchem_total: Optional[int],
         checkpoint_rows: int,
         chunk_rows: int,
         max_rows: Optional[int],
+        source_bytes: Optional[int] = None,
+        source_mtime_ns: Optional[int] = None,
     ) -> "RunState":
         now = utc_now()
         return cls(
@@ -73,6 +80,8 @@ class RunState:
             rdkit_failed_rows=0,
             other_failed_rows=0,
             next_chunk_id=1,
+            source_bytes=source_bytes,
+            source_mtime_ns=source_mtime_ns,
         )
 
     def update(
@@ -112,10 +121,12 @@ class RunState:
         *,
         input_path: Path,
         materialized_input_path: Path,
-        pubchem_total: int,
+        pubchem_total: Optional[int],
         checkpoint_rows: int,
         chunk_rows: int,
         max_rows: Optional[int],
+        source_bytes: Optional[int] = None,
+        source_mtime_ns: Optional[int] = None,
     ) -> None:
         mismatches = []
         if self.version != STATE_VERSION:
@@ -126,8 +137,16 @@ class RunState:
             mismatches.append("input path changed")
         if self.materialized_input_path != str(materialized_input_path):
             mismatches.append("materialized input path changed")
-        if self.pubchem_total != pubchem_total:
+        if (
+            self.pubchem_total is not None
+            and pubchem_total is not None
+            and self.pubchem_total != pubchem_total
+        ):
             mismatches.append("PubChem total changed")
+        if self.source_bytes is not None and (
+            self.source_bytes != source_bytes or self.source_mtime_ns != source_mtime_ns
+        ):
+            mismatches.append("PubChem input changed (size or modification time)")
         if self.checkpoint_rows != checkpoint_rows:
             mismatches.append("checkpoint_rows changed")
         if self.chunk_rows != chunk_rows:
@@ -136,3 +155,12 @@ class RunState:
             mismatches.append("max_rows changed")
         if mismatches:
             raise ValueError("; ".join(mismatches))
+
+    def record_pubchem_total(self, pubchem_total: int) -> None:
+        if self.pubchem_total is not None and self.pubchem_total != pubchem_total:
+            raise ValueError(
+                "PubChem total changed: state has {0}, input has {1}".format(
+                    self.pubchem_total, pubchem_total
+                )
+            )
+        self.pubchem_total = pubchem_total
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_BLOCK_BYTES = 4 * 1024 * 1024
+# Longest all-digit CID parsed without Python's int(); 10**18 still fits in int64.
+MAX_FAST_CID_DIGITS = 18
+# One uint64 per 4096 rows keeps the PubChem row index under 300 KB.
+ROW_INDEX_STRIDE = 4096
+ROW_INDEX_SKIP_BLOCK_BYTES = 256 * 1024
+_ROW_INDEX_MAGIC = b"NPCROWS1"
+
+_NEWLINE = ord("\n")
+_TAB = ord("\t")
+_ZERO = ord("0")
+
+
+def parse_pubchem_line(raw_line: str) -> Optional[Tuple[int, str]]:
+    parts = raw_line.rstrip("\n").split("\t", 1)
+    if len(parts) != 2:
+        return None
+    cid_text, smiles = parts
+    try:
+        cid = int(cid_text)
+    except ValueError:
+        return None
+    return cid, smiles.strip()
+
+
+@dataclass
+class TsvBatch:
+    """Parsed rows for one read, plus the offset just past the last line consumed."""
+
+    cids: np.ndarray
+    smiles: List[str]
+    end_offset: int
+
+    @property
+    def rows(self) -> int:
+        return len(self.cids)
+
+
+@dataclass
+class _ParsedBlock:
+    line_ends: np.ndarray
+    row_lines: np.ndarray
+    cids: np.ndarray
+    smiles: List[str]
+
+
+@dataclass
+class _LineScan:
+    buffer: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+    tab_at: np.ndarray
+    has_tab: np.ndarray
+    fast: np.ndarray
+    cids: np.ndarray
+
+    @property
+    def consumed(self) -> int:
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def slow_lines(self) -> List[int]:
+        return np.flatnonzero(self.has_tab & ~self.fast).tolist()
+
+    def decode_line(self, data: bytes, line: int) -> str:
+        return data[self.starts[line] : self.ends[line]].decode("utf-8", errors="replace")
+
+
+def _scan_lines(data: bytes, *, final: bool) -> _LineScan:
+    """Find every complete line in ``data``, its first tab and its CID when that is easy.
+
+    ``fast`` marks lines whose CID column is 1 to 18 ASCII digits; their CIDs
+    are filled in. Other lines that have a tab still need ``parse_pubchem_line``
+    to match the line-at-a-time reader exactly.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buffer == _NEWLINE) + 1
+    if final and len(data) and (len(ends) == 0 or ends[-1] != len(data)):
+        ends = np.append(ends, len(data))
+    consumed = int(ends[-1]) if len(ends) else 0
+    starts = np.zeros_like(ends)
+    starts[1:] = ends[:-1]
+
+    tabs = np.flatnonzero(buffer[:consumed] == _TAB)
+    tab_index = np.searchsorted(tabs, starts)
+    if len(tabs):
+        tab_at = tabs[np.minimum(tab_index, len(tabs) - 1)]
+    else:
+        tab_at = np.zeros_like(ends)
+    has_tab = (tab_index < len(tabs)) & (tab_at < ends)
+
+    widths = tab_at - starts
+    fast = has_tab & (widths >= 1) & (widths <= MAX_FAST_CID_DIGITS)
+    cids = np.zeros(len(ends), dtype=np.int64)
+    scale = np.ones(len(ends), dtype=np.int64)
+    for digit in range(int(widths[fast].max()) if fast.any() else 0):
+        active = fast & (widths > digit)
+        values = buffer[np.where(active, tab_at - 1 - digit, 0)].astype(np.int64) - _ZERO
+        fast &= ~active | ((values >= 0) & (values <= 9))
+        cids += np.where(active, values, 0) * scale
+        scale *= 10
+    return _LineScan(buffer, starts, ends, tab_at, has_tab, fast, cids)
+
+
+def _parse_block(data: bytes, base_offset: int, *, final: bool) -> Tuple[_ParsedBlock, int]:
+    """Parse the complete lines in ``data``; returns the block and the bytes consumed."""
+    scan = _scan_lines(data, final=final)
+    buffer, ends, tab_at, cids = scan.buffer, scan.ends, scan.tab_at, scan.cids
+    consumed = scan.consumed
+
+    accepted = scan.fast.copy()
+    fallback: Dict[int, str] = {}
+    for line in scan.slow_lines():
+        parsed = parse_pubchem_line(scan.decode_line(data, line))
+        if parsed is None:
+            continue
+        cids[line], fallback[line] = parsed
+        accepted[line] = True
+
+    row_lines = np.flatnonzero(accepted)
+    smiles_starts = (tab_at[row_lines] + 1).tolist()
+    smiles_ends = (ends[row_lines] - (buffer[ends[row_lines] - 1] == _NEWLINE)).tolist()
+    if buffer[:consumed].max(initial=0) < 0x80:
+        text = data[:consumed].decode("ascii")
+        smiles = [text[start:end].strip() for start, end in zip(smiles_starts, smiles_ends)]
+    else:
+        smiles = [
+            data[start:end].decode("utf-8", errors="replace").strip()
+            for start, end in zip(smiles_starts, smiles_ends)
+        ]
+    if fallback:
+        for position, line in enumerate(row_lines.tolist()):
+            if line in fallback:
+                smiles[position] = fallback[line]
+
+    block = _ParsedBlock(
+        line_ends=ends.astype(np.int64) + base_offset,
+        row_lines=row_lines,
+        cids=cids[row_lines],
+        smiles=smiles,
+    )
+    return block, consumed
+
+
+class PubchemTsvReader:
+    """Block reader for the materialized ``CID<TAB>SMILES`` input.
+
+    Reads ``block_bytes`` at a time from a binary handle positioned at a line
+    boundary, and finds line boundaries, the tab column and the CIDs with
+    NumPy. The handle runs ahead of the rows returned, so resume offsets come
+    from ``TsvBatch.end_offset`` rather than ``handle.tell()``.
+    """
+
+    def __init__(self, handle, *, block_bytes: int = DEFAULT_BLOCK_BYTES) -> None:
+        if block_bytes <= 0:
+            raise ValueError("block_bytes must be positive")
+        self.handle = handle
+        self.block_bytes = block_bytes
+        self.offset = handle.tell()
+        self._carry = b""
+        self._carry_offset = self.offset
+        self._eof = False
+        self._block: Optional[_ParsedBlock] = None
+        self._next_row = 0
+
+    def _fill(self) -> bool:
+        while not self._eof:
+            data = self.handle.read(self.block_bytes)
+            if not data:
+                self._eof = True
+            payload = self._carry + data if self._carry else data
+            block, consumed = _parse_block(payload, self._carry_offset, final=self._eof)
+            self._carry = payload[consumed:]
+            self._carry_offset += consumed
+            if len(block.line_ends):
+                self._block = block
+                self._next_row = 0
+                return True
+        return False
+
+    def read(self, max_rows: int) -> TsvBatch:
+        """Return up to ``max_rows`` parsed rows; fewer only at end of input.
+
+        Unparseable lines before the last returned row are consumed with it,
+        as are trailing ones once the input is exhausted.
+        """
+        cid_parts: List[np.ndarray] = []
+        smiles: List[str] = []
+        taken = 0
+        while taken < max_rows:
+            block = self._block
+            if block is None:
+                if not self._fill():
+                    break
+                continue
+            stop = min(len(block.row_lines), self._next_row + max_rows - taken)
+            if stop > self._next_row:
+                cid_parts.append(block.cids[self._next_row : stop])
+                smiles.extend(block.smiles[self._next_row : stop])
+                taken += stop - self._next_row
+                self._next_row = stop
+                self.offset = int(block.line_ends[block.row_lines[stop - 1]])
+            if self._next_row == len(block.row_lines) and taken < max_rows:
+                self.offset = int(block.line_ends[-1])
+                self._block = None
+        cids = np.concatenate(cid_parts) if cid_parts else np.zeros((0,), dtype=np.int64)
+        return TsvBatch(cids=cids, smiles=smiles, end_offset=self.offset)
+
+
+class PubchemRowCounter:
+    """Counts the rows ``PubchemTsvReader`` would accept, fed arbitrary byte blocks.
+
+    Also records where every ``stride``-th row starts, for ``RowOffsetIndex``.
+
+        counter = PubchemRowCounter()
+        for block in blocks:
+            counter.update(block)
+        total = counter.finish()
+        counter.row_index().save(path)
+    """
+
+    def __init__(self, *, stride: int = ROW_INDEX_STRIDE) -> None:
+        if stride <= 0:
+            raise ValueError("stride must be positive")
+        self.stride = stride
+        self.rows = 0
+        self.offset = 0
+        self._carry = b""
+        self._offsets: List[np.ndarray] = []
+
+    def _count(self, data: bytes, *, final: bool) -> int:
+        scan = _scan_lines(data, final=final)
+        accepted = scan.fast.copy()
+        for line in scan.slow_lines():
+            if parse_pubchem_line(scan.decode_line(data, line)) is not None:
+                accepted[line] = True
+        row_lines = np.flatnonzero(accepted)
+        first = -self.rows % self.stride
+        if first < len(row_lines):
+            starts = scan.starts[row_lines[first :: self.stride]]
+            self._offsets.append(starts.astype(np.uint64) + np.uint64(self.offset))
+        self.rows += len(row_lines)
+        self.offset += scan.consumed
+        return scan.consumed
+
+    def update(self, data: bytes) -> None:
+        payload = self._carry + data if self._carry else data
+        consumed = self._count(payload, final=False)
+        self._carry = payload[consumed:]
+
+    def finish(self) -> int:
+        if self._carry:
+            self._count(self._carry, final=True)
+            self._carry = b""
+        return self.rows
+
+    def row_index(self) -> "RowOffsetIndex":
+        self.finish()
+        offsets = (
+            np.concatenate(self._offsets) if self._offsets else np.zeros((0,), dtype=np.uint64)
+        )
+        return RowOffsetIndex(
+            stride=self.stride, rows=self.rows, end_offset=self.offset, offsets=offsets
+        )
+
+
+@dataclass
+class RowOffsetIndex:
+    """Byte offsets of every ``stride``-th row of a PubChem TSV stream.
+
+    ``offsets[i]`` is where the line holding row ``i * stride`` starts, so a
+    reader seeked there returns that row first. Offsets are positions in the
+    uncompressed stream and hold for the materialized copy and the indexed
+    gzip alike.
+    """
+
+    stride: int
+    rows: int
+    end_offset: int
+    offsets: np.ndarray
+
+    def checkpoint(self, row: int) -> Tuple[int, int]:
+        """Return ``(checkpoint_row, offset)`` for the nearest row at or before ``row``."""
+        if not 0 <= row <= self.rows:
+            raise IndexError("row {0} is outside 0..{1}".format(row, self.rows))
+        if row == self.rows:
+            return row, self.end_offset
+        entry = row // self.stride
+        return entry * self.stride, int(self.offsets[entry])
+
+    def offset_of(self, handle, row: int) -> int:
+        """Return the offset to seek to so the next row read is ``row``.
+
+        Reads at most ``stride - 1`` rows from ``handle`` past the checkpoint.
+        """
+        checkpoint_row, offset = self.checkpoint(row)
+        if checkpoint_row == row:
+            return offset
+        handle.seek(offset)
+        reader = PubchemTsvReader(handle, block_bytes=ROW_INDEX_SKIP_BLOCK_BYTES)
+        return reader.read(row - checkpoint_row).end_offset
+
+    def save(self, path: Path) -> None:
+        header = np.array([self.stride, self.rows, self.end_offset], dtype="<u8")
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with tmp_path.open("wb") as handle:
+            handle.write(_ROW_INDEX_MAGIC)
+            handle.write(header.tobytes())
+            handle.write(self.offsets.astype("<u8").tobytes())
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "RowOffsetIndex":
+        payload = path.read_bytes()
+        header_bytes = len(_ROW_INDEX_MAGIC) + 24
+        if payload[: len(_ROW_INDEX_MAGIC)] != _ROW_INDEX_MAGIC or len(payload) < header_bytes:
+            raise ValueError("{0} is not a row offset index".format(path))
+        stride, rows, end_offset = np.frombuffer(
+            payload, dtype="<u8", count=3, offset=len(_ROW_INDEX_MAGIC)
+        ).tolist()
+        offsets = np.frombuffer(payload, dtype="<u8", offset=header_bytes)
+        if stride == 0 or len(offsets) != -(-rows // stride):
+            raise ValueError(
+                "{0} has {1} offsets for {2} rows at stride {3}".format(
+                    path, len(offsets), rows, stride
+                )
+            )
+        return cls(stride=stride, rows=rows, end_offset=end_offset, offsets=offsets)
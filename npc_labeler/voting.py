@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import itertools
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, List, Mapping, Optional, Sequence, Tuple, Union, cast
+
+import numpy as np
+
+THRESHOLDS = {"SUPERCLASS": 0.3, "CLASS": 0.1, "PATHWAY": 0.5}
+
+VotedIds = Tuple[List[int], List[int], List[int]]
+# A voted row, or the message of the error the legacy voting raised for it.
+VoteOutcome = Union[VotedIds, str]
+
+DEFAULT_VOTE_CACHE_SIZE = 65536
+# Cached under a bare signature whose outcome also depends on the argmaxes.
+_NEEDS_ARGMAX = object()
+
+
+def _incidence(
+    hierarchy: Mapping[str, Mapping[str, List[int]]], field: str, rows: int, columns: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    matrix = np.zeros((rows, columns), dtype=np.float32)
+    missing = np.ones((rows,), dtype=np.bool_)
+    for key, entry in hierarchy.items():
+        index = int(key)
+        if 0 <= index < rows:
+            matrix[index, entry[field]] = 1.0
+            missing[index] = False
+    return matrix, missing
+
+
+def _any_product(mask: np.ndarray, incidence: np.ndarray) -> np.ndarray:
+    return (mask.astype(np.float32) @ incidence) > 0.0
+
+
+def _copy_outcome(outcome: VoteOutcome) -> VoteOutcome:
+    if isinstance(outcome, str):
+        return outcome
+    return (list(outcome[0]), list(outcome[1]), list(outcome[2]))
+
+
+def _row_lists(mask: np.ndarray) -> List[List[int]]:
+    flat = np.nonzero(mask)[1].tolist()
+    output = []
+    start = 0
+    for count in mask.sum(axis=1).tolist():
+        output.append(flat[start : start + count])
+        start += count
+    return output
+
+
+class BatchVoter:
+    """prediction_voting.vote_classification applied to whole score matrices.
+
+    Class_hierarchy and Super_hierarchy are compiled into incidence matrices
+    once, and the thresholds and voting branches run as boolean matrix
+    algebra over the batch. Only the emission of each row's id lists stays in
+    Python, in exactly the order the legacy function emits labels.
+
+    Outcomes are memoized in a bounded LRU keyed by each row's packed
+    threshold masks, plus the score argmaxes for the few branches that read
+    them, so repeated signatures skip the voting logic entirely.
+    """
+
+    def __init__(
+        self, ontology: Mapping[str, object], cache_size: int = DEFAULT_VOTE_CACHE_SIZE
+    ) -> None:
+        pathways = cast(Dict[str, int], ontology["Pathway"])
+        superclasses = cast(Dict[str, int], ontology["Superclass"])
+        classes = cast(Dict[str, int], ontology["Class"])
+        super_hierarchy = cast(Dict[str, Dict[str, List[int]]], ontology["Super_hierarchy"])
+        class_hierarchy = cast(Dict[str, Dict[str, List[int]]], ontology["Class_hierarchy"])
+
+        # The legacy voting works on label positions and emits the labels at
+        # those positions; these map a position to the label's ontology id.
+        self.pathway_ids = list(pathways.values())
+        self.superclass_ids = list(superclasses.values())
+        self.class_ids = list(classes.values())
+
+        self.super_pathways, self.missing_superclasses = _incidence(
+            super_hierarchy, "Pathway", len(superclasses), len(pathways)
+        )
+        self.class_pathways, self.missing_classes = _incidence(
+            class_hierarchy, "Pathway", len(classes), len(pathways)
+        )
+        self.class_superclasses, _ = _incidence(
+            class_hierarchy, "Superclass", len(classes), len(superclasses)
+        )
+        self.pathway_supers = np.ascontiguousarray(self.super_pathways.T)
+        self.pathway_classes = np.ascontiguousarray(self.class_pathways.T)
+        self.super_classes = np.ascontiguousarray(self.class_superclasses.T)
+
+        superclass_lists = [
+            list(class_hierarchy[str(index)]["Superclass"])
+            if str(index) in class_hierarchy
+            else []
+            for index in range(len(classes))
+        ]
+
+        @lru_cache(maxsize=65536)
+        def chained_superclasses(class_positions: Tuple[int, ...]) -> List[int]:
+            # Rebuilt the legacy way so the output keeps CPython's set order.
+            return list(
+                set(itertools.chain.from_iterable(superclass_lists[c] for c in class_positions))
+            )
+
+        self._chained_superclasses = chained_superclasses
+
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def vote(
+        self, pred_super: np.ndarray, pred_class: np.ndarray, pred_path: np.ndarray
+    ) -> List[VoteOutcome]:
+        path_hits = pred_path >= THRESHOLDS["PATHWAY"]
+        super_hits = pred_super >= THRESHOLDS["SUPERCLASS"]
+        class_hits = pred_class >= THRESHOLDS["CLASS"]
+        if self.cache_size <= 0:
+            return self._vote(pred_super, pred_class, path_hits, super_hits, class_hits)[0]
+
+        signatures = np.packbits(np.hstack([path_hits, super_hits, class_hits]), axis=1)
+        argmax_supers = pred_super.argmax(axis=1).tolist()
+        argmax_classes = pred_class.argmax(axis=1).tolist()
+        outcomes: List[Optional[VoteOutcome]] = [None] * len(signatures)
+        misses = []
+        with self._cache_lock:
+            for row in range(len(signatures)):
+                key: Hashable = signatures[row].tobytes()
+                cached = self._cache.get(key)
+                if cached is _NEEDS_ARGMAX:
+                    self._cache.move_to_end(key)
+                    key = (key, argmax_supers[row], argmax_classes[row])
+                    cached = self._cache.get(key)
+                if cached is None:
+                    misses.append(row)
+                    continue
+                self._cache.move_to_end(key)
+                outcomes[row] = _copy_outcome(cast(VoteOutcome, cached))
+            self.cache_hits += len(signatures) - len(misses)
+            self.cache_misses += len(misses)
+
+        if misses:
+            index = np.asarray(misses)
+            fresh, needs_argmax = self._vote(
+                pred_super[index],
+                pred_class[index],
+                path_hits[index],
+                super_hits[index],
+                class_hits[index],
+            )
+            with self._cache_lock:
+                for position, row in enumerate(misses):
+                    key = signatures[row].tobytes()
+                    if needs_argmax[position]:
+                        self._remember(key, _NEEDS_ARGMAX)
+                        key = (key, argmax_supers[row], argmax_classes[row])
+                    self._remember(key, fresh[position])
+                    outcomes[row] = _copy_outcome(fresh[position])
+        return cast(List[VoteOutcome], outcomes)
+
+    def _remember(self, key: Hashable, value: object) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _vote(
+        self,
+        pred_super: np.ndarray,
+        pred_class: np.ndarray,
+        path_hits: np.ndarray,
+        super_hits: np.ndarray,
+        class_hits: np.ndarray,
+    ) -> Tuple[List[VoteOutcome], List[bool]]:
+        from_super = _any_product(super_hits, self.super_pathways)
+        from_class = _any_product(class_hits, self.class_pathways)
+        votes = path_hits.astype(np.int8) + from_class + from_super
+        path = votes == 3
+        path = np.where(path.any(axis=1, keepdims=True), path, votes == 2)
+        has_path = path.any(axis=1)
+
+        super_on_path = _any_product(path, self.pathway_supers) & super_hits
+        class_on_path = _any_product(path, self.pathway_classes) & class_hits
+        class_under_super = _any_product(super_on_path, self.super_classes) & class_hits
+        supers_on_path = super_on_path.sum(axis=1)
+
+        # Rows that take a branch other than "keep the classes on the voted
+        # pathways and rebuild the superclasses from them".
+        voted_by_super = (path_hits & path).any(axis=1) & (path & from_super).any(axis=1)
+        single_super = voted_by_super & (supers_on_path == 1)
+        argmax_fallback = voted_by_super & (supers_on_path > 1) & ~class_on_path.any(axis=1)
+
+        missing_super = super_hits & self.missing_superclasses
+        missing_class = class_hits & self.missing_classes
+        failed = missing_super.any(axis=1) | missing_class.any(axis=1)
+
+        path_lists = _row_lists(path)
+        path_hit_lists = _row_lists(path_hits)
+        super_on_path_lists = _row_lists(super_on_path)
+        class_on_path_lists = _row_lists(class_on_path)
+        class_under_super_lists = _row_lists(class_under_super)
+        argmax_supers = pred_super.argmax(axis=1).tolist()
+        argmax_classes = pred_class.argmax(axis=1).tolist()
+
+        outcomes: List[VoteOutcome] = []
+        needs_argmax = [False] * len(path_lists)
+        for row in range(len(path_lists)):
+            if failed[row]:
+                # The legacy hierarchy lookups raise KeyError(str(position)),
+                # superclasses first, each in ascending order.
+                missing = np.flatnonzero(
+                    missing_super[row] if missing_super[row].any() else missing_class[row]
+                )
+                outcomes.append(repr(str(missing[0])))
+                continue
+            if not has_path[row]:
+                outcomes.append((self._ids(self.pathway_ids, path_hit_lists[row]), [], []))
+                continue
+
+            pathway_positions = path_lists[row]
+            argmax_class = argmax_classes[row]
+            uses_argmax_class = (
+                single_super[row] and not class_under_super_lists[row]
+            ) or (argmax_fallback[row] and len(pathway_positions) == 1)
+            needs_argmax[row] = bool(uses_argmax_class)
+            if uses_argmax_class and self.missing_classes[argmax_class]:
+                outcomes.append(repr(str(argmax_class)))
+                continue
+            if single_super[row]:
+                superclass_positions = super_on_path_lists[row]
+                class_positions = class_under_super_lists[row]
+                if not class_positions and self.class_superclasses[
+                    argmax_class, superclass_positions[0]
+                ]:
+                    class_positions = [argmax_class]
+            elif argmax_fallback[row]:
+                if len(pathway_positions) == 1:
+                    superclass_positions = [argmax_supers[row]]
+                    class_positions = (
+                        [argmax_class]
+                        if self.class_superclasses[argmax_class, argmax_supers[row]]
+                        else []
+                    )
+                else:
+                    superclass_positions = super_on_path_lists[row]
+                    class_positions = []
+            else:
+                class_positions = class_on_path_lists[row]
+                superclass_positions = self._chained_superclasses(tuple(class_positions))
+
+            outcomes.append(
+                (
+                    self._ids(self.pathway_ids, pathway_positions),
+                    self._ids(self.superclass_ids, superclass_positions),
+                    self._ids(self.class_ids, class_positions),
+                )
+            )
+        return outcomes, needs_argmax
+
+    @staticmethod
+    def _ids(ids: Sequence[int], positions: List[int]) -> List[int]:
+        return [ids[position] for position in positions]
@@ -0,0 +1,323 @@
+import gzip
+import http.server
+import random
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+from unittest import mock
+
+import requests
+
+from npc_labeler import downloads
+from npc_labeler.downloads import (
+    download_file,
+    ensure_pubchem_input,
+    gzip_index_path,
+    load_row_index,
+    open_pubchem_input,
+    row_index_path,
+)
+from npc_labeler.tsv import ROW_INDEX_STRIDE, PubchemTsvReader
+
+
+def _write_input(path: Path, rows: int) -> bytes:
+    payload = b"".join(b"%d\tC%s\n" % (cid, b"C" * (cid % 7)) for cid in range(1, rows + 1))
+    payload += b"not a row\n"
+    with gzip.open(path, "wb") as handle:
+        handle.write(payload)
+    return payload
+
+
+class _StandInServer(http.server.ThreadingHTTPServer):
+    payload = b""
+    ranges = True
+    drops = 0
+    status_failures = 0
+    missing = False
+    etag: Optional[str] = '"v1"'
+    last_modified: Optional[str] = None
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.lock = threading.Lock()
+        self.range_headers: List[Optional[str]] = []
+        self.if_range_headers: List[Optional[str]] = []
+        self.sent_bytes = 0
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{0}/CID-SMILES.gz".format(self.server_address[1])
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    server: _StandInServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self._respond(body=False)
+
+    def do_GET(self) -> None:
+        self._respond(body=True)
+
+    def _respond(self, *, body: bool) -> None:
+        server = self.server
+        payload = server.payload
+        if server.missing:
+            self.send_error(404)
+            return
+        with server.lock:
+            fail = body and server.status_failures > 0
+            drop = body and not fail and server.drops > 0
+            server.status_failures -= fail
+            server.drops -= drop
+            if body:
+                server.range_headers.append(self.headers.get("Range"))
+                server.if_range_headers.append(self.headers.get("If-Range"))
+        if fail:
+            self.send_error(503)
+            return
+        start, end, status = 0, len(payload), 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        # If-Range only matches a strong ETag or the exact Last-Modified date.
+        strong_etag = server.etag if server.etag and not server.etag.startswith("W/") else None
+        if if_range is not None and if_range not in (strong_etag, server.last_modified):
+            range_header = None
+        if server.ranges and range_header is not None:
+            first, last = range_header[len("bytes=") :].split("-")
+            start, end, status = int(first), int(last) + 1 if last else len(payload), 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if server.etag is not None:
+            self.send_header("ETag", server.etag)
+        if server.last_modified is not None:
+            self.send_header("Last-Modified", server.last_modified)
+        if status == 206:
+            self.send_header(
+                "Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, len(payload))
+            )
+        self.end_headers()
+        if not body:
+            return
+        chunk = payload[start:end]
+        if drop:
+            # Promise the whole range but hang up halfway through it.
+            chunk = chunk[: len(chunk) // 2]
+            self.close_connection = True
+        self.wfile.write(chunk)
+        with server.lock:
+            server.sent_bytes += len(chunk)
+
+
+@contextmanager
+def _stand_in(payload: bytes, **settings: Any) -> Iterator[_StandInServer]:
+    server = _StandInServer()
+    server.payload = payload
+    for name, value in settings.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # Small reads, so a dropped connection leaves some of its range on disk.
+        patcher = mock.patch.object(downloads, "DOWNLOAD_CHUNK_BYTES", 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = random.Random(3).randbytes(300_000)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.destination = Path(self.tmp_dir.name) / "CID-SMILES.gz"
+        self.tmp_path = Path(self.tmp_dir.name) / "CID-SMILES.gz.tmp"
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _files(self) -> List[str]:
+        return sorted(path.name for path in self.destination.parent.iterdir())
+
+    def test_parallel_ranges_retry_where_they_stopped(self) -> None:
+        with _stand_in(self.payload, drops=2, status_failures=1) as server:
+            download_file(server.url, self.destination, connections=4, backoff_seconds=0)
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+        self.assertEqual(self._files(), ["CID-SMILES.gz"])
+        starts = {
+            int(header.split("=")[1].split("-")[0]) for header in server.range_headers if header
+        }
+        part_starts = {len(self.payload) * index // 4 for index in range(4)}
+        self.assertTrue(part_starts <= starts)
+        self.assertTrue(starts - part_starts, "a dropped range should resume mid-part")
+
+    def test_an_interrupted_download_resumes_on_the_next_call(self) -> None:
+        with _stand_in(self.payload, drops=100) as server:
+            with self.assertRaises(requests.RequestException):
+                download_file(server.url, self.destination, connections=3, retries=0)
+            self.assertTrue(self.tmp_path.exists())
+            self.assertFalse(self.destination.exists())
+            server.drops, server.sent_bytes = 0, 0
+            download_file(server.url, self.destination, connections=3)
+            self.assertLess(server.sent_bytes, len(self.payload) * 0.6)
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+
+    def test_a_tmp_without_a_sidecar_is_not_reused(self) -> None:
+        # Left by an earlier release of the file, with nothing to say so.
+        self.tmp_path.write_bytes(bytes(reversed(self.payload))[:1000])
+        with _stand_in(self.payload) as server:
+            download_file(server.url, self.destination)
+        self.assertEqual(server.range_headers, ["bytes=0-{0}".format(len(self.payload) - 1)])
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+        self.assertEqual(self._files(), ["CID-SMILES.gz"])
+
+    def test_servers_without_ranges_get_one_plain_request(self) -> None:
+        self.tmp_path.write_bytes(b"stale")
+        parts_path = Path(self.tmp_dir.name) / "CID-SMILES.gz.tmp.parts.json"
+        parts_path.write_text("{}\n")
+        with _stand_in(self.payload, ranges=False, drops=1) as server:
+            download_file(server.url, self.destination, connections=4, backoff_seconds=0)
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+        self.assertEqual(len(server.range_headers), 2)
+        self.assertEqual(self._files(), ["CID-SMILES.gz"])
+
+        with _stand_in(self.payload, missing=True) as server:
+            with self.assertRaises(requests.HTTPError):
+                download_file(server.url, self.destination)
+
+    def test_weak_etags_fall_back_to_last_modified_or_one_stream(self) -> None:
+        last_modified = "Tue, 06 Oct 2026 04:13:27 GMT"
+        with _stand_in(self.payload, etag='W/"v1"', last_modified=last_modified) as server:
+            download_file(server.url, self.destination, connections=3)
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+        self.assertEqual(server.if_range_headers, [last_modified] * 3)
+
+        self.destination.unlink()
+        with _stand_in(self.payload, etag='W/"v1"') as server:
+            download_file(server.url, self.destination, connections=3)
+        self.assertEqual(self.destination.read_bytes(), self.payload)
+        self.assertEqual((server.range_headers, server.if_range_headers), ([None], [None]))
+
+
+class PubchemInputTest(unittest.TestCase):
+    def test_materialized_mode_copies_and_counts(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            payload = _write_input(root / "CID-SMILES.gz", 5000)
+            options: Dict[str, Any] = dict(
+                pubchem_input_path=root / "CID-SMILES.gz",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                allow_download=False,
+                pubchem_url="https://example.invalid/CID-SMILES.gz",
+            )
+            info = ensure_pubchem_input(**options)
+            self.assertEqual(info["pubchem_total"], 5000)
+            self.assertEqual((root / "CID-SMILES.tsv").read_bytes(), payload)
+            self.assertEqual(ensure_pubchem_input(**options), info)
+            row_index = load_row_index(root / "CID-SMILES.tsv")
+            self.assertEqual((row_index.stride, row_index.rows), (ROW_INDEX_STRIDE, 5000))
+            with (root / "CID-SMILES.tsv").open("rb") as handle:
+                handle.seek(row_index.offset_of(handle, 4500))
+                self.assertEqual(handle.readline(), b"4501\tC%s\n" % (b"C" * (4501 % 7)))
+
+            # A run materialized before the row index existed gets one on the next start.
+            row_index_path(root / "CID-SMILES.tsv").unlink()
+            self.assertEqual(ensure_pubchem_input(**options), info)
+            self.assertEqual(
+                load_row_index(root / "CID-SMILES.tsv").offsets.tolist(),
+                row_index.offsets.tolist(),
+            )
+            with self.assertRaises(ValueError):
+                ensure_pubchem_input(input_mode="mmap", **options)
+
+    def test_deferred_count_returns_before_counting(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            (root / "CID-SMILES.tsv").write_bytes(b"1\tC\n2\tCC\nbad\n")
+            options: Dict[str, Any] = dict(
+                pubchem_input_path=root / "CID-SMILES.tsv",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                allow_download=False,
+                pubchem_url="https://example.invalid/CID-SMILES.gz",
+            )
+            deferred = ensure_pubchem_input(defer_count=True, **options)
+            self.assertIsNone(deferred["pubchem_total"])
+            self.assertFalse(row_index_path(root / "CID-SMILES.tsv").exists())
+            counted = ensure_pubchem_input(**options)
+            self.assertEqual(counted["pubchem_total"], 2)
+            self.assertEqual(ensure_pubchem_input(defer_count=True, **options), counted)
+
+            # A gzip that has to be materialized is counted while it is copied.
+            _write_input(root / "CID-SMILES.gz", 10)
+            options["pubchem_input_path"] = root / "CID-SMILES.gz"
+            options["materialized_input_path"] = root / "copy.tsv"
+            self.assertEqual(ensure_pubchem_input(defer_count=True, **options)["pubchem_total"], 10)
+
+    def test_indexed_gzip_mode_resumes_from_uncompressed_offsets(self) -> None:
+        if find_spec("indexed_gzip") is None:
+            self.skipTest("indexed_gzip is not installed")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            source_path = root / "CID-SMILES.gz"
+            _write_input(source_path, 50000)
+            info = ensure_pubchem_input(
+                pubchem_input_path=source_path,
+                materialized_input_path=root / "CID-SMILES.tsv",
+                allow_download=False,
+                pubchem_url="https://example.invalid/CID-SMILES.gz",
+                input_mode="indexed-gzip",
+            )
+            self.assertEqual(info["pubchem_total"], 50000)
+            self.assertEqual(info["materialized_path"], str(source_path))
+            self.assertTrue(gzip_index_path(source_path).exists())
+            self.assertFalse((root / "CID-SMILES.tsv").exists())
+            row_index = load_row_index(source_path)
+            with open_pubchem_input(source_path) as handle:
+                handle.seek(row_index.offset_of(handle, 45678))
+                self.assertEqual(handle.readline().split(b"\t")[0], b"45679")
+
+            batches = []
+            with open_pubchem_input(source_path) as handle:
+                reader = PubchemTsvReader(handle, block_bytes=4096)
+                offset = 0
+                while True:
+                    batch = reader.read(7000)
+                    if not batch.rows:
+                        break
+                    batches.append((offset, batch.cids.tolist(), batch.smiles))
+                    offset = batch.end_offset
+            for offset, cids, smiles in reversed(batches):
+                with open_pubchem_input(source_path) as handle:
+                    handle.seek(offset)
+                    batch = PubchemTsvReader(handle).read(len(cids))
+                self.assertEqual((batch.cids.tolist(), batch.smiles), (cids, smiles))
+
+    def test_indexed_gzip_mode_names_the_missing_package(self) -> None:
+        if find_spec("indexed_gzip") is not None:
+            self.skipTest("indexed_gzip is installed")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            _write_input(root / "CID-SMILES.gz", 10)
+            with self.assertRaisesRegex(ImportError, "indexed_gzip"):
+                ensure_pubchem_input(
+                    pubchem_input_path=root / "CID-SMILES.gz",
+                    materialized_input_path=root / "CID-SMILES.tsv",
+                    allow_download=False,
+                    pubchem_url="https://example.invalid/CID-SMILES.gz",
+                    input_mode="indexed-gzip",
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
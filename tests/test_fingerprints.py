@@ -0,0 +1,80 @@
+import unittest
+from importlib.util import find_spec
+
+PARITY_SMILES = [
+    "CCO",
+    "C",
+    "[Na+].[Cl-]",
+    "N#N",
+    "C1CC1",
+    "c1ccccc1C(=O)O",
+    "CC(=O)Oc1ccccc1C(=O)O",
+    "CN1C=NC2=C1C(=O)N(C(=O)N2C)C",
+    "CC(C)CC1=CC=C(C=C1)C(C)C(=O)O",
+    "C[C@H](N)C(=O)O",
+    "OCC1OC(O)C(O)C(O)C1O",
+    "C(C1C(C(C(C(O1)O)O)O)O)O",
+    "OC1C(O)C(OC2=CC=CC=C2)OC(CO)C1O",
+    "OC[C@H]1O[C@@H](Oc2ccc(cc2)C=O)[C@H](O)[C@@H](O)[C@@H]1O",
+    "OC[C@H]1O[C@@H](O[C@H]2[C@H](O)[C@@H](O)[C@H](O)O[C@@H]2CO)[C@H](O)[C@@H](O)[C@@H]1O",
+    "C[C@@H]1O[C@@H](OC2=C(Oc3cc(O)cc(O)c3C2=O)c2ccc(O)c(O)c2)[C@H](O)[C@H](O)[C@H]1O",
+    "CC12CCC3C(C1CCC2O)CCC4=CC(=O)CCC34C",
+    "COC1=CC(=CC(=C1O)OC)C=CC(=O)O",
+    "C=CC(C)(O)CCC=C(C)C",
+    "CCCCCCCCCCCCCCCC(=O)OC[C@H](COP(=O)(O)OCC[N+](C)(C)C)OC(=O)CCCCCCCCCCCCCCC",
+    "CC1=C2[C@@]([C@]([C@H]([C@@H]3[C@]4([C@H](OC4)C[C@@H]([C@]3(C(=O)[C@@H]2OC(=O)C)C)O)OC(=O)C)OC(=O)c5ccccc5)(C[C@@H]1OC(=O)[C@H](O)[C@@H](NC(=O)c6ccccc6)c7ccccc7)O)(C)C",
+    "O=C1C=CC(=O)C=C1",
+    "OC(=O)CCC(=O)O",
+    "C1=CC2=C(C=C1)C=CC=C2",
+    "[2H]C([2H])([2H])O",
+    "FC(F)(F)c1ccc(Cl)c(Br)c1I",
+    "N[C@@H](CS)C(=O)N[C@@H](CCC(=O)O)C(=O)NCC(=O)O",
+    "CC1OC(OC2C(O)C(O)C(OC3CCC4(C)C(CCC5C4CCC4(C)C5CCC4C(C)CCC(=O)O)C3)OC2CO)C(O)C(O)C1O",
+    "O=P(O)(O)OP(=O)(O)O",
+    "C1CCC2(CC1)OCCO2",
+    "S1C=CC=C1",
+    "c1ccc2c(c1)[nH]c1ccccc12",
+    "CC(C)(C)c1ccc(O)cc1",
+    "O=C(O)C1=CC=CN=C1",
+]
+
+
+class FingerprintParityTest(unittest.TestCase):
+    def setUp(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+    def test_single_parse_glycoside_check_matches_legacy_helper(self) -> None:
+        from npc_labeler import fingerprints
+        from npc_labeler.original import fingerprint_handler
+
+        for smiles in PARITY_SMILES:
+            with self.subTest(smiles=smiles):
+                molecule = fingerprints.parse_smiles(smiles)
+                self.assertIsNotNone(molecule)
+                self.assertIs(
+                    fingerprints.is_glycoside(molecule),
+                    fingerprint_handler._isglycoside(smiles),
+                )
+
+    def test_morgan_count_pairs_are_bit_exact_with_legacy_fingerprints(self) -> None:
+        import numpy as np
+
+        from npc_labeler import fingerprints
+        from npc_labeler.original import fingerprint_handler
+
+        for smiles in PARITY_SMILES:
+            with self.subTest(smiles=smiles):
+                indices, counts = fingerprints.morgan_count_pairs(
+                    fingerprints.parse_smiles(smiles)
+                )
+                self.assertEqual((indices.dtype, counts.dtype), (np.uint16, np.uint16))
+                fp2048, fp4096 = fingerprint_handler.calculate_fingerprint(smiles, 2)
+                expected = np.concatenate([fp2048[0], fp4096[0]])
+                self.assertEqual(expected.shape, (fingerprints.FINGERPRINT_WIDTH,))
+                self.assertEqual(indices.tolist(), np.flatnonzero(expected).tolist())
+                self.assertEqual(counts.tolist(), expected[indices].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from npc_labeler.inference import (
+    FingerprintBatch,
+    ForwardWorkspace,
+    FusedPlan,
+    ModelPlan,
+    _forward,
+    compile_layers,
+    load_model_plan,
+    plan_cache_path,
+)
+from npc_labeler.output import sha256_file
+
+
+def _dense(rng, name, inputs, outputs, activation):
+    return (
+        "dense",
+        name,
+        {
+            "kernel": (rng.standard_normal((inputs, outputs)) * 0.2).astype(np.float32),
+            "bias": (rng.standard_normal((outputs,)) * 0.1).astype(np.float32),
+            "activation": activation,
+        },
+    )
+
+
+def _batch_norm(rng, name, width):
+    return (
+        "batch_norm",
+        name,
+        {
+            "gamma": (1.0 + 0.1 * rng.standard_normal((width,))).astype(np.float32),
+            "beta": (0.1 * rng.standard_normal((width,))).astype(np.float32),
+            "mean": (0.1 * rng.standard_normal((width,))).astype(np.float32),
+            "variance": (1.0 + rng.random((width,))).astype(np.float32),
+            "epsilon": 1e-3,
+        },
+    )
+
+
+def _layers(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [
+        ("concat", "concatenate", {}),
+        _dense(rng, "dense", 12, 8, "relu"),
+        _batch_norm(rng, "batch_normalization", 8),
+        ("dropout", "dropout", {}),
+        _dense(rng, "dense_1", 8, 6, "linear"),
+        _batch_norm(rng, "batch_normalization_1", 6),
+        _dense(rng, "dense_2", 6, 4, "sigmoid"),
+        _batch_norm(rng, "batch_normalization_2", 4),
+    ]
+
+
+def _write_keras_hdf5(path: Path, layers) -> None:
+    keras_layers = [{"class_name": "InputLayer", "name": "input", "config": {}}]
+    class_names = {
+        "concat": "Concatenate",
+        "dropout": "Dropout",
+        "dense": "Dense",
+        "batch_norm": "BatchNormalization",
+    }
+    with h5py.File(path, "w") as handle:
+        weights_root = handle.create_group("model_weights")
+        for op, name, params in layers:
+            config = {}
+            if op == "dense":
+                config["activation"] = params["activation"]
+                group = weights_root.create_group(name).create_group(name)
+                group["kernel:0"] = params["kernel"]
+                group["bias:0"] = params["bias"]
+            if op == "batch_norm":
+                config["epsilon"] = params["epsilon"]
+                group = weights_root.create_group(name).create_group(name)
+                group["gamma:0"] = params["gamma"]
+                group["beta:0"] = params["beta"]
+                group["moving_mean:0"] = params["mean"]
+                group["moving_variance:0"] = params["variance"]
+            keras_layers.append({"class_name": class_names[op], "name": name, "config": config})
+        handle.attrs["model_config"] = json.dumps({"config": {"layers": keras_layers}})
+
+
+class ModelPlanTest(unittest.TestCase):
+    def test_compiled_plan_folds_batch_norm_and_matches_layers(self) -> None:
+        layers = _layers()
+        plan = compile_layers(layers)
+
+        self.assertEqual([step.op for step in plan.steps], ["dense", "dense", "dense", "affine"])
+        self.assertEqual(plan.input_width, 12)
+
+        inputs = np.random.default_rng(1).integers(0, 4, size=(9, 12)).astype(np.float32)
+        np.testing.assert_allclose(
+            plan.forward(inputs), _forward(layers, inputs), rtol=1e-5, atol=1e-6
+        )
+
+    def test_plan_cache_is_keyed_by_weights_sha256(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = Path(tmp_dir) / "model.hdf5"
+            _write_keras_hdf5(weights_path, _layers(seed=0))
+
+            first = load_model_plan(weights_path)
+            cache_path = plan_cache_path(weights_path)
+            self.assertTrue(cache_path.exists())
+            self.assertIsNone(ModelPlan.load(cache_path, source_sha256="0" * 64))
+
+            cached = load_model_plan(weights_path)
+            for expected, actual in zip(first.steps, cached.steps):
+                self.assertEqual(expected.op, actual.op)
+                self.assertEqual(expected.activation, actual.activation)
+                np.testing.assert_array_equal(expected.weight, actual.weight)
+                np.testing.assert_array_equal(expected.bias, actual.bias)
+
+            # A digest the caller already verified is used as is.
+            with mock.patch("npc_labeler.inference.sha256_file") as hashed:
+                load_model_plan(weights_path, source_sha256=sha256_file(weights_path))
+            hashed.assert_not_called()
+
+            _write_keras_hdf5(weights_path, _layers(seed=2))
+            rebuilt = load_model_plan(weights_path)
+            expected_plan = compile_layers(_layers(seed=2))
+            np.testing.assert_array_equal(rebuilt.steps[0].weight, expected_plan.steps[0].weight)
+
+    def test_a_damaged_or_unwritable_cache_does_not_stop_loading(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = Path(tmp_dir) / "model.hdf5"
+            _write_keras_hdf5(weights_path, _layers(seed=0))
+            expected = compile_layers(_layers(seed=0))
+            load_model_plan(weights_path)
+            cache_path = plan_cache_path(weights_path)
+
+            # A truncated cache is a miss and gets rewritten.
+            cache_path.write_bytes(cache_path.read_bytes()[:100])
+            plan = load_model_plan(weights_path)
+            np.testing.assert_array_equal(plan.steps[0].weight, expected.steps[0].weight)
+            self.assertIsNotNone(
+                ModelPlan.load(cache_path, source_sha256=sha256_file(weights_path))
+            )
+
+            # A directory where the cache is written makes the save fail.
+            cache_path.unlink()
+            cache_path.with_name(cache_path.name + ".tmp").mkdir()
+            messages: List[str] = []
+            plan = load_model_plan(weights_path, log=messages.append)
+            np.testing.assert_array_equal(plan.steps[0].weight, expected.steps[0].weight)
+            self.assertEqual(len(messages), 1)
+            self.assertIn("could not cache model plan", messages[0])
+            self.assertFalse(cache_path.exists())
+            with self.assertWarns(RuntimeWarning):
+                load_model_plan(weights_path)
+
+
+class FusedPlanTest(unittest.TestCase):
+    def test_fused_heads_match_separate_plans(self) -> None:
+        plans = [compile_layers(_layers(seed=seed)) for seed in (3, 4, 5)]
+        fused = FusedPlan.from_plans(plans)
+        self.assertEqual(fused.kernel.shape, (12, 24))
+
+        rng = np.random.default_rng(6)
+        inputs = rng.integers(0, 3, size=(7, 12)).astype(np.float32)
+        inputs[2] = 0.0
+        rows, columns = np.nonzero(inputs)
+        batch = FingerprintBatch(
+            indptr=np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=7))]),
+            indices=columns.astype(np.intp),
+            counts=inputs[rows, columns],
+        )
+
+        dense_heads = fused.forward(inputs)
+        sparse_heads = fused.forward_sparse(batch)
+        for plan, dense_head, sparse_head in zip(plans, dense_heads, sparse_heads):
+            expected = plan.forward(inputs)
+            np.testing.assert_allclose(dense_head, expected, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(sparse_head, expected, rtol=1e-5, atol=1e-6)
+
+        # A sparse-only workspace never holds the densified inputs.
+        workspace = ForwardWorkspace(fused, rows=7)
+        for sparse, heads in ((True, sparse_heads), (False, dense_heads)):
+            for head, expected in zip(workspace.run(batch, sparse=sparse), heads):
+                np.testing.assert_allclose(head, expected, rtol=1e-5, atol=1e-6)
+            if sparse:
+                self.assertIsNone(workspace.inputs)
+        self.assertIsNotNone(workspace.inputs)
+
+    def test_narrow_kernels_track_float32_on_the_sparse_path(self) -> None:
+        fused = FusedPlan.from_plans([compile_layers(_layers(seed=seed)) for seed in (7, 8)])
+        rng = np.random.default_rng(9)
+        inputs = rng.integers(0, 3, size=(5, 12)).astype(np.float32)
+        rows, columns = np.nonzero(inputs)
+        batch = FingerprintBatch(
+            indptr=np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=5))]),
+            indices=columns.astype(np.intp),
+            counts=inputs[rows, columns],
+        )
+        expected = fused.forward(inputs)
+
+        for precision, dtype in (("float16", np.float16), ("int8", np.int8)):
+            with self.subTest(precision=precision):
+                narrow = fused.with_precision(precision)
+                self.assertEqual(narrow.kernel.dtype, dtype)
+                self.assertEqual(narrow.precision, precision)
+                allocating = narrow.forward_sparse(batch)
+                reusing = ForwardWorkspace(narrow, rows=5).run(batch, sparse=True)
+                for expected_head, allocating_head, reusing_head in zip(
+                    expected, allocating, reusing
+                ):
+                    np.testing.assert_allclose(allocating_head, expected_head, atol=0.05)
+                    np.testing.assert_array_equal(reusing_head, allocating_head)
+                with self.assertRaises(RuntimeError):
+                    narrow.forward(inputs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 from importlib.util import find_spec
+from typing import Dict
 
 import numpy as np
 
@@ -58,15 +59,15 @@ class NPClassifierBatchingTest(unittest.TestCase):
                 cid=1,
                 smiles="mol-1",
                 is_glycoside=False,
-                fp1=np.array([0.8, 0.0], dtype=np.float32),
-                fp2=np.zeros((3,), dtype=np.float32),
+                fingerprint_indices=np.array([0], dtype=np.uint16),
+                fingerprint_counts=np.array([1], dtype=np.uint16),
             ),
             PreparedRecord(
                 cid=2,
                 smiles="mol-2",
                 is_glycoside=True,
-                fp1=np.array([0.0, 0.9], dtype=np.float32),
-                fp2=np.zeros((3,), dtype=np.float32),
+                fingerprint_indices=np.array([1, 3], dtype=np.uint16),
+                fingerprint_counts=np.array([1, 2], dtype=np.uint16),
             ),
         ]
 
@@ -79,5 +80,255 @@ class NPClassifierBatchingTest(unittest.TestCase):
         self.assertEqual(expected_records, batched_records)
 
 
+def _random_models(seed: int = 0, width: int = 6144, hidden: int = 48):
+    rng = np.random.default_rng(seed)
+    models = {}
+    for model_name, labels in (("PATHWAY", 2), ("SUPERCLASS", 2), ("CLASS", 2)):
+        models[model_name] = [
+            ("concat", "concatenate", {}),
+            (
+                "dense",
+                "dense",
+                {
+                    "kernel": (rng.standard_normal((width, hidden)) * 0.05).astype(np.float32),
+                    "bias": (rng.standard_normal((hidden,)) * 0.1).astype(np.float32),
+                    "activation": "relu",
+                },
+            ),
+            (
+                "batch_norm",
+                "batch_normalization",
+                {
+                    "gamma": (1.0 + 0.1 * rng.standard_normal((hidden,))).astype(np.float32),
+                    "beta": (0.1 * rng.standard_normal((hidden,))).astype(np.float32),
+                    "mean": (0.1 * rng.standard_normal((hidden,))).astype(np.float32),
+                    "variance": (1.0 + rng.random((hidden,))).astype(np.float32),
+                    "epsilon": 1e-3,
+                },
+            ),
+            ("dropout", "dropout", {}),
+            (
+                "dense",
+                "dense_1",
+                {
+                    "kernel": (rng.standard_normal((hidden, labels)) * 0.5).astype(np.float32),
+                    "bias": (rng.standard_normal((labels,)) * 0.1).astype(np.float32),
+                    "activation": "sigmoid",
+                },
+            ),
+        ]
+    return models
+
+
+def _random_prepared_records(seed: int = 1, rows: int = 37, width: int = 6144):
+    from npc_labeler.model import PreparedRecord
+
+    rng = np.random.default_rng(seed)
+    records = []
+    for index in range(rows):
+        nnz = 0 if index == 3 else int(rng.integers(1, 120))
+        records.append(
+            PreparedRecord(
+                cid=index,
+                smiles="mol-{0}".format(index),
+                is_glycoside=bool(index % 2),
+                fingerprint_indices=np.sort(
+                    rng.choice(width, size=nnz, replace=False)
+                ).astype(np.uint16),
+                fingerprint_counts=rng.integers(1, 6, size=nnz).astype(np.uint16),
+            )
+        )
+    return records
+
+
+class SparseInferenceTest(unittest.TestCase):
+    def test_sparse_first_layer_matches_dense_forward_pass(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import NPClassifier
+
+        ontology: Dict[str, object] = {
+            "Pathway": {"pathway-a": 0, "pathway-b": 1},
+            "Superclass": {"super-a": 0, "super-b": 1},
+            "Class": {"class-a": 0, "class-b": 1},
+            "Super_hierarchy": {},
+            "Class_hierarchy": {},
+        }
+        models = _random_models()
+        records = _random_prepared_records()
+        dense = NPClassifier(models=models, ontology=ontology).predict_batch(records)
+        sparse = NPClassifier(
+            models=models, ontology=ontology, inference_mode="sparse"
+        ).predict_batch(records)
+
+        for expected, actual in zip(dense, sparse):
+            self.assertEqual(expected.shape, actual.shape)
+            np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+class ForwardWorkspaceTest(unittest.TestCase):
+    def test_workspace_forward_matches_allocating_forward(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import NPClassifier
+
+        ontology: Dict[str, object] = {
+            "Pathway": {"pathway-a": 0, "pathway-b": 1},
+            "Superclass": {"super-a": 0, "super-b": 1},
+            "Class": {"class-a": 0, "class-b": 1},
+            "Super_hierarchy": {},
+            "Class_hierarchy": {},
+        }
+        models = _random_models(seed=2)
+        records = _random_prepared_records(seed=3, rows=40)
+        for inference_mode in ("dense", "sparse"):
+            allocating = NPClassifier(
+                models=models, ontology=ontology, inference_mode=inference_mode
+            )
+            reusing = NPClassifier(
+                models=models,
+                ontology=ontology,
+                inference_mode=inference_mode,
+                workspace_rows=16,
+            )
+            for start, stop in ((0, 16), (16, 21), (21, 37)):
+                with self.subTest(inference_mode=inference_mode, start=start):
+                    expected = allocating.predict_batch(records[start:stop])
+                    actual = reusing.predict_batch(records[start:stop])
+                    for expected_head, actual_head in zip(expected, actual):
+                        np.testing.assert_array_equal(actual_head, expected_head)
+
+
+class PrecisionParityTest(unittest.TestCase):
+    ontology: Dict[str, object] = {
+        "Pathway": {"pathway-a": 0, "pathway-b": 1},
+        "Superclass": {"super-a": 0, "super-b": 1},
+        "Class": {"class-a": 0, "class-b": 1},
+        "Super_hierarchy": {"0": {"Pathway": [0]}, "1": {"Pathway": [1]}},
+        "Class_hierarchy": {
+            "0": {"Pathway": [0], "Superclass": [0]},
+            "1": {"Pathway": [1], "Superclass": [1]},
+        },
+    }
+
+    def test_reduced_precision_passes_gate_and_tracks_float32(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import NPClassifier
+
+        models = _random_models(seed=6)
+        records = _random_prepared_records(seed=5)
+        reference = NPClassifier(models=models, ontology=self.ontology, inference_mode="sparse")
+        expected = reference.classify_prepared_batch(records)
+        for precision in ("float16", "int8"):
+            with self.subTest(precision=precision):
+                classifier = NPClassifier(
+                    models=models,
+                    ontology=self.ontology,
+                    inference_mode="sparse",
+                    workspace_rows=16,
+                    inference_precision=precision,
+                )
+                classifier.check_precision_parity(records)
+                self.assertIsNone(classifier._reference_engine)
+                actual = classifier.classify_prepared_batch(records[:16])
+                for key in ("pathway_ids", "superclass_ids", "class_ids"):
+                    self.assertEqual(
+                        [record[key] for record in actual],
+                        [record[key] for record in expected[:16]],
+                    )
+
+    def test_gate_refuses_weights_that_change_voted_labels(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import NPClassifier, PrecisionParityError
+
+        classifier = NPClassifier(
+            models=_random_models(seed=4),
+            ontology=self.ontology,
+            inference_mode="sparse",
+            inference_precision="int8",
+        )
+        assert classifier.engine.kernel_scale is not None
+        classifier.engine.kernel_scale *= 8.0
+        with self.assertRaises(PrecisionParityError):
+            classifier.check_precision_parity(_random_prepared_records(seed=5))
+
+    def test_reduced_precision_requires_sparse_mode(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import NPClassifier
+
+        with self.assertRaises(ValueError):
+            NPClassifier(
+                models=_random_models(), ontology=self.ontology, inference_precision="float16"
+            )
+
+
+class ColumnarClassificationTest(unittest.TestCase):
+    def test_classify_into_matches_per_row_records(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.model import ClassificationRuntimeError, NPClassifier
+        from npc_labeler.results import ClassificationBatch, ClassificationBatchBuilder
+
+        # Superclass 1 has no hierarchy entry, so rows voting for it fail.
+        ontology: Dict[str, object] = {
+            "Pathway": {"pathway-a": 0, "pathway-b": 1},
+            "Superclass": {"super-a": 0, "super-b": 1},
+            "Class": {"class-a": 0, "class-b": 1},
+            "Super_hierarchy": {"0": {"Pathway": [0]}},
+            "Class_hierarchy": {
+                "0": {"Pathway": [0], "Superclass": [0]},
+                "1": {"Pathway": [1], "Superclass": [1]},
+            },
+        }
+        classifier = NPClassifier(models=_random_models(seed=7), ontology=ontology)
+        records = _random_prepared_records(seed=8)
+        vector_widths = classifier.vector_widths()
+
+        expected_records = []
+        for record in records:
+            try:
+                expected_records.append(classifier.classify_prepared_record(record))
+            except ClassificationRuntimeError as error:
+                expected_records.append(
+                    {
+                        "cid": record.cid,
+                        "smiles": record.smiles,
+                        "pathway_ids": None,
+                        "other_failure": True,
+                        "error_message": str(error),
+                    }
+                )
+        expected = ClassificationBatch.from_records(expected_records, vector_widths)
+
+        builder = ClassificationBatchBuilder(len(records), vector_widths)
+        # Rows may arrive in any order, one inference slice at a time.
+        order = list(range(len(records)))[::-1]
+        for start in range(0, len(order), 16):
+            rows = order[start : start + 16]
+            classifier.classify_into(builder, rows, [records[row] for row in rows])
+        actual = builder.build()
+
+        self.assertGreater(actual.other_failed_rows, 0)
+        self.assertGreater(actual.successful_rows, 0)
+        self.assertEqual(actual.smiles, expected.smiles)
+        self.assertEqual(actual.error_messages, expected.error_messages)
+        for name in ("cids", "classified", "isglycoside", "parse_failed", "other_failure"):
+            np.testing.assert_array_equal(getattr(actual, name), getattr(expected, name))
+        for column in actual.label_offsets:
+            np.testing.assert_array_equal(actual.label_offsets[column], expected.label_offsets[column])
+            np.testing.assert_array_equal(actual.label_values[column], expected.label_values[column])
+        for column in actual.vectors:
+            np.testing.assert_array_equal(actual.vectors[column], expected.vectors[column])
+
+
 if __name__ == "__main__":
     unittest.main()
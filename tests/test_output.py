@@ -1,16 +1,30 @@
+import io
+import json
 import tempfile
 import unittest
 from pathlib import Path
+from typing import Any, Dict
 
 import numpy as np
 import pyarrow.parquet as pq
 import zstandard as zstd
 
 from npc_labeler.output import (
+    COMPRESSION_PROFILES,
+    DEFAULT_COMPRESSION_PROFILE,
+    PART_JOURNAL,
+    ROWS_PARQUET_SCHEMA,
+    VECTOR_WRITERS,
     ChunkIndex,
+    ChunkWriter,
+    _rows_table,
+    cleanup_completed_dir,
     finalize_chunk,
+    read_part_journal,
+    sha256_file,
     write_staging_part,
 )
+from npc_labeler.results import ClassificationBatch
 
 
 class OutputLayoutTest(unittest.TestCase):
@@ -21,16 +35,13 @@ class OutputLayoutTest(unittest.TestCase):
             staging_dir = root / "staging"
             chunk_index = ChunkIndex.open(root / "state" / "chunks.jsonl")
 
-            write_staging_part(
-                staging_dir=staging_dir,
-                chunk_id=1,
-                part_id=1,
-                vector_widths={
-                    "pathway_prediction_vector": 2,
-                    "superclass_prediction_vector": 2,
-                    "class_prediction_vector": 2,
-                },
-                records=[
+            vector_widths = {
+                "pathway_prediction_vector": 2,
+                "superclass_prediction_vector": 2,
+                "class_prediction_vector": 2,
+            }
+            batch = ClassificationBatch.from_records(
+                [
                     {
                         "cid": 1,
                         "smiles": "CCO",
@@ -62,6 +73,14 @@ class OutputLayoutTest(unittest.TestCase):
                         "error_message": "parse failed",
                     },
                 ],
+                vector_widths,
+            )
+            write_staging_part(
+                staging_dir=staging_dir,
+                chunk_id=1,
+                part_id=1,
+                batch=batch,
+                vector_widths=vector_widths,
             )
 
             chunk = finalize_chunk(
@@ -71,11 +90,7 @@ class OutputLayoutTest(unittest.TestCase):
                 first_row=0,
                 last_row=1,
                 row_count=2,
-                vector_widths={
-                    "pathway_prediction_vector": 2,
-                    "superclass_prediction_vector": 2,
-                    "class_prediction_vector": 2,
-                },
+                vector_widths=vector_widths,
             )
             chunk_index.append(chunk)
 
@@ -109,6 +124,35 @@ class OutputLayoutTest(unittest.TestCase):
                 "other_failure",
                 "error_message",
             ])
+            self.assertEqual(
+                rows.to_pylist(),
+                [
+                    {
+                        "cid": 1,
+                        "smiles": "CCO",
+                        "pathway_ids": [1],
+                        "superclass_ids": [2],
+                        "class_ids": [3],
+                        "isglycoside": False,
+                        "parse_failed": False,
+                        "rdkit_failed": False,
+                        "other_failure": False,
+                        "error_message": None,
+                    },
+                    {
+                        "cid": 2,
+                        "smiles": "bad",
+                        "pathway_ids": None,
+                        "superclass_ids": None,
+                        "class_ids": None,
+                        "isglycoside": None,
+                        "parse_failed": True,
+                        "rdkit_failed": False,
+                        "other_failure": False,
+                        "error_message": "parse failed",
+                    },
+                ],
+            )
 
             self.assertEqual(pathway_vectors.shape, (2, 2))
             self.assertEqual(superclass_vectors.shape, (2, 2))
@@ -120,11 +164,324 @@ class OutputLayoutTest(unittest.TestCase):
             self.assertTrue(np.isnan(superclass_vectors[1]).all())
             self.assertTrue(np.isnan(class_vectors[1]).all())
 
+    def test_streaming_writers_match_staged_parts(self) -> None:
+        vector_widths = {
+            "pathway_prediction_vector": 2,
+            "superclass_prediction_vector": 3,
+            "class_prediction_vector": 4,
+        }
+        batches = [
+            ClassificationBatch.from_records(
+                [
+                    {
+                        "cid": cid,
+                        "smiles": "C" * cid,
+                        "pathway_ids": [cid % 2],
+                        "superclass_ids": [],
+                        "class_ids": [cid % 4, 3],
+                        "isglycoside": cid % 3 == 0,
+                        "pathway_prediction_vector": [0.5, cid / 8.0],
+                        "superclass_prediction_vector": [0.25, 0.5, 0.75],
+                        "class_prediction_vector": [0.0, 0.125, 0.25, cid / 16.0],
+                    }
+                    if cid % 5
+                    else {
+                        "cid": cid,
+                        "smiles": "bad",
+                        "pathway_ids": None,
+                        "parse_failed": True,
+                        "error_message": "parse failed",
+                    }
+                    for cid in range(start, start + 4)
+                ],
+                vector_widths,
+            )
+            for start in (1, 5, 9)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            chunks = {}
+            for rows_writer in ("staged", "streaming"):
+                completed_dir = root / rows_writer / "completed"
+                writer = ChunkWriter(
+                    staging_dir=root / rows_writer / "staging",
+                    completed_dir=completed_dir,
+                    chunk_id=1,
+                    vector_widths=vector_widths,
+                    rows_writer=rows_writer,
+                    vector_writer=rows_writer,
+                )
+                for part_index, batch in enumerate(batches):
+                    writer.write(batch, first_row=4 * part_index, next_offset=100 * (part_index + 1))
+                if rows_writer == "streaming":
+                    # Before finalization only .tmp files exist, and resume
+                    # cleanup throws them away.
+                    self.assertEqual(
+                        sorted(path.name for path in completed_dir.iterdir()),
+                        [
+                            "part-000001.class-vectors.f16.zst.tmp",
+                            "part-000001.parquet.tmp",
+                            "part-000001.pathway-vectors.f16.zst.tmp",
+                            "part-000001.superclass-vectors.f16.zst.tmp",
+                        ],
+                    )
+                    self.assertEqual(
+                        list(writer.chunk_dir.iterdir()), [writer.chunk_dir / PART_JOURNAL]
+                    )
+                    journal = read_part_journal(writer.chunk_dir)
+                    self.assertEqual([part.rows for part in journal], [4, 4, 4])
+                    class_tmp = completed_dir / "part-000001.class-vectors.f16.zst.tmp"
+                    self.assertEqual(
+                        journal[-1].vector_ends["class_prediction_vector"], class_tmp.stat().st_size
+                    )
+                    # Every journaled prefix decodes on its own.
+                    prefix = class_tmp.read_bytes()[: journal[0].vector_ends["class_prediction_vector"]]
+                    self.assertEqual(
+                        zstd.ZstdDecompressor().decompress(prefix),
+                        batches[0].vectors["class_prediction_vector"].tobytes(),
+                    )
+                chunks[rows_writer] = writer.finalize(first_row=0, last_row=11, row_count=12)
+                self.assertEqual(
+                    sorted(path.name for path in completed_dir.iterdir()),
+                    sorted(chunks[rows_writer].completed_filenames()),
+                )
+                # Digests hashed on the way to disk match the files.
+                record = chunks[rows_writer].__dict__
+                for stem in ("", "pathway_vector_", "superclass_vector_", "class_vector_"):
+                    path = completed_dir / record[stem + "filename"]
+                    self.assertEqual(record[stem + "sha256"], sha256_file(path))
+                    self.assertEqual(record[stem + "bytes"], path.stat().st_size)
+
+            staged, streaming = chunks["staged"], chunks["streaming"]
+            staged_rows = pq.ParquetFile(root / "staged" / "completed" / staged.filename)
+            streaming_rows = pq.ParquetFile(root / "streaming" / "completed" / streaming.filename)
+            self.assertEqual(streaming_rows.metadata.num_row_groups, 3)
+            self.assertEqual(streaming_rows.read().to_pylist(), staged_rows.read().to_pylist())
+            self.assertEqual(streaming.sha256, staged.sha256)
+            for column_name, width in vector_widths.items():
+                sidecar_field = column_name.replace("_prediction_vector", "_vector_filename")
+                np.testing.assert_array_equal(
+                    self._read_vector_matrix(
+                        root / "streaming" / "completed" / getattr(streaming, sidecar_field),
+                        rows=12,
+                        width=width,
+                    ),
+                    self._read_vector_matrix(
+                        root / "staged" / "completed" / getattr(staged, sidecar_field),
+                        rows=12,
+                        width=width,
+                    ),
+                )
+
+            leftover = ChunkWriter(
+                staging_dir=root / "crash" / "staging",
+                completed_dir=root / "crash" / "completed",
+                chunk_id=1,
+                vector_widths=vector_widths,
+                rows_writer="streaming",
+                vector_writer="streaming",
+            )
+            leftover.write(batches[0], first_row=0, next_offset=100)
+            leftover.close()
+            cleanup_completed_dir(root / "crash" / "completed", ChunkIndex.open(root / "none.jsonl"))
+            self.assertEqual(list((root / "crash" / "completed").iterdir()), [])
+
+    def test_resume_continues_after_the_last_committed_part(self) -> None:
+        vector_widths = {
+            "pathway_prediction_vector": 2,
+            "superclass_prediction_vector": 3,
+            "class_prediction_vector": 4,
+        }
+        batches = [
+            ClassificationBatch.from_records(
+                [
+                    {
+                        "cid": cid,
+                        "smiles": "C" * cid,
+                        "pathway_ids": [cid % 2],
+                        "superclass_ids": [cid % 3],
+                        "class_ids": [cid % 4],
+                        "isglycoside": False,
+                        "pathway_prediction_vector": [0.5, cid / 8.0],
+                        "superclass_prediction_vector": [0.25, 0.5, cid / 16.0],
+                        "class_prediction_vector": [0.0, 0.125, 0.25, cid / 32.0],
+                    }
+                    for cid in range(start, start + 4)
+                ],
+                vector_widths,
+            )
+            for start in (1, 5, 9)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            for vector_writer in VECTOR_WRITERS:
+                options: Dict[str, Any] = {
+                    "chunk_id": 1,
+                    "vector_widths": vector_widths,
+                    "rows_writer": "staged",
+                    "vector_writer": vector_writer,
+                }
+                reference = ChunkWriter(
+                    staging_dir=root / vector_writer / "reference" / "staging",
+                    completed_dir=root / vector_writer / "reference" / "completed",
+                    **options,
+                )
+                for part_index, batch in enumerate(batches):
+                    reference.write(batch, first_row=4 * part_index, next_offset=100 * (part_index + 1))
+                expected = reference.finalize(first_row=0, last_row=11, row_count=12)
+
+                staging_dir = root / vector_writer / "staging"
+                completed_dir = root / vector_writer / "completed"
+                crashed = ChunkWriter(staging_dir=staging_dir, completed_dir=completed_dir, **options)
+                for part_index, batch in enumerate(batches[:2]):
+                    crashed.write(batch, first_row=4 * part_index, next_offset=100 * (part_index + 1))
+                # Die while writing the third part: its files are partly
+                # written and its journal line is torn.
+                write_staging_part(staging_dir, 1, 3, batches[2], vector_widths=vector_widths)
+                for handle in crashed._vector_handles.values():
+                    handle.write(b"partial frame")
+                crashed.close()
+                with (crashed.chunk_dir / PART_JOURNAL).open("a") as journal:
+                    journal.write(json.dumps({"part_id": 3})[:8])
+
+                self.assertIsNone(
+                    ChunkWriter.resume(
+                        staging_dir=staging_dir, completed_dir=completed_dir, first_row=4, **options
+                    )
+                )
+                resumed = ChunkWriter.resume(
+                    staging_dir=staging_dir, completed_dir=completed_dir, first_row=0, **options
+                )
+                assert resumed is not None
+                self.assertEqual([part.next_offset for part in resumed.parts], [100, 200])
+                self.assertEqual((resumed.next_part_id, resumed.rows), (3, 8))
+                cleanup_completed_dir(
+                    completed_dir, ChunkIndex.open(root / "none.jsonl"), keep=resumed.open_filenames()
+                )
+                self.assertEqual(
+                    len(list(completed_dir.iterdir())), 3 if vector_writer == "streaming" else 0
+                )
+
+                resumed.write(batches[2], first_row=8, next_offset=300)
+                record = resumed.finalize(first_row=0, last_row=11, row_count=12)
+                for field in ("sha256", "pathway_vector_sha256", "class_vector_sha256"):
+                    self.assertEqual(getattr(record, field), getattr(expected, field))
+                self.assertEqual(record.class_vector_sha256, sha256_file(
+                    completed_dir / record.class_vector_filename
+                ))
+
+            streaming_rows = ChunkWriter(
+                staging_dir=root / "rows" / "staging",
+                completed_dir=root / "rows" / "completed",
+                chunk_id=1,
+                vector_widths=vector_widths,
+                rows_writer="streaming",
+            )
+            streaming_rows.write(batches[0], first_row=0, next_offset=100)
+            streaming_rows.close()
+            self.assertIsNone(
+                ChunkWriter.resume(
+                    staging_dir=root / "rows" / "staging",
+                    completed_dir=root / "rows" / "completed",
+                    chunk_id=1,
+                    first_row=0,
+                    vector_widths=vector_widths,
+                    rows_writer="streaming",
+                )
+            )
+
+    def test_compression_profiles_change_bytes_not_content(self) -> None:
+        vector_widths = {
+            "pathway_prediction_vector": 2,
+            "superclass_prediction_vector": 3,
+            "class_prediction_vector": 64,
+        }
+        rng = np.random.default_rng(0)
+        batch = ClassificationBatch.from_records(
+            [
+                {
+                    "cid": cid,
+                    "smiles": "C" * (cid % 7 + 1),
+                    "pathway_ids": [cid % 2],
+                    "superclass_ids": [cid % 3],
+                    "class_ids": [cid % 5],
+                    "isglycoside": False,
+                    "pathway_prediction_vector": rng.random(2).tolist(),
+                    "superclass_prediction_vector": rng.random(3).tolist(),
+                    "class_prediction_vector": (rng.random(64) ** 8).tolist(),
+                }
+                for cid in range(1, 201)
+            ],
+            vector_widths,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            chunk_index = ChunkIndex.open(root / "chunks.jsonl")
+            for chunk_id, (name, profile) in enumerate(COMPRESSION_PROFILES.items(), start=1):
+                for vector_writer in VECTOR_WRITERS:
+                    completed_dir = root / vector_writer / "completed"
+                    writer = ChunkWriter(
+                        staging_dir=root / vector_writer / "staging",
+                        completed_dir=completed_dir,
+                        chunk_id=chunk_id,
+                        vector_widths=vector_widths,
+                        rows_writer=vector_writer,
+                        vector_writer=vector_writer,
+                        compression=profile,
+                    )
+                    writer.write(batch, first_row=0, next_offset=0)
+                    record = writer.finalize(first_row=0, last_row=199, row_count=200)
+                    chunk_index.append(record)
+                    self.assertEqual(record.compression_profile, name)
+
+                    if (name, vector_writer) == (DEFAULT_COMPRESSION_PROFILE, "staged"):
+                        # The default writes what finalization wrote before profiles existed.
+                        legacy_rows = io.BytesIO()
+                        with pq.ParquetWriter(
+                            legacy_rows, ROWS_PARQUET_SCHEMA, compression="zstd"
+                        ) as legacy_writer:
+                            legacy_writer.write_table(_rows_table(batch))
+                        legacy_vectors = io.BytesIO()
+                        with zstd.ZstdCompressor(level=19).stream_writer(
+                            legacy_vectors, closefd=False
+                        ) as legacy_stream:
+                            legacy_stream.write(
+                                batch.vectors["class_prediction_vector"].astype("<f2").tobytes()
+                            )
+                        self.assertEqual(
+                            (completed_dir / record.filename).read_bytes(), legacy_rows.getvalue()
+                        )
+                        self.assertEqual(
+                            (completed_dir / record.class_vector_filename).read_bytes(),
+                            legacy_vectors.getvalue(),
+                        )
+
+                    rows = pq.ParquetFile(completed_dir / record.filename)
+                    self.assertEqual(
+                        rows.metadata.row_group(0).column(0).compression, "ZSTD"
+                    )
+                    self.assertEqual(rows.read()["cid"].to_pylist(), list(range(1, 201)))
+                    np.testing.assert_array_equal(
+                        self._read_vector_matrix(
+                            completed_dir / record.class_vector_filename, rows=200, width=64
+                        ),
+                        batch.vectors["class_prediction_vector"],
+                    )
+
+            reopened = ChunkIndex.open(root / "chunks.jsonl")
+            self.assertEqual(
+                [record.compression_profile for record in reopened.records],
+                [name for name in COMPRESSION_PROFILES for _ in VECTOR_WRITERS],
+            )
+
     @staticmethod
     def _read_vector_matrix(path: Path, *, rows: int, width: int) -> np.ndarray:
         dctx = zstd.ZstdDecompressor()
         with path.open("rb") as handle:
-            with dctx.stream_reader(handle) as reader:
+            with dctx.stream_reader(handle, read_across_frames=True) as reader:
                 payload = reader.read()
         matrix = np.frombuffer(payload, dtype=np.dtype("<f2"))
         return matrix.reshape(rows, width)
@@ -0,0 +1,453 @@
+import io
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+class PreparationWorkersTest(unittest.TestCase):
+    def test_process_pool_matches_serial_preparation(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.pipeline import _prep_executor, _prepare_tasks
+
+        tasks = [
+            (0, 1, "CCO"),
+            (1, 2, "not-a-smiles"),
+            (2, 3, "OCC1OC(O)C(O)C(O)C1O"),
+            (3, 4, "c1ccccc1C(=O)O"),
+            (4, 5, ""),
+            (5, 6, "CC(=O)Oc1ccccc1C(=O)O"),
+        ]
+        serial = _prepare_tasks(tasks, None, 1)
+        with _prep_executor(2) as executor:
+            pooled = _prepare_tasks(tasks, executor, 2)
+
+        self.assertEqual(len(serial), len(pooled))
+        for expected, actual in zip(serial, pooled):
+            self.assertEqual(expected.failure, actual.failure)
+            self.assertEqual(expected.error_message, actual.error_message)
+            if expected.prepared is None or actual.prepared is None:
+                self.assertIs(expected.prepared, actual.prepared)
+                continue
+            self.assertEqual(expected.prepared.cid, actual.prepared.cid)
+            self.assertEqual(expected.prepared.smiles, actual.prepared.smiles)
+            self.assertEqual(expected.prepared.is_glycoside, actual.prepared.is_glycoside)
+            self.assertEqual(
+                expected.prepared.fingerprint_indices.tobytes(),
+                actual.prepared.fingerprint_indices.tobytes(),
+            )
+            self.assertEqual(
+                expected.prepared.fingerprint_counts.tobytes(),
+                actual.prepared.fingerprint_counts.tobytes(),
+            )
+
+
+class BackgroundFinalizationTest(unittest.TestCase):
+    def test_chunks_commit_once_their_finalization_is_done(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from npc_labeler.output import ChunkIndex, ChunkWriter
+        from npc_labeler.pipeline import RunCounts, _ChunkFinalizer, _state_update
+        from npc_labeler.results import ClassificationBatch
+        from npc_labeler.state import RunState
+
+        vector_widths = {
+            "pathway_prediction_vector": 2,
+            "superclass_prediction_vector": 2,
+            "class_prediction_vector": 3,
+        }
+        batches = [
+            ClassificationBatch.from_records(
+                [
+                    {
+                        "cid": cid,
+                        "smiles": "C" * cid,
+                        "pathway_ids": [cid % 2],
+                        "superclass_ids": [cid % 3],
+                        "class_ids": [],
+                        "isglycoside": False,
+                        "pathway_prediction_vector": [0.5, cid / 8.0],
+                        "superclass_prediction_vector": [0.25, 0.75],
+                        "class_prediction_vector": [0.0, 0.125, cid / 16.0],
+                    }
+                    for cid in range(start, start + 3)
+                ],
+                vector_widths,
+            )
+            for start in (1, 4, 7)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            indexes = {}
+            for max_pending in (0, 1):
+                run_dir = root / str(max_pending)
+                chunk_index = ChunkIndex.open(run_dir / "state" / "chunks.jsonl")
+                state = RunState.create(
+                    input_path=Path("in.tsv"),
+                    materialized_input_path=Path("in.tsv"),
+                    pubchem_total=9,
+                    checkpoint_rows=3,
+                    chunk_rows=3,
+                    max_rows=None,
+                )
+                state_path = run_dir / "state" / "run-state.json"
+                counts = RunCounts(0, 0, 0, 0)
+                with _ChunkFinalizer(
+                    max_pending=max_pending,
+                    chunk_index=chunk_index,
+                    state=state,
+                    state_path=state_path,
+                ) as finalizer:
+                    for chunk_id, batch in enumerate(batches, start=1):
+                        writer = ChunkWriter(
+                            staging_dir=run_dir / "staging",
+                            completed_dir=run_dir / "completed",
+                            chunk_id=chunk_id,
+                            vector_widths=vector_widths,
+                        )
+                        writer.write(batch, first_row=3 * (chunk_id - 1), next_offset=10 * chunk_id)
+                        counts.successful_rows += batch.successful_rows
+                        finalizer.submit(
+                            writer,
+                            first_row=3 * (chunk_id - 1),
+                            last_row=3 * chunk_id - 1,
+                            row_count=3,
+                            state_update=_state_update(
+                                counts,
+                                next_row=3 * chunk_id,
+                                next_offset=10 * chunk_id,
+                                next_chunk_id=chunk_id + 1,
+                            ),
+                        )
+                        # A chunk commits as soon as its finalization is done, not
+                        # when a later chunk is submitted.
+                        deadline = time.monotonic() + 60
+                        while finalizer.pending and time.monotonic() < deadline:
+                            time.sleep(0.01)
+                            finalizer.commit_finished()
+                        self.assertEqual(finalizer.pending, 0)
+                        self.assertEqual(len(chunk_index.records), chunk_id)
+                        saved = RunState.load(state_path)
+                        self.assertEqual(saved.next_chunk_id, chunk_id + 1)
+                        self.assertEqual(saved.next_row, 3 * chunk_id)
+                        self.assertEqual(saved.successful_rows, 3 * chunk_id)
+
+                saved = RunState.load(state_path)
+                self.assertEqual((saved.next_row, saved.next_offset), (9, 30))
+                indexes[max_pending] = ChunkIndex.open(chunk_index.path).records
+
+            self.assertEqual(
+                [record.filename for record in indexes[1]],
+                ["part-000001.parquet", "part-000002.parquet", "part-000003.parquet"],
+            )
+            self.assertEqual(
+                [record.sha256 for record in indexes[1]],
+                [record.sha256 for record in indexes[0]],
+            )
+
+
+def _run_config(root: Path, **overrides: Any):
+    from npc_labeler.pipeline import RunConfig
+
+    options: Dict[str, Any] = dict(
+        work_dir=root,
+        pubchem_input_path=root / "CID-SMILES.tsv",
+        materialized_input_path=root / "CID-SMILES.tsv",
+        weights_dir=root / "weights",
+        completed_dir=root / "completed",
+        state_dir=root / "state",
+        release_dir=root / "releases",
+        checkpoint_rows=5,
+        inference_batch_rows=4,
+        max_rows=None,
+        download_pubchem=False,
+        chunk_rows=20,
+    )
+    options.update(overrides)
+    return RunConfig(**options)
+
+
+def _stand_in_classifier(*, weights_sha256: Any = None, log: Any = None, **options: Any):
+    import numpy as np
+
+    from npc_labeler.model import NPClassifier
+
+    rng = np.random.default_rng(0)
+    ontology: Dict[str, object] = {
+        "Pathway": {"pathway-a": 0, "pathway-b": 1},
+        "Superclass": {"super-a": 0, "super-b": 1},
+        "Class": {"class-a": 0, "class-b": 1},
+        "Super_hierarchy": {"0": {"Pathway": [0]}, "1": {"Pathway": [1]}},
+        "Class_hierarchy": {
+            "0": {"Pathway": [0], "Superclass": [0]},
+            "1": {"Pathway": [1], "Superclass": [1]},
+        },
+    }
+    models = {
+        model_name: [
+            ("concat", "concatenate", {}),
+            (
+                "dense",
+                "dense",
+                {
+                    "kernel": (rng.standard_normal((6144, 2)) * 0.1).astype(np.float32),
+                    "bias": np.zeros((2,), dtype=np.float32),
+                    "activation": "sigmoid",
+                },
+            ),
+        ]
+        for model_name in ("PATHWAY", "SUPERCLASS", "CLASS")
+    }
+    return NPClassifier(models=models, ontology=ontology, **options)
+
+
+class CrashResumeTest(unittest.TestCase):
+    def test_a_crash_while_finalizing_resumes_the_next_chunk_mid_way(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from unittest import mock
+
+        from npc_labeler import pipeline
+        from npc_labeler.output import ChunkIndex, ChunkWriter
+
+        smiles = ["CCO", "c1ccccc1C(=O)O", "not-a-smiles", "OCC1OC(O)C(O)C(O)C1O", "CC(=O)O"]
+        weights_info = {"doi": "", "download_url": "", "weights_dir": "", "files": []}
+        original_write = ChunkWriter.write
+
+        def run(root: Path, *, crash_at: Optional[int] = None, **overrides: Any) -> int:
+            writes = []
+
+            def write(writer, batch, **kwargs):
+                writes.append(batch.rows)
+                if len(writes) == crash_at:
+                    # A killed process leaves its files closed but not finalized.
+                    writer.close()
+                    raise KeyboardInterrupt("stopped")
+                original_write(writer, batch, **kwargs)
+
+            with mock.patch.object(ChunkWriter, "write", write), redirect_stdout(io.StringIO()):
+                pipeline.run_pipeline(_run_config(root, **overrides))
+            return len(writes)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+            pipeline, "ensure_model_weights", return_value=weights_info
+        ), mock.patch.object(
+            pipeline.NPClassifier,
+            "from_weights_dir",
+            side_effect=lambda weights_dir, **options: _stand_in_classifier(**options),
+        ):
+            for vector_writer in ("staged", "streaming"):
+                with self.subTest(vector_writer=vector_writer):
+                    roots = [Path(tmp_dir) / vector_writer / name for name in ("clean", "crash")]
+                    for root in roots:
+                        root.mkdir(parents=True)
+                        (root / "CID-SMILES.tsv").write_text(
+                            "".join(
+                                "{0}\t{1}\n".format(cid, smiles[cid % len(smiles)])
+                                for cid in range(1, 51)
+                            )
+                        )
+                    self.assertEqual(run(roots[0], vector_writer=vector_writer), 10)
+
+                    # Stop as if killed while chunk 1 was still being finalized,
+                    # after chunk 2 committed two of its four parts.
+                    def seal_only(finalizer, writer, *, state_update, **bounds):
+                        writer.seal(**bounds)
+
+                    with mock.patch.object(pipeline._ChunkFinalizer, "submit", seal_only):
+                        with self.assertRaises(KeyboardInterrupt):
+                            run(roots[1], crash_at=7, vector_writer=vector_writer)
+                    chunks_path = roots[1] / "state" / "chunks.jsonl"
+                    self.assertEqual(ChunkIndex.open(chunks_path).records, [])
+
+                    # Chunk 1 is finalized from its staged parts and chunk 2 continues
+                    # after its second part.
+                    self.assertEqual(run(roots[1], vector_writer=vector_writer), 4)
+                    clean, resumed = (
+                        [
+                            (record.filename, record.sha256, record.class_vector_sha256)
+                            for record in ChunkIndex.open(root / "state" / "chunks.jsonl").records
+                        ]
+                        for root in roots
+                    )
+                    self.assertEqual(resumed, clean)
+                    self.assertEqual(
+                        *(
+                            sorted(path.name for path in (root / "completed").iterdir())
+                            for root in roots
+                        )
+                    )
+
+
+class PrecisionGateTest(unittest.TestCase):
+    def test_gate_runs_when_the_first_batch_has_nothing_to_classify(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from unittest import mock
+
+        from npc_labeler import pipeline
+        from npc_labeler.model import PrecisionParityError
+
+        def skewed_classifier(weights_dir: Path, **options: Any):
+            classifier = _stand_in_classifier(**options)
+            assert classifier.engine.kernel_scale is not None
+            classifier.engine.kernel_scale *= 8.0
+            return classifier
+
+        weights_info = {"doi": "", "download_url": "", "weights_dir": "", "files": []}
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+            pipeline, "ensure_model_weights", return_value=weights_info
+        ), mock.patch.object(
+            pipeline.NPClassifier, "from_weights_dir", side_effect=skewed_classifier
+        ):
+            root = Path(tmp_dir)
+            # The whole first checkpoint fails to parse, so it has no inference slice.
+            (root / "CID-SMILES.tsv").write_text(
+                "".join("{0}\tnot-a-smiles\n".format(cid) for cid in range(1, 6))
+                + "".join(
+                    "{0}\t{1}\n".format(cid, smiles)
+                    for cid, smiles in enumerate(
+                        ["CCO", "c1ccccc1C(=O)O", "OCC1OC(O)C(O)C(O)C1O", "CC(=O)O", "CCN"] * 3,
+                        start=6,
+                    )
+                )
+            )
+            config = _run_config(root, inference_mode="sparse", inference_precision="int8")
+            with self.assertRaises(PrecisionParityError), redirect_stdout(io.StringIO()):
+                pipeline.run_pipeline(config)
+            self.assertFalse((root / "state" / "chunks.jsonl").exists())
+            self.assertFalse(any(path.is_file() for path in (root / "completed").iterdir()))
+
+
+class DeferredCountTest(unittest.TestCase):
+    def test_count_arrives_from_the_background_process(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from functools import partial
+
+        from npc_labeler.downloads import ensure_pubchem_input
+        from npc_labeler.pipeline import _DeferredCount
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = Path(tmp_dir) / "CID-SMILES.tsv"
+            input_path.write_bytes(b"".join(b"%d\tC\n" % cid for cid in range(1, 101)))
+            options: Dict[str, Any] = dict(
+                pubchem_input_path=input_path,
+                materialized_input_path=input_path,
+                allow_download=False,
+                pubchem_url="https://example.invalid/CID-SMILES.gz",
+            )
+            source_info = ensure_pubchem_input(defer_count=True, **options)
+            with _DeferredCount(source_info, partial(ensure_pubchem_input, **options)) as count:
+                self.assertEqual(count.wait(), 100)
+                self.assertEqual(count.poll(), 100)
+            self.assertEqual(count.source_info["pubchem_total"], 100)
+
+            with _DeferredCount(count.source_info, partial(ensure_pubchem_input, **options)) as count:
+                self.assertEqual(count.poll(), 100)
+
+    def test_a_changed_input_stops_the_resume(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from unittest import mock
+
+        from npc_labeler import pipeline
+        from npc_labeler.output import ChunkIndex, ChunkWriter
+
+        weights_info = {"doi": "", "download_url": "", "weights_dir": "", "files": []}
+        original_write = ChunkWriter.write
+        writes: List[int] = []
+        crash_at = [6]
+
+        def write(writer, batch, **kwargs):
+            writes.append(batch.rows)
+            if len(writes) == crash_at[0]:
+                crash_at[0] = 0
+                writer.close()
+                raise KeyboardInterrupt("stopped")
+            original_write(writer, batch, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+            pipeline, "ensure_model_weights", return_value=weights_info
+        ), mock.patch.object(
+            pipeline.NPClassifier,
+            "from_weights_dir",
+            side_effect=lambda weights_dir, **options: _stand_in_classifier(**options),
+        ), mock.patch.object(ChunkWriter, "write", write), redirect_stdout(io.StringIO()):
+            root = Path(tmp_dir)
+            input_path = root / "CID-SMILES.tsv"
+            input_path.write_text("".join("{0}\tCCO\n".format(cid) for cid in range(1, 51)))
+            with self.assertRaises(KeyboardInterrupt):
+                pipeline.run_pipeline(_run_config(root, defer_count=True))
+            chunks_path = root / "state" / "chunks.jsonl"
+            committed = ChunkIndex.open(chunks_path).records
+            self.assertEqual(len(committed), 1)
+
+            # A new release rewrites the rows the saved offset points into.
+            input_path.write_text("".join("{0}\tCCCO\n".format(cid) for cid in range(1, 61)))
+            writes.clear()
+            with self.assertRaisesRegex(ValueError, "PubChem input changed"):
+                pipeline.run_pipeline(_run_config(root, defer_count=True))
+            self.assertEqual(writes, [])
+            self.assertEqual(ChunkIndex.open(chunks_path).records, committed)
+
+
+class StagePipelineTest(unittest.TestCase):
+    def test_results_reach_the_writer_in_input_order(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from queue import Queue
+
+        from npc_labeler.pipeline import _END_OF_STAGE, _StagePipeline
+
+        def produce(stages, output, sequences):
+            for sequence in sequences:
+                stages.put(output, (sequence, [(sequence, sequence, "C")], sequence * 10, None))
+            stages.put(output, _END_OF_STAGE)
+
+        with _StagePipeline() as stages:
+            # A queue of one forces the producers to block on the writer.
+            output: Queue = Queue(maxsize=1)
+            stages.start("odd", produce, stages, output, [5, 1, 3])
+            stages.start("even", produce, stages, output, [4, 2, 0])
+            offsets = [offset for _, offset, _ in stages.ordered(output, producers=2)]
+        self.assertEqual(offsets, [0, 10, 20, 30, 40, 50])
+
+    def test_a_failing_stage_stops_the_pipeline(self) -> None:
+        if find_spec("rdkit") is None:
+            self.skipTest("rdkit is not available in this environment")
+
+        from queue import Queue
+
+        from npc_labeler.pipeline import _StagePipeline
+
+        def blocked(stages, output):
+            while True:
+                stages.put(output, (0, [], 0, None))
+
+        def fail():
+            raise RuntimeError("stage failed")
+
+        with self.assertRaisesRegex(RuntimeError, "stage failed"):
+            with _StagePipeline() as stages:
+                output: Queue = Queue(maxsize=1)
+                stages.start("blocked", blocked, stages, Queue(maxsize=1))
+                stages.start("fail", fail)
+                list(stages.ordered(output, producers=1))
+        self.assertFalse(any(thread.is_alive() for thread in stages.threads))
+
+
+if __name__ == "__main__":
+    unittest.main()
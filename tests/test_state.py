@@ -1,6 +1,8 @@
+import json
 import tempfile
 import unittest
 from pathlib import Path
+from typing import Any, Dict
 
 from npc_labeler.state import RunState
 
@@ -74,6 +76,69 @@ class RunStateTest(unittest.TestCase):
                     max_rows=None,
                 )
 
+    def test_deferred_total_is_checked_once_known(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            state = RunState.create(
+                input_path=root / "CID-SMILES.tsv",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                pubchem_total=None,
+                checkpoint_rows=100,
+                chunk_rows=1000,
+                max_rows=None,
+            )
+            state.validate_against(
+                input_path=root / "CID-SMILES.tsv",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                pubchem_total=7,
+                checkpoint_rows=100,
+                chunk_rows=1000,
+                max_rows=None,
+            )
+            state.record_pubchem_total(7)
+            state.save(root / "run-state.json")
+            loaded = RunState.load(root / "run-state.json")
+            self.assertEqual(loaded.pubchem_total, 7)
+            loaded.validate_against(
+                input_path=root / "CID-SMILES.tsv",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                pubchem_total=None,
+                checkpoint_rows=100,
+                chunk_rows=1000,
+                max_rows=None,
+            )
+            with self.assertRaises(ValueError):
+                loaded.record_pubchem_total(8)
+
+    def test_validation_rejects_a_changed_source_while_the_total_is_deferred(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            options: Dict[str, Any] = dict(
+                input_path=root / "CID-SMILES.tsv",
+                materialized_input_path=root / "CID-SMILES.tsv",
+                pubchem_total=None,
+                checkpoint_rows=100,
+                chunk_rows=1000,
+                max_rows=None,
+            )
+            state = RunState.create(source_bytes=120, source_mtime_ns=5, **options)
+            state.save(root / "run-state.json")
+            loaded = RunState.load(root / "run-state.json")
+            loaded.validate_against(source_bytes=120, source_mtime_ns=5, **options)
+            for source_bytes, source_mtime_ns in ((130, 5), (120, 6)):
+                with self.assertRaisesRegex(ValueError, "PubChem input changed"):
+                    loaded.validate_against(
+                        source_bytes=source_bytes, source_mtime_ns=source_mtime_ns, **options
+                    )
+
+            # States written before the source identity was kept still resume.
+            payload = json.loads((root / "run-state.json").read_text())
+            del payload["source_bytes"], payload["source_mtime_ns"]
+            (root / "run-state.json").write_text(json.dumps(payload))
+            RunState.load(root / "run-state.json").validate_against(
+                source_bytes=130, source_mtime_ns=6, **options
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,141 @@
+import io
+import random
+import tempfile
+import unittest
+from pathlib import Path
+from typing import List, Tuple
+
+from npc_labeler.tsv import (
+    PubchemRowCounter,
+    PubchemTsvReader,
+    RowOffsetIndex,
+    parse_pubchem_line,
+)
+
+
+def _legacy_read(handle, max_rows):
+    # The readline loop pipeline._read_batch used before the block reader.
+    rows: List[Tuple[int, str]] = []
+    end_offset = handle.tell()
+    while len(rows) < max_rows:
+        raw_line = handle.readline()
+        if not raw_line:
+            break
+        end_offset = handle.tell()
+        parsed = parse_pubchem_line(raw_line.decode("utf-8", errors="replace"))
+        if parsed is not None:
+            rows.append(parsed)
+    return rows, end_offset
+
+
+LINES = [
+    b"1\tCCO\n",
+    b"2\tc1ccccc1  \n",
+    b"\n",
+    b"no tab here\n",
+    b"x3\tCC\n",
+    b" 4\tCN\n",
+    b"+5\tCO\r\n",
+    b"\t\n",
+    b"6\t\n",
+    b"1_000\tCCC\n",
+    b"\xd9\xa7\tCS\n",
+    b"8\tC\xff\xfeO\n",
+    b"9\tC[N+](=O)[O-]\textra\n",
+    b"123456789012345678\tC\n",
+    b"1234567890123456789\tCC\n",
+    b"10\t\xe2\x82\xac\n",
+]
+
+
+class PubchemTsvReaderTest(unittest.TestCase):
+    def _compare(self, payload: bytes, *, block_bytes: int, batch_rows: int, start: int = 0) -> None:
+        legacy = io.BytesIO(payload)
+        legacy.seek(start)
+        handle = io.BytesIO(payload)
+        handle.seek(start)
+        reader = PubchemTsvReader(handle, block_bytes=block_bytes)
+        while True:
+            expected_rows, expected_offset = _legacy_read(legacy, batch_rows)
+            batch = reader.read(batch_rows)
+            self.assertEqual(list(zip(batch.cids.tolist(), batch.smiles)), expected_rows)
+            self.assertEqual(batch.end_offset, expected_offset)
+            if not expected_rows:
+                break
+
+    def test_matches_line_reader_on_edge_cases(self) -> None:
+        payload = b"".join(LINES)
+        for block_bytes in (1, 3, 7, 64, 1 << 20):
+            for batch_rows in (1, 2, 5, 100):
+                with self.subTest(block_bytes=block_bytes, batch_rows=batch_rows):
+                    self._compare(payload, block_bytes=block_bytes, batch_rows=batch_rows)
+        for tail in (b"11\tCCN", b"garbage", b"\n\n"):
+            with self.subTest(tail=tail):
+                self._compare(payload + tail, block_bytes=5, batch_rows=3)
+
+    def test_matches_line_reader_on_random_input(self) -> None:
+        rnd = random.Random(7)
+        payload = b"".join(rnd.choice(LINES) for _ in range(2000))
+        offsets = [0] + [index + 1 for index, byte in enumerate(payload) if byte == ord("\n")]
+        for start in rnd.sample(offsets, 3):
+            with self.subTest(start=start):
+                self._compare(payload, block_bytes=97, batch_rows=37, start=start)
+
+    def test_zero_rows_leaves_offset(self) -> None:
+        handle = io.BytesIO(b"bad\n1\tC\n")
+        reader = PubchemTsvReader(handle, block_bytes=2)
+        batch = reader.read(0)
+        self.assertEqual((batch.rows, batch.end_offset), (0, 0))
+        batch = reader.read(4)
+        self.assertEqual((batch.cids.tolist(), batch.smiles, batch.end_offset), ([1], ["C"], 8))
+
+
+class PubchemRowCounterTest(unittest.TestCase):
+    def test_counts_the_rows_the_reader_accepts(self) -> None:
+        rnd = random.Random(11)
+        payload = b"".join(rnd.choice(LINES) for _ in range(500)) + b"12\tCC"
+        expected = len(_legacy_read(io.BytesIO(payload), len(payload))[0])
+        for block_bytes in (1, 5, 64, len(payload)):
+            with self.subTest(block_bytes=block_bytes):
+                counter = PubchemRowCounter()
+                for start in range(0, len(payload), block_bytes):
+                    counter.update(payload[start : start + block_bytes])
+                self.assertEqual(counter.finish(), expected)
+        self.assertEqual(PubchemRowCounter().finish(), 0)
+
+
+class RowOffsetIndexTest(unittest.TestCase):
+    def test_offsets_locate_every_row(self) -> None:
+        rnd = random.Random(5)
+        payload = b"".join(rnd.choice(LINES) for _ in range(700)) + b"13\tCCl"
+        expected, end_offset = _legacy_read(io.BytesIO(payload), len(payload))
+        counter = PubchemRowCounter(stride=16)
+        for start in range(0, len(payload), 29):
+            counter.update(payload[start : start + 29])
+        index = counter.row_index()
+        self.assertEqual((index.rows, index.end_offset), (len(expected), end_offset))
+        self.assertEqual(len(index.offsets), -(-len(expected) // 16))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "CID-SMILES.tsv.rows.idx"
+            index.save(path)
+            loaded = RowOffsetIndex.load(path)
+            path.write_bytes(path.read_bytes()[:-8])
+            with self.assertRaises(ValueError):
+                RowOffsetIndex.load(path)
+        self.assertEqual(loaded.offsets.tolist(), index.offsets.tolist())
+        self.assertEqual((loaded.stride, loaded.rows, loaded.end_offset), (16, index.rows, end_offset))
+
+        handle = io.BytesIO(payload)
+        for row in range(len(expected)):
+            handle.seek(loaded.offset_of(handle, row))
+            batch = PubchemTsvReader(handle, block_bytes=64).read(1)
+            self.assertEqual(list(zip(batch.cids.tolist(), batch.smiles)), [expected[row]])
+        self.assertEqual(loaded.offset_of(handle, len(expected)), end_offset)
+        self.assertEqual(loaded.checkpoint(35), (32, int(loaded.offsets[2])))
+        with self.assertRaises(IndexError):
+            loaded.checkpoint(len(expected) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import copy
+import json
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from npc_labeler.original import prediction_voting
+from npc_labeler.voting import THRESHOLDS, BatchVoter
+
+ONTOLOGY_PATH = Path(__file__).resolve().parents[1] / "npc_labeler" / "original" / "dict" / "index_v1.json"
+
+
+def _legacy_vote(ontology, pred_super, pred_class, pred_path):
+    # The per-row path NPClassifier.record_from_predictions used to take.
+    try:
+        n_super = list(np.flatnonzero(pred_super >= THRESHOLDS["SUPERCLASS"]))
+        n_class = list(np.flatnonzero(pred_class >= THRESHOLDS["CLASS"]))
+        n_path = list(np.flatnonzero(pred_path >= THRESHOLDS["PATHWAY"]))
+        path_from_super = set()
+        for label in n_super:
+            path_from_super.update(ontology["Super_hierarchy"][str(label)]["Pathway"])
+        path_from_class = set()
+        for label in n_class:
+            path_from_class.update(ontology["Class_hierarchy"][str(label)]["Pathway"])
+        pathways, superclasses, classes, _ = prediction_voting.vote_classification(
+            n_path,
+            n_class,
+            n_super,
+            pred_class,
+            pred_super,
+            list(path_from_class),
+            list(path_from_super),
+            False,
+            ontology,
+        )
+    except Exception as error:  # noqa: BLE001
+        return str(error)
+    return (
+        [ontology["Pathway"][label] for label in pathways],
+        [ontology["Superclass"][label] for label in superclasses],
+        [ontology["Class"][label] for label in classes],
+    )
+
+
+def _scores(ontology, rows: int, seed: int):
+    # Sparse noise at several densities plus one planted class per row whose
+    # superclass and pathway are switched on at random, so every voting
+    # branch is reached.
+    rng = np.random.default_rng(seed)
+    hierarchy = ontology["Class_hierarchy"]
+    pred_path = np.empty((rows, len(ontology["Pathway"])), dtype=np.float32)
+    pred_super = np.empty((rows, len(ontology["Superclass"])), dtype=np.float32)
+    pred_class = np.empty((rows, len(ontology["Class"])), dtype=np.float32)
+    for row in range(rows):
+        sharpness = float(rng.choice([5.0, 40.0, 200.0, 2000.0]))
+        pred_path[row] = rng.random(pred_path.shape[1]) ** (sharpness / 20.0 + 1.0)
+        pred_super[row] = rng.random(pred_super.shape[1]) ** (sharpness / 4.0 + 1.0)
+        pred_class[row] = rng.random(pred_class.shape[1]) ** sharpness
+        planted = hierarchy[str(int(rng.integers(len(hierarchy))))]
+        pred_class[row, int(rng.integers(pred_class.shape[1]))] = rng.random()
+        if rng.random() < 0.7:
+            pred_super[row, planted["Superclass"]] = rng.uniform(0.2, 1.0)
+        if rng.random() < 0.7:
+            pred_path[row, planted["Pathway"]] = rng.uniform(0.4, 1.0)
+    return pred_super, pred_class, pred_path
+
+
+class BatchVoterTest(unittest.TestCase):
+    def test_matches_legacy_voting_on_the_shipped_ontology(self) -> None:
+        ontology = json.loads(ONTOLOGY_PATH.read_text())
+        voter = BatchVoter(ontology)
+        pred_super, pred_class, pred_path = _scores(ontology, rows=4000, seed=0)
+
+        outcomes = voter.vote(pred_super, pred_class, pred_path)
+        for row, outcome in enumerate(outcomes):
+            expected = _legacy_vote(ontology, pred_super[row], pred_class[row], pred_path[row])
+            self.assertEqual(outcome, expected, msg="row {0}".format(row))
+        self.assertIn("'58'", outcomes)
+
+    def test_single_row_votes_match_the_batch(self) -> None:
+        ontology = json.loads(ONTOLOGY_PATH.read_text())
+        voter = BatchVoter(ontology)
+        pred_super, pred_class, pred_path = _scores(ontology, rows=50, seed=1)
+
+        batch = voter.vote(pred_super, pred_class, pred_path)
+        for row in range(50):
+            single = voter.vote(
+                pred_super[row : row + 1], pred_class[row : row + 1], pred_path[row : row + 1]
+            )
+            self.assertEqual(single, [batch[row]])
+
+
+class VoteCacheTest(unittest.TestCase):
+    def test_cached_votes_match_uncached_votes(self) -> None:
+        ontology = json.loads(ONTOLOGY_PATH.read_text())
+        pred_super, pred_class, pred_path = _scores(ontology, rows=600, seed=2)
+        pred_super, pred_class, pred_path = (
+            np.vstack([scores, scores[::-1]]) for scores in (pred_super, pred_class, pred_path)
+        )
+
+        expected = BatchVoter(ontology, cache_size=0).vote(pred_super, pred_class, pred_path)
+        voter = BatchVoter(ontology, cache_size=1000)
+        for start in range(0, 1200, 300):
+            actual = voter.vote(
+                pred_super[start : start + 300],
+                pred_class[start : start + 300],
+                pred_path[start : start + 300],
+            )
+            self.assertEqual(actual, expected[start : start + 300])
+        self.assertEqual(voter.cache_hits + voter.cache_misses, 1200)
+        self.assertGreaterEqual(voter.cache_hits, 600)
+        self.assertLessEqual(len(voter._cache), 1000)
+
+    def test_argmax_branches_are_keyed_by_the_argmax(self) -> None:
+        ontology = json.loads(ONTOLOGY_PATH.read_text())
+        hierarchy = ontology["Class_hierarchy"]
+        target = next(
+            int(key)
+            for key, entry in hierarchy.items()
+            if len(entry["Superclass"]) == 1 and len(entry["Pathway"]) == 1
+        )
+        superclass = hierarchy[str(target)]["Superclass"][0]
+        pathway = hierarchy[str(target)]["Pathway"][0]
+        unrelated = next(
+            int(key) for key, entry in hierarchy.items() if superclass not in entry["Superclass"]
+        )
+
+        # One voted pathway and superclass and no class above threshold, so
+        # the legacy voting falls back to the class argmax.
+        pred_path = np.zeros((2, len(ontology["Pathway"])), dtype=np.float32)
+        pred_super = np.zeros((2, len(ontology["Superclass"])), dtype=np.float32)
+        pred_class = np.full((2, len(ontology["Class"])), 0.01, dtype=np.float32)
+        pred_path[:, pathway] = 0.9
+        pred_super[:, superclass] = 0.9
+        pred_class[0, target] = 0.05
+        pred_class[1, unrelated] = 0.05
+
+        expected = [
+            _legacy_vote(ontology, pred_super[row], pred_class[row], pred_path[row])
+            for row in range(2)
+        ]
+        self.assertEqual(expected[0], ([pathway], [superclass], [target]))
+        self.assertEqual(expected[1], ([pathway], [superclass], []))
+
+        voter = BatchVoter(ontology, cache_size=16)
+        self.assertEqual(voter.vote(pred_super, pred_class, pred_path), expected)
+        self.assertEqual(
+            voter.vote(pred_super[::-1], pred_class[::-1], pred_path[::-1]), expected[::-1]
+        )
+        self.assertEqual((voter.cache_hits, voter.cache_misses), (2, 2))
+
+    def test_callers_never_share_the_cached_lists(self) -> None:
+        ontology = json.loads(ONTOLOGY_PATH.read_text())
+        pred_super, pred_class, pred_path = _scores(ontology, rows=20, seed=5)
+        voter = BatchVoter(ontology, cache_size=64)
+
+        first = voter.vote(pred_super, pred_class, pred_path)
+        snapshot = copy.deepcopy(first)
+        for outcome in first:
+            if not isinstance(outcome, str):
+                outcome[0].append(-1)
+        self.assertEqual(voter.vote(pred_super, pred_class, pred_path), snapshot)
+        self.assertEqual(voter.cache_hits, 20)
+
+if __name__ == "__main__":
+    unittest.main()